@@ -21,17 +21,20 @@ import datetime
 import enum
 import json
 import logging
+import time
+from concurrent import futures
 from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
-from googleapiclient import discovery
+from googleapiclient.errors import HttpError
 import google_auth_httplib2
-import google.oauth2.credentials
+import httplib2
 
 import errors
 import immutabledict
-import requests
 from pydantic import Field
-from utils import ProtocolSchema, RunResult, SchemaUtils, ValidationResult
+from utils import (GoogleApiUtils, HttpTransport, OAuthTokenCache,
+                   ProtocolSchema, RunResult, SchemaUtils, SharedRateLimiter,
+                   ValidationResult)
 
 CM_CONVERSION_FIELDS = [
   "floodlightConfigurationId",
@@ -80,6 +83,23 @@ CM_CREDENTIALS = [
   "client_secret",
 ]
 
+API_VERSION = "v4"
+
+# Maximum number of conversions of a batchinsert request.
+_MAX_CONVERSIONS_PER_REQUEST = 1000
+_DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+_DEFAULT_MAX_REQUESTS_PER_SECOND = 5
+
+# Failed conversions are re-sent on their own, in smaller requests.
+_MAX_RETRIES = 2
+_MAX_CONVERSIONS_PER_RETRY_REQUEST = 100
+_RETRY_BACKOFF_SECONDS = 2
+# ConversionError codes worth re-sending the conversion for.
+_RETRIABLE_CONVERSION_ERROR_CODES = frozenset(["INTERNAL"])
+
+IndexedConversions = List[Tuple[int, Dict[str, Any]]]
+
+
 class Destination:
   """Implements DestinationProto protocol for Campaign Manager Offline Conversion Import."""
 
@@ -96,24 +116,45 @@ class Destination:
     self.encryption_info["encryptionEntityId"] = config.get("encryptionEntityId","")
     self.encryption_info["encryptionEntitySource"] = config.get("encryptionEntitySource","")
     self.encryption_info["kind"] = config.get("kind","")
+    self.max_concurrent_requests = int(
+      config.get("max_concurrent_requests") or _DEFAULT_MAX_CONCURRENT_REQUESTS)
+    # shared by the runs of every worker uploading to the profile
+    self._rate_limiter = SharedRateLimiter(
+      f"cm360oci/{self.profileId}",
+      float(config.get("max_requests_per_second") or _DEFAULT_MAX_REQUESTS_PER_SECOND))
     self.validate()
     self._validate_credentials()
     
     # Authenticate using the supplied user account credentials
     self.http = self.authenticate_using_user_account()
+    # Built on first use and reused by every request.
+    self._service = None
+
+  @property
+  def service(self) -> Any:
+    """The Campaign Manager 360 API service."""
+    if self._service is None:
+      self._service = GoogleApiUtils().build_service(
+        "dfareporting", API_VERSION, http=self.http)
+    return self._service
 
   def authenticate_using_user_account(self):
     """Authorizes an httplib2.Http instance using user account credentials."""
     
-    credentials = google.oauth2.credentials.Credentials(
-    self.credentials['access_token'],
-    refresh_token = self.credentials['refresh_token'],
-    token_uri = self.credentials['token_uri'],
-    client_id = self.credentials['client_id'],
-    client_secret = self.credentials['client_secret'])
-
-    # Use the credentials to authorize an httplib2.Http instance.
-    http = google_auth_httplib2.AuthorizedHttp(credentials)
+    # Access tokens are shared with the other connections of the same user,
+    # the access_token of the config being only validated.
+    credentials = OAuthTokenCache.shared().user_credentials(
+      self.credentials['client_id'],
+      self.credentials['client_secret'],
+      self.credentials['refresh_token'],
+      token_uri=self.credentials['token_uri'])
+
+    # Authorizes an httplib2.Http view of the worker's pooled transport,
+    # which is safe to share between the sending threads. Requests are sent
+    # once, failed ones being retried (rate-limited) by _send_conversions,
+    # which opts requests with ordinals into 5xx retries (see _send_payload).
+    http = google_auth_httplib2.AuthorizedHttp(
+      credentials, http=HttpTransport.shared().httplib2_adapter(retry=False))
 
     return http
 
@@ -136,36 +177,49 @@ class Destination:
       return timestamp_micros
     return None
 
-  def _send_payload(self, payload: Dict[str, Any]) -> None:
+  def _send_payload(self, payload: Dict[str, Any]) -> Mapping[str, Any]:
     """Sends conversions payload to CM360 via CM API.
 
+    Safe to call from concurrent threads, requests being spaced out by the
+    rate limiter of the profile.
+
+    Requests failing with a 5xx or connection error may have been processed,
+    so they are only retriable when CM360 deduplicates their conversions,
+    i.e. when every conversion has an ordinal.
+
     Args:
       payload: Parameters containing required data for conversion tracking.
 
     Returns:
-      results: Includes request body, status_code, error_msg, response body and
-      debug flag.
-    """
-
-    # Construct a service object via the discovery service.
-    service = discovery.build('dfareporting', 'v4', http=self.http)
+      The ConversionsBatchInsertResponse.
 
+    Raises:
+      DataOutConnectorSendUnsuccessfulError: If the request failed.
+    """
+    request = self.service.conversions().batchinsert(profileId=self.profileId,
+                                                     body=payload)
+    idempotent = all(
+      conversion.get("ordinal") for conversion in payload["conversions"])
+    self._rate_limiter.acquire()
     try:
-      request = service.conversions().batchinsert(profileId=self.profileId,
-                                            body=payload)
-
-      response = request.execute()
-      # Success is to be considered between 200 and 299:
-      # https://developer.mozilla.org/en-US/docs/Web/HTTP/Status
-      if response.status_code < 200 or response.status_code >= 300:
-        raise errors.DataOutConnectorSendUnsuccessfulError(
-            msg="Sending payload to CM360 did not complete successfully.",
-            error_num=errors.ErrorNameIDMap.RETRIABLE_CM360_HOOK_ERROR_HTTP_ERROR,
-        )
-    except requests.ConnectionError:
+      return request.execute()
+    except HttpError as http_error:
+      status = http_error.resp.status
+      if status == 429 or (status >= 500 and idempotent):
+        error_num = errors.ErrorNameIDMap.RETRIABLE_CM360_HOOK_ERROR_HTTP_ERROR
+      else:
+        error_num = errors.ErrorNameIDMap.NON_RETRIABLE_ERROR_EVENT_NOT_SENT
+      raise errors.DataOutConnectorSendUnsuccessfulError(
+          msg=f"Sending payload to CM360 did not complete successfully: {http_error}",
+          error_num=error_num,
+      )
+    except (httplib2.HttpLib2Error, OSError):
       raise errors.DataOutConnectorSendUnsuccessfulError(
           msg="Sending payload to CM360 did not complete successfully.",
-          error_num=errors.ErrorNameIDMap.RETRIABLE_CM360_HOOK_ERROR_HTTP_ERROR,
+          error_num=(
+            errors.ErrorNameIDMap.RETRIABLE_CM360_HOOK_ERROR_HTTP_ERROR
+            if idempotent
+            else errors.ErrorNameIDMap.NON_RETRIABLE_ERROR_EVENT_NOT_SENT),
       )
 
   def send_data(self, input_data: List[Mapping[str, Any]], dry_run:bool) -> Optional[RunResult]:
@@ -190,22 +244,19 @@ class Destination:
           conversion[conversion_field] = str(entry.get(conversion_field, ""))
       
       if self.validate_conversion(conversion):
-        valid_conversions.append(conversion)
+        valid_conversions.append((i, conversion))
       else:
         invalid_conversions.append((i, errors.ErrorNameIDMap.CM_HOOK_ERROR_INVALID_CONVERSION_EVENT))
 
     if valid_conversions:
-      payload = {}
-      payload["encryptionInfo"] = self.encryption_info
-      payload["conversions"] = valid_conversions
-
       if not dry_run:
-        try:
-          self._send_payload(payload)
-        except (
-              errors.DataOutConnectorSendUnsuccessfulError,
-          ) as error:
-            send_error = error.error_num
+        failed_conversions = self._send_conversions(valid_conversions)
+        failed_indices = {index for index, _ in failed_conversions}
+        valid_conversions = [
+          (index, conversion) for index, conversion in valid_conversions
+          if index not in failed_indices
+        ]
+        invalid_conversions += failed_conversions
       else:
         print(
           "Dry-Run: CM conversions event will not be sent."
@@ -216,10 +267,102 @@ class Destination:
       failed_hits=len(invalid_conversions),
       error_messages=[str(error[1]) for error in invalid_conversions],
       dry_run=dry_run,
+      failed_indices=[error[0] for error in invalid_conversions],
     )
 
     return run_result
 
+  def _send_chunk(
+      self, chunk: IndexedConversions
+  ) -> Tuple[List[Tuple[int, Dict[str, Any], str]], List[Tuple[int, str]]]:
+    """Sends a batchinsert request, checking the status of each conversion.
+
+    Args:
+      chunk: Index-conversion tuples, where the index is the position of the
+        conversion in the input data.
+
+    Returns:
+      The index-conversion-error tuples of the conversions worth re-sending,
+      and the index-error tuples of the other failed conversions.
+    """
+    payload = {}
+    payload["encryptionInfo"] = self.encryption_info
+    payload["conversions"] = [conversion for _, conversion in chunk]
+    try:
+      response = self._send_payload(payload)
+    except errors.DataOutConnectorSendUnsuccessfulError as error:
+      if error.error_num == errors.ErrorNameIDMap.RETRIABLE_CM360_HOOK_ERROR_HTTP_ERROR:
+        return [(index, conversion, error.msg) for index, conversion in chunk], []
+      return [], [(index, error.msg) for index, _ in chunk]
+
+    retriable_conversions = []
+    failed_conversions = []
+    if not response.get("hasFailures"):
+      return retriable_conversions, failed_conversions
+    # Statuses are in the order of the conversions of the request.
+    for (index, conversion), status in zip(chunk, response.get("status", [])):
+      conversion_errors = status.get("errors")
+      if not conversion_errors:
+        continue
+      error_msg = "; ".join(
+        f"{error.get('code')}: {error.get('message')}" for error in conversion_errors)
+      if all(error.get("code") in _RETRIABLE_CONVERSION_ERROR_CODES
+             for error in conversion_errors):
+        retriable_conversions.append((index, conversion, error_msg))
+      else:
+        failed_conversions.append((index, error_msg))
+    return retriable_conversions, failed_conversions
+
+  def _send_conversions(
+      self, indexed_conversions: IndexedConversions
+  ) -> List[Tuple[int, Any]]:
+    """Sends conversions in concurrent batchinsert requests.
+
+    Only the conversions failing with a retriable error are re-sent, in
+    smaller requests, up to _MAX_RETRIES times.
+
+    Args:
+      indexed_conversions: Index-conversion tuples, where the index is the
+        position of the conversion in the input data.
+
+    Returns:
+      Index-error tuples of the conversions that could not be sent.
+    """
+    failed_conversions = []
+    pending_conversions = indexed_conversions
+    chunk_size = _MAX_CONVERSIONS_PER_REQUEST
+    for attempt in range(_MAX_RETRIES + 1):
+      if attempt:
+        print(f"Retrying {len(pending_conversions)} CM360 conversions.")
+        time.sleep(_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+      chunks = [
+        pending_conversions[start:start + chunk_size]
+        for start in range(0, len(pending_conversions), chunk_size)
+      ]
+      retriable_conversions = []
+      with futures.ThreadPoolExecutor(max(1, self.max_concurrent_requests)) as executor:
+        for chunk_retriable, chunk_failed in executor.map(self._send_chunk, chunks):
+          retriable_conversions.extend(chunk_retriable)
+          failed_conversions.extend(chunk_failed)
+      if not retriable_conversions:
+        return failed_conversions
+      pending_conversions = [
+        (index, conversion) for index, conversion, _ in retriable_conversions
+      ]
+      chunk_size = _MAX_CONVERSIONS_PER_RETRY_REQUEST
+    # Retries exhausted
+    failed_conversions.extend(
+      (index, error_msg) for index, _, error_msg in retriable_conversions)
+    return failed_conversions
+
+  def telemetry(self) -> Mapping[str, Any]:
+    """Returns the HTTP counters of the worker's transport."""
+    return HttpTransport.shared().stats()
+
+  def close(self) -> None:
+    """Releases the database connection of the rate limiter."""
+    self._rate_limiter.close()
+
   @staticmethod
   def schema() -> Optional[ProtocolSchema]:
     return ProtocolSchema(
@@ -235,6 +378,8 @@ class Destination:
         ("token_uri", str, Field(description="A Campaign Manager 360 API token uri.")),
         ("client_id", str, Field(description="An OAuth2.0 Web Client ID.")),
         ("client_secret", str, Field(description="An OAuth2.0 Web Client Secret.")),
+        ("max_concurrent_requests", Optional[int], Field(default=_DEFAULT_MAX_CONCURRENT_REQUESTS, description="Maximum number of batchinsert requests sent concurrently.")),
+        ("max_requests_per_second", Optional[float], Field(default=_DEFAULT_MAX_REQUESTS_PER_SECOND, description="Maximum number of batchinsert requests per second for the profile, shared by all the runs (on every worker) uploading to it.")),
       ]
     )
 
@@ -242,7 +387,8 @@ class Destination:
     return CM_CONVERSION_FIELDS
 
   def batch_size(self) -> int:
-    return 1000
+    # One request per concurrent slot.
+    return _MAX_CONVERSIONS_PER_REQUEST * self.max_concurrent_requests
 
   def validate(self) -> ValidationResult:
     """Validates the provided config.
@@ -18,17 +18,19 @@ limitations under the License."""
 # pylint: disable=raise-missing-from
 
 import enum
+import json
+import re
+from concurrent import futures
 from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
 import googleapiclient
-from googleapiclient import discovery
 
 import google_auth_httplib2
-import google.oauth2.credentials
 
 import errors
 from pydantic import Field
-from utils import GoogleAdsUtils, ProtocolSchema, RunResult, ValidationResult
+from utils import (GoogleApiUtils, HashingUtils, HttpTransport, OAuthTokenCache,
+                   ProtocolSchema, RunResult, ValidationResult)
 
 DV_CONTACT_INFO_FIELDS = [
     "email",
@@ -48,7 +50,6 @@ DV_DEVICE_ID_FIELDS = [
 ]
 
 DV_CREDENTIALS = [
-    "access_token",
     "refresh_token",
     "client_id",
     "client_secret",
@@ -59,6 +60,47 @@ SERVICE_URL = f"https://displayvideo.googleapis.com/$discovery/rest?version={API
 
 MEMBERSHIP_DURATION_DEFAULT = 540
 
+# editCustomerMatchMembers accepts up to 500,000 members per request, but
+# smaller chunks are sent concurrently and bound what a failure can affect.
+_MAX_ENTRIES_PER_REQUEST = 10000
+# Kept well below the API's request payload size limit.
+_MAX_REQUEST_BYTES = 8 * 1024 * 1024
+_DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+# Bisection levels of a rejected chunk, i.e. down to chunks of ~10 entries.
+_MAX_BISECTION_DEPTH = 10
+# Fields of the ids objects, as named by the errors rejecting their values.
+_MEMBER_DATA_ERROR_REGEX = re.compile(
+    r"contact_?info|mobile_?device_?id|hashed|zip_?code|country_?code",
+    re.IGNORECASE)
+
+IndexedIds = List[Tuple[int, Any]]
+
+# Raw PII fields hashed by the destination, mapped to their normalization rule
+RAW_PII_FIELDS = {
+    "email": HashingUtils.EMAIL,
+    "phone_number": HashingUtils.TEXT,
+    "first_name": HashingUtils.TEXT,
+    "last_name": HashingUtils.TEXT,
+}
+
+
+def _is_member_data_error(error: Exception) -> bool:
+  """Whether a request was rejected because of the members it contained."""
+  if not isinstance(error, googleapiclient.errors.HttpError) or (
+      error.resp.status != 400):
+    return False
+  try:
+    details = json.loads(error.content)["error"]
+    fields = [
+        violation.get("field", "")
+        for detail in details.get("details", [])
+        for violation in detail.get("fieldViolations", [])
+    ]
+    text = " ".join([details.get("message", ""), *fields])
+  except (ValueError, KeyError, TypeError, AttributeError):
+    return False
+  return bool(_MEMBER_DATA_ERROR_REGEX.search(text))
+
 
 class PayloadTypes(str, enum.Enum):
   """DV360 supported payload types."""
@@ -79,6 +121,11 @@ class Destination:
     self.membership_duration_days = config.get(
         "membership_duration_days",
         MEMBERSHIP_DURATION_DEFAULT)
+    self.hashing = HashingUtils(
+        HashingUtils.modes_from_config(config, RAW_PII_FIELDS))
+    self.max_concurrent_requests = int(
+        config.get("max_concurrent_requests")
+        or _DEFAULT_MAX_CONCURRENT_REQUESTS)
 
     self.credentials = {}
     for credential in DV_CREDENTIALS:
@@ -87,26 +134,43 @@ class Destination:
 
     # Authenticate using the supplied user account credentials
     self.http = self.authenticate_using_user_account()
-    self.client = discovery.build(
-        "displayvideo",
-        API_VERSION,
-        discoveryServiceUrl=SERVICE_URL,
-        http=self.http
-    ).firstAndThirdPartyAudiences()
+    # Adding members is idempotent, so member uploads (unlike audience
+    # creations) are retried on 5xx responses too.
+    self._members_http = google_auth_httplib2.AuthorizedHttp(
+        self.http.credentials,
+        http=HttpTransport.shared().httplib2_adapter(idempotent=True))
+    # Built on first use, so parsing the DAG does not build the service.
+    self._client = None
+    # Looked up (or created) once per run.
+    self._audience_id = None
+
+  @property
+  def client(self) -> Any:
+    """The firstAndThirdPartyAudiences resource of the DV360 service."""
+    if self._client is None:
+      self._client = GoogleApiUtils().build_service(
+          "displayvideo",
+          API_VERSION,
+          http=self.http,
+          discovery_service_url=SERVICE_URL,
+      ).firstAndThirdPartyAudiences()
+    return self._client
 
   def authenticate_using_user_account(self):
     """Authorizes an httplib2.Http instance using user account credentials."""
 
-    credentials = google.oauth2.credentials.Credentials(
-        self.credentials["access_token"],
-        refresh_token=self.credentials["refresh_token"],
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=self.credentials["client_id"],
-        client_secret=self.credentials["client_secret"]
+    # Access tokens are refreshed from the refresh token and shared with the
+    # other connections of the same user.
+    credentials = OAuthTokenCache.shared().user_credentials(
+        self.credentials["client_id"],
+        self.credentials["client_secret"],
+        self.credentials["refresh_token"],
     )
 
-    # Use the credentials to authorize an httplib2.Http instance.
-    http = google_auth_httplib2.AuthorizedHttp(credentials)
+    # Authorizes an httplib2.Http view of the worker's pooled transport,
+    # which is safe to share between the sending threads.
+    http = google_auth_httplib2.AuthorizedHttp(
+        credentials, http=HttpTransport.shared().httplib2_adapter())
 
     return http
 
@@ -157,11 +221,16 @@ class Destination:
 
   def _get_audience_id(self) -> Optional[str]:
     """Get audience_id of an audience with the same name as provided, if it exists.
+
+    The audience is only looked up until it is found (or created by this
+    run), the id being cached afterwards.
     
     Returns:
       The audience_id str, if the audience can be found.
       Returns None otherwise, which will cause a new audience to be created.
     """
+    if self._audience_id is not None:
+      return self._audience_id
     audiences = self.client.list(
         advertiserId=self.advertiser_id,
         filter=f"displayName:\"{self.audience_name}\""
@@ -170,17 +239,45 @@ class Destination:
       if audience["displayName"] == self.audience_name:
         # if and audience with the exact display name exists,
         # return the audience id
-        audience_id = audience["name"].split("/")[1]
-        return audience_id
+        self._audience_id = audience["name"].split("/")[1]
+        return self._audience_id
    # if the audience is not found, return None and a new audience
    # with this display name will be created downstream.
     return None
 
-  def _build_request_body(self, entries: List[Dict[str, Any]], is_create: bool) -> Dict[str, Any]:
+  def _build_indexed_ids(
+      self, indexed_entries: List[Tuple[int, Dict[str, Any]]]) -> IndexedIds:
+    """Builds the ids objects of the entries, keeping their input indices."""
+    entries = [entry for _, entry in indexed_entries]
+    if self.payload_type == PayloadTypes.CONTACT_INFO:
+      # Raw PII fields are normalized and hashed for the whole batch at once.
+      entries = self.hashing.hash_columns(entries, RAW_PII_FIELDS)
+    return [(index, self._build_ids_object(entry))
+            for (index, _), entry in zip(indexed_entries, entries)]
+
+  def _chunk_ids(self, indexed_ids: IndexedIds) -> List[IndexedIds]:
+    """Splits ids objects in chunks within the per-request limits."""
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+    for index, ids in indexed_ids:
+      ids_bytes = len(json.dumps(ids))
+      if chunk and (len(chunk) == _MAX_ENTRIES_PER_REQUEST or
+                    chunk_bytes + ids_bytes > _MAX_REQUEST_BYTES):
+        chunks.append(chunk)
+        chunk = []
+        chunk_bytes = 0
+      chunk.append((index, ids))
+      chunk_bytes += ids_bytes
+    if chunk:
+      chunks.append(chunk)
+    return chunks
+
+  def _build_request_body(self, ids_objects: List[Any], is_create: bool) -> Dict[str, Any]:
     """Creates DV360 API request body."""
     body = {}
     inner_id_field = "contactInfos" if self.payload_type == PayloadTypes.CONTACT_INFO else "mobileDeviceIds"
-    ids = {inner_id_field: [self._build_ids_object(entry) for entry in entries]}
+    ids = {inner_id_field: ids_objects}
     if is_create:
       # "create" exclusive fields
       outer_id_field = "contactInfoList" if self.payload_type == PayloadTypes.CONTACT_INFO else "mobileDeviceIdList"
@@ -204,7 +301,8 @@ class Destination:
     """Build an ids object compatible with the payload type using the provided entry.
 
     Args:
-      entry: One row of the input_data read from the source.
+      entry: One row of the input_data read from the source, with its raw PII
+        fields already hashed (see _build_indexed_ids).
 
     Returns:
       A formatted id object compatible with the payload type.
@@ -227,25 +325,25 @@ class Destination:
       # Email
       if email:
         ids["hashedEmails"] = []
-        ids["hashedEmails"].append(GoogleAdsUtils().normalize_and_hash_email_address(email))
+        ids["hashedEmails"].append(email)
       elif hashed_email:
         ids["hashedEmails"] = []
         ids["hashedEmails"].append(hashed_email)
       # Phone Number
       if phone_number:
         ids["hashedPhoneNumbers"] = []
-        ids["hashedPhoneNumbers"].append(GoogleAdsUtils().normalize_and_hash(phone_number))
+        ids["hashedPhoneNumbers"].append(phone_number)
       elif hashed_phone_number:
         ids["hashedPhoneNumbers"] = []
         ids["hashedPhoneNumbers"].append(hashed_phone_number)
       # First Name
       if first_name:
-        ids["hashedFirstName"] = GoogleAdsUtils().normalize_and_hash(first_name)
+        ids["hashedFirstName"] = first_name
       elif hashed_first_name:
         ids["hashedFirstName"] = hashed_first_name
       # Last Name
       if last_name:
-        ids["hashedLastName"] = GoogleAdsUtils().normalize_and_hash(last_name)
+        ids["hashedLastName"] = last_name
       elif hashed_last_name:
         ids["hashedLastName"] = hashed_last_name
       # Other Address fields
@@ -272,56 +370,115 @@ class Destination:
             f"Missing {credential} in config: {self.config}"
         )
 
-  def _send_payload(self, valid_entries: List[Dict[str, Any]], audience_id: Optional[str]) -> None:
-    """Sends Customer Match payload to DV360 API.
+  @staticmethod
+  def _error_message(error: Exception) -> str:
+    return f"Sending payload to DV360 did not complete successfully: {error}"
 
-    Args:
-      valid_entries: Validated customer match list entries.
-      audience_id: Id of existing list to update. Will create a new list if it is None.
+  def _request_members(self, chunk: IndexedIds) -> Optional[Exception]:
+    """Sends a chunk of members in a single request.
+
+    The audience is created with the chunk if it does not exist yet.
 
     Returns:
-      results: Includes request body, status_code, error_msg, response body and
-      debug flag.
+      The error of the request, if it failed.
     """
-    is_create = audience_id is None
-    body = self._build_request_body(
-        entries=valid_entries,
-        is_create=is_create
-    )
+    is_create = self._audience_id is None
+    body = self._build_request_body([ids for _, ids in chunk], is_create)
     try:
       if is_create:
-        # creates new audience
-        request = self.client.create(
-            advertiserId=self.advertiser_id,
-            body=body
-        )
+        response = self.client.create(
+            advertiserId=self.advertiser_id, body=body).execute()
+        self._audience_id = response.get("firstAndThirdPartyAudienceId")
+        print(f"{self.audience_name} customer match list created successfully with {len(chunk)} entries.")
       else:
-        # adds to existent audience
-        request = self.client.editCustomerMatchMembers(
-            firstAndThirdPartyAudienceId=audience_id,
-            body=body
-        )
+        self.client.editCustomerMatchMembers(
+            firstAndThirdPartyAudienceId=self._audience_id, body=body
+        ).execute(http=self._members_http)
+    except (googleapiclient.errors.HttpError, OSError) as error:
+      # OSError: requests and httplib2 connection errors, once retries are
+      # exhausted
+      return error
+    return None
 
-      response = request.execute()
-      if response:
-        action_verb = "created" if is_create else "updated"
-        print(f"{self.audience_name} customer match list {action_verb} successfully with {len(valid_entries)} entries.")
-    except googleapiclient.errors.HttpError as http_error:
-      if http_error.resp.status >= 400 and http_error.resp.status < 500:
-        error_num = errors.ErrorNameIDMap.NON_RETRIABLE_ERROR_EVENT_NOT_SENT
-      else:
-        error_num = errors.ErrorNameIDMap.RETRIABLE_DV360_HOOK_ERROR_HTTP_ERROR
-      raise errors.DataOutConnectorSendUnsuccessfulError(
-          msg=f"Sending payload to DV360 did not complete successfully: {http_error}",
-          error_num=error_num,
-      )
+  def _send_members(self, chunk: IndexedIds) -> List[Tuple[int, str]]:
+    """Sends a chunk of members, isolating the entries that are rejected.
+
+    Args:
+      chunk: Index-ids tuples, where the index is the position of the entry in
+        the input data.
+
+    Returns:
+      Index-error tuples of the entries that could not be sent.
+    """
+    error = self._request_members(chunk)
+    if error is None:
+      return []
+    return self._bisect(chunk, error, depth=0)
+
+  def _bisect(
+      self, chunk: IndexedIds, error: Exception, depth: int
+  ) -> List[Tuple[int, str]]:
+    """Sends the halves of a rejected chunk again, down to the failing entries.
+
+    Only chunks rejected because of their member data are bisected, up to
+    _MAX_BISECTION_DEPTH levels.
+    """
+    if (len(chunk) == 1 or depth >= _MAX_BISECTION_DEPTH or
+        not _is_member_data_error(error)):
+      message = self._error_message(error)
+      return [(index, message) for index, _ in chunk]
+    middle = len(chunk) // 2
+    halves = (chunk[:middle], chunk[middle:])
+    half_errors = [self._request_members(half) for half in halves]
+    failures = []
+    for half, half_error in zip(halves, half_errors):
+      if half_error is not None:
+        failures.extend(self._bisect(half, half_error, depth + 1))
+    return failures
+
+  def _send_payload(
+      self, valid_entries: List[Tuple[int, Dict[str, Any]]]
+  ) -> List[Tuple[int, str]]:
+    """Sends Customer Match payload to DV360 API.
+
+    Entries are sent in chunks within the API limits, with up to
+    max_concurrent_requests chunks in flight. When the audience does not
+    exist yet, it is first created with the first chunk.
+
+    Args:
+      valid_entries: Validated customer match list entries, with their input
+        indices.
+
+    Returns:
+      Index-error tuples of the entries that could not be sent.
+    """
+    chunks = self._chunk_ids(self._build_indexed_ids(valid_entries))
+    failures = []
+    if self._audience_id is None:
+      failures = self._send_members(chunks[0])
+      chunks = chunks[1:]
+      if self._audience_id is None:
+        # nothing can be added to an audience that could not be created
+        error = failures[0][1] if failures else (
+            f"The creation of {self.audience_name} returned no audience id.")
+        return failures + [
+            (index, error) for chunk in chunks for index, _ in chunk
+        ]
+
+    edit_failures = []
+    with futures.ThreadPoolExecutor(max(1, self.max_concurrent_requests)) as executor:
+      for chunk_failures in executor.map(self._send_members, chunks):
+        edit_failures.extend(chunk_failures)
+    if chunks:
+      sent_entries = sum(map(len, chunks)) - len(edit_failures)
+      print(f"{self.audience_name} customer match list updated successfully with {sent_entries} entries.")
+    return failures + edit_failures
 
   def send_data(self, input_data: List[Mapping[str, Any]], dry_run: bool) -> Optional[RunResult]:
     """Builds payload and sends data to DV360 API."""
 
     valid_entry_tuples = []
     invalid_entry_tuples = []
-    http_error = None
 
     for i, entry in enumerate(input_data):
       is_valid, error_message = self._validate_entry(entry)
@@ -332,22 +489,20 @@ class Destination:
 
     if valid_entry_tuples:
       if not dry_run:
-        try:
-          valid_entries = [entry[1] for entry in valid_entry_tuples] 
-          self._send_payload(valid_entries, self._get_audience_id())
-        except (
-            errors.DataOutConnectorSendUnsuccessfulError,
-        ) as error:
-          http_error = error.msg
+        # creates the audience (see _send_payload) if it is not found
+        self._get_audience_id()
+        failed_entry_tuples = self._send_payload(valid_entry_tuples)
+        failed_indices = {entry_tuple[0] for entry_tuple in failed_entry_tuples}
+        valid_entry_tuples = [
+            entry_tuple for entry_tuple in valid_entry_tuples
+            if entry_tuple[0] not in failed_indices
+        ]
+        invalid_entry_tuples += failed_entry_tuples
       else:
         print(
             "Dry-Run: DV Customer Match audiences will not be sent."
         )
 
-    if http_error:
-      invalid_entry_tuples += [(entry_tuple[0], http_error) for entry_tuple in valid_entry_tuples]
-      valid_entry_tuples = []
-
     print(f"Sent entries: {len(valid_entry_tuples)}")
     print(f"Invalid entries: {len(invalid_entry_tuples)}")
 
@@ -362,10 +517,19 @@ class Destination:
         failed_hits=len(invalid_entry_tuples),
         error_messages=[str(error[1]) for error in invalid_entry_tuples],
         dry_run=dry_run,
+        failed_indices=[error[0] for error in invalid_entry_tuples],
     )
 
     return run_result
 
+  def telemetry(self) -> Mapping[str, Any]:
+    """Returns the hash cache counters of the run and the HTTP counters."""
+    return {**self.hashing.stats(), **HttpTransport.shared().stats()}
+
+  def close(self) -> None:
+    """Shuts down the hashing process pool of the run."""
+    self.hashing.close()
+
   @staticmethod
   def schema() -> Optional[ProtocolSchema]:
     return ProtocolSchema(
@@ -396,9 +560,17 @@ class Destination:
                  default=MEMBERSHIP_DURATION_DEFAULT,
                  description="The duration in days that an entry remains in the audience after the qualifying event. If the audience has no expiration, set the value of this field to 10000. Otherwise, the set value must be greater than 0 and less than or equal to 540.")
             ),
+            ("max_concurrent_requests",
+             Optional[int],
+             Field(
+                 default=_DEFAULT_MAX_CONCURRENT_REQUESTS,
+                 description="Maximum number of member upload requests sent concurrently.")
+            ),
             ("access_token",
-             str,
-             Field(description="An OAuth2.0 access token.")
+             Optional[str],
+             Field(
+                 default=None,
+                 description="Unused: access tokens are refreshed from the refresh token.")
             ),
             ("refresh_token",
              str,
@@ -412,6 +584,7 @@ class Destination:
              str,
              Field(description="An OAuth2.0 Web Client Secret.")
             ),
+            *HashingUtils.schema_fields(RAW_PII_FIELDS),
         ]
     )
 
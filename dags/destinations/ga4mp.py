@@ -21,19 +21,96 @@ import datetime
 import enum
 import json
 import logging
+import random
+import re
+import time
+from concurrent import futures
 from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
 import errors
 import immutabledict
 import requests
 from pydantic import Field
-from utils import ProtocolSchema, RunResult, SchemaUtils, ValidationResult
+from utils import (HttpTransport, ProtocolSchema, RunResult, SchemaUtils,
+                   ValidationResult)
+
+try:
+  import orjson
+  _dumps = orjson.dumps
+except ImportError:
+  _JSON_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+  def _dumps(obj: Any) -> bytes:
+    return _JSON_ENCODER.encode(obj).encode()
 
 _GA_EVENT_POST_URL = "https://www.google-analytics.com/mp/collect"
 _GA_EVENT_VALIDATION_URL = "https://www.google-analytics.com/debug/mp/collect"
 
+# Measurement Protocol limits, see
+# https://developers.google.com/analytics/devguides/collection/protocol/ga4/sending-events#limitations
+_MAX_EVENTS_PER_REQUEST = 25
+_MAX_PAYLOAD_BYTES = 130000
+
+# Documented Measurement Protocol payload rules, checked locally so that the
+# debug endpoint is not needed for every event. See
+# https://developers.google.com/analytics/devguides/collection/protocol/ga4/sending-events#limitations
+# and https://support.google.com/analytics/answer/13316687
+_MAX_EVENT_NAME_LENGTH = 40
+_MAX_PARAMS_PER_EVENT = 25
+_MAX_PARAM_NAME_LENGTH = 40
+_MAX_PARAM_VALUE_LENGTH = 100
+_MAX_ITEM_CUSTOM_PARAMS = 10
+_MAX_USER_PROPERTIES = 25
+_MAX_USER_PROPERTY_NAME_LENGTH = 24
+_MAX_USER_PROPERTY_VALUE_LENGTH = 36
+_MAX_USER_ID_LENGTH = 256
+_MAX_TIMESTAMP_AGE_MICROS = 72 * 3600 * 1_000_000
+# tolerated clock skew for events timestamped slightly in the future
+_MAX_TIMESTAMP_SKEW_MICROS = 15 * 60 * 1_000_000
+_NAME_REGEX = re.compile(r"^[A-Za-z][A-Za-z0-9_]*$")
+_APP_INSTANCE_ID_REGEX = re.compile(r"^[0-9A-Fa-f]{32}$")
+_RESERVED_PREFIXES = ("_", "firebase_", "ga_", "google_", "gtag.")
+_RESERVED_EVENT_NAMES = frozenset([
+    "ad_activeview", "ad_click", "ad_exposure", "ad_impression", "ad_query",
+    "ad_reward", "adunit_exposure", "app_background", "app_clear_data",
+    "app_exception", "app_install", "app_remove", "app_store_refund",
+    "app_store_subscription_cancel", "app_store_subscription_convert",
+    "app_store_subscription_renew", "app_update", "app_upgrade",
+    "dynamic_link_app_open", "dynamic_link_app_update",
+    "dynamic_link_first_open", "error", "first_open", "first_visit",
+    "in_app_purchase", "notification_dismiss", "notification_foreground",
+    "notification_open", "notification_receive", "os_update", "session_start",
+    "session_start_with_rollout", "user_engagement",
+])
+_RESERVED_USER_PROPERTY_NAMES = frozenset([
+    "first_open_time", "first_visit_time", "last_deep_link_referrer",
+    "user_id", "first_open_after_install",
+])
+_ITEM_ID_PARAMS = ("item_id", "item_name")
+_ITEM_STANDARD_PARAMS = frozenset([
+    "item_id", "item_name", "affiliation", "coupon", "discount", "index",
+    "item_brand", "item_category", "item_category2", "item_category3",
+    "item_category4", "item_category5", "item_list_id", "item_list_name",
+    "item_variant", "location_id", "price", "quantity",
+])
+
+_DEFAULT_VALIDATION_SAMPLE_SIZE = 10
+_DEFAULT_VALIDATION_SAMPLE_RATE = 0.01
+_DEFAULT_VALIDATION_ERROR_THRESHOLD = 0.05
+
+_DEFAULT_MAX_CONCURRENT_REQUESTS = 10
+_DEFAULT_REQUEST_TIMEOUT_SECONDS = 30
+
 _FIREBASE_ID_COLUMN = "app_instance_id"
 _GTAG_ID_COLUMN = "client_id"
+# Row keys that are payload fields rather than event params
+_NON_PARAM_KEYS = frozenset([
+    _FIREBASE_ID_COLUMN,
+    _GTAG_ID_COLUMN,
+    "user_id",
+    "timestamp_micros",
+    "event_name",
+])
 
 _ERROR_TYPES = immutabledict.immutabledict({
     "client_id": errors.ErrorNameIDMap.GA4_HOOK_ERROR_VALUE_REQUIRED_CLIENT_ID,
@@ -95,6 +172,206 @@ class PayloadTypes(enum.Enum):
   GTAG = "gtag"
 
 
+class ValidationPolicies(enum.Enum):
+  """Which locally valid events are also checked by the debug endpoint."""
+
+  ALL = "all"
+  NONE = "none"
+  FIRST_N = "first_n"
+  SAMPLE_RATE = "sample_rate"
+
+
+def _is_reserved_name(name: str) -> bool:
+  return name.startswith(_RESERVED_PREFIXES)
+
+
+def _config_value(config: Dict[str, Any], key: str, default: Any) -> Any:
+  """Returns the configured value of key, or default when it is unset."""
+  value = config.get(key)
+  return default if value is None else value
+
+
+class _OfflineValidator:
+  """Checks single-event payloads against the documented MP rules.
+
+  Raises the same DataOutConnectorValueError codes that the debug endpoint
+  responses are mapped to (see _ERROR_TYPES).
+  """
+
+  def __init__(self, payload_type: str):
+    self._payload_type = payload_type
+
+  def validate(self, payload: Dict[str, Any]) -> None:
+    self._validate_ids(payload)
+    self._validate_timestamp(payload.get("timestamp_micros"))
+    if not isinstance(payload.get("non_personalized_ads"), bool):
+      self._fail("non_personalized_ads")
+    self._validate_user_properties(payload.get("user_properties"))
+    for event in payload["events"]:
+      self._validate_event(event)
+
+  @staticmethod
+  def _fail(property_name: str) -> None:
+    raise errors.DataOutConnectorValueError(
+        error_num=_ERROR_TYPES[property_name]
+    )
+
+  def _validate_ids(self, payload: Dict[str, Any]) -> None:
+    if self._payload_type == PayloadTypes.FIREBASE.value:
+      app_instance_id = payload.get("app_instance_id") or ""
+      if not _APP_INSTANCE_ID_REGEX.match(app_instance_id):
+        self._fail("client_id")
+    elif not payload.get("client_id"):
+      self._fail("client_id")
+    if len(payload.get("user_id") or "") > _MAX_USER_ID_LENGTH:
+      self._fail("user_id")
+
+  def _validate_timestamp(self, timestamp_micros: Optional[int]) -> None:
+    if timestamp_micros is None:
+      return
+    now_micros = int(time.time() * 1_000_000)
+    if (
+        timestamp_micros < now_micros - _MAX_TIMESTAMP_AGE_MICROS
+        or timestamp_micros > now_micros + _MAX_TIMESTAMP_SKEW_MICROS
+    ):
+      self._fail("timestamp_micros")
+
+  def _validate_user_properties(
+      self, user_properties: Optional[Dict[str, Any]]
+  ) -> None:
+    if not user_properties:
+      return
+    if len(user_properties) > _MAX_USER_PROPERTIES:
+      self._fail("user_properties")
+    for name, user_property in user_properties.items():
+      value = user_property.get("value")
+      if (
+          len(name) > _MAX_USER_PROPERTY_NAME_LENGTH
+          or not _NAME_REGEX.match(name)
+          or _is_reserved_name(name)
+          or name in _RESERVED_USER_PROPERTY_NAMES
+          or (isinstance(value, str)
+              and len(value) > _MAX_USER_PROPERTY_VALUE_LENGTH)
+      ):
+        self._fail("user_properties")
+
+  def _validate_event(self, event: Dict[str, Any]) -> None:
+    name = event.get("name") or ""
+    if (
+        len(name) > _MAX_EVENT_NAME_LENGTH
+        or not _NAME_REGEX.match(name)
+        or _is_reserved_name(name)
+        or name in _RESERVED_EVENT_NAMES
+    ):
+      self._fail("events")
+    params = event.get("params") or {}
+    if len(params) > _MAX_PARAMS_PER_EVENT:
+      self._fail("events.params")
+    for key, value in params.items():
+      if key == "items":
+        self._validate_items(value)
+      elif (
+          len(key) > _MAX_PARAM_NAME_LENGTH
+          or not _NAME_REGEX.match(key)
+          or _is_reserved_name(key)
+          or (isinstance(value, str) and len(value) > _MAX_PARAM_VALUE_LENGTH)
+      ):
+        self._fail("events.params")
+
+  def _validate_items(self, items: Any) -> None:
+    if isinstance(items, str):
+      # CSV and Drill sources deliver the items as a JSON string
+      try:
+        items = json.loads(items)
+      except ValueError:
+        self._fail("events.params.items")
+    if not isinstance(items, list):
+      self._fail("events.params.items")
+    for item in items:
+      if (
+          not isinstance(item, dict)
+          or not any(item.get(key) for key in _ITEM_ID_PARAMS)
+          or len(item.keys() - _ITEM_STANDARD_PARAMS) > _MAX_ITEM_CUSTOM_PARAMS
+      ):
+        self._fail("events.params.items")
+
+
+class _PayloadBuilder:
+  """Turns rows into single-event payloads for a destination config.
+
+  Everything that only depends on the config (id column, static fields) is
+  resolved once, so building a payload is a single pass over the row.
+  """
+
+  def __init__(
+      self,
+      payload_type: str,
+      non_personalized_ads: bool,
+      user_properties: Optional[Dict[str, Any]],
+  ):
+    self._is_gtag = payload_type == PayloadTypes.GTAG.value
+    self._id_column = _GTAG_ID_COLUMN if self._is_gtag else _FIREBASE_ID_COLUMN
+    self._static_fields = {"non_personalized_ads": non_personalized_ads}
+    if user_properties:
+      self._static_fields["user_properties"] = user_properties
+
+  def build(self, event: Mapping[str, Any]) -> Dict[str, Any]:
+    event_id = event.get(self._id_column, "")
+    payload = {
+        self._id_column: str(event_id) if self._is_gtag else event_id,
+        "user_id": str(event.get("user_id", "")),
+    }
+    payload.update(self._static_fields)
+    timestamp_micros = event.get("timestamp_micros")
+    if timestamp_micros:
+      if isinstance(timestamp_micros, int):
+        payload["timestamp_micros"] = timestamp_micros
+      elif timestamp_micros.isdigit():
+        payload["timestamp_micros"] = int(timestamp_micros)
+    payload["events"] = [{
+        "name": event.get("event_name", ""),
+        # filter out null parameters and payload fields
+        "params": {
+            k: v for k, v in event.items()
+            if v is not None and v != "" and k not in _NON_PARAM_KEYS
+        },
+    }]
+    return payload
+
+
+class _EventPack:
+  """A multi-event request body and the input indices of its events.
+
+  Events are kept serialized, so each event is encoded exactly once and the
+  payload size is known without re-encoding the whole body.
+  """
+
+  def __init__(self, payload: Dict[str, Any]):
+    self.indices = []
+    self._events = []
+    header = {k: v for k, v in payload.items() if k != "events"}
+    # the serialized header ends with "}", reopened to append the events
+    self._prefix = _dumps(header)[:-1] + b',"events":['
+    self.size = len(self._prefix) + 2
+
+  def fits(self, event_size: int) -> bool:
+    return (
+        len(self.indices) < _MAX_EVENTS_PER_REQUEST
+        # +1 accounts for the separator between events
+        and self.size + event_size + 1 <= _MAX_PAYLOAD_BYTES
+    )
+
+  def add(self, index: int, event: bytes) -> None:
+    if self._events:
+      self.size += 1
+    self.indices.append(index)
+    self._events.append(event)
+    self.size += len(event)
+
+  def body(self) -> bytes:
+    return self._prefix + b",".join(self._events) + b"]}"
+
+
 class Destination:
   """Implements DestinationProto protocol for GA4 Measurement Protocol."""
 
@@ -109,8 +386,35 @@ class Destination:
     self.non_personalized_ads = config.get("non_personalized_ads") or False
     self.user_properties = self._parse_user_properties(config)
     self.debug = config.get("debug") or False
+    self.validation_policy = (
+        config.get("validation_policy") or ValidationPolicies.ALL.value
+    )
+    # an explicit 0 is meaningful (no sample, no tolerated error)
+    self.validation_sample_size = int(_config_value(
+        config, "validation_sample_size", _DEFAULT_VALIDATION_SAMPLE_SIZE
+    ))
+    self.validation_sample_rate = float(_config_value(
+        config, "validation_sample_rate", _DEFAULT_VALIDATION_SAMPLE_RATE
+    ))
+    self.validation_error_threshold = float(_config_value(
+        config, "validation_error_threshold", _DEFAULT_VALIDATION_ERROR_THRESHOLD
+    ))
+    self.max_concurrent_requests = int(
+        config.get("max_concurrent_requests") or _DEFAULT_MAX_CONCURRENT_REQUESTS
+    )
+    self.request_timeout = float(
+        config.get("request_timeout_seconds") or _DEFAULT_REQUEST_TIMEOUT_SECONDS
+    )
+    # Keeps connections alive across requests, and retries throttled (429)
+    # requests with backoff; 5xx responses are only retried for the debug
+    # endpoint, as events sent to /mp/collect may have been collected.
+    self._transport = HttpTransport.shared()
 
     self._validate_credentials()
+    self._offline_validator = _OfflineValidator(self.payload_type)
+    self._payload_builder = _PayloadBuilder(
+        self.payload_type, self.non_personalized_ads, self.user_properties
+    )
     self.post_url = self._build_api_url(True)
     self.validate_url = self._build_api_url(False)
 
@@ -133,8 +437,10 @@ class Destination:
   ) -> Tuple[List[Tuple[int, Dict[str, Any]]], List[Tuple[int, errors.ErrorNameIDMap]]]:
     """Prepares index-event tuples to keep order while sending.
 
-       Validation of the payload is done by posting it to the validation API
-       provided by the product of Google Analytics 4.
+       Every payload is validated locally against the documented Measurement
+       Protocol rules. Depending on the validation policy, locally valid
+       payloads are also posted to the validation API provided by the product
+       of Google Analytics 4.
 
        A valid payload format in event should comply with rules described below.
        https://developers.google.com/analytics/devguides/collection/protocol/ga4/reference/events
@@ -153,44 +459,139 @@ class Destination:
     valid_events = []
     invalid_indices_and_errors = []
     for i, event in enumerate(events):
-      payload = {}
-      if self.payload_type == PayloadTypes.FIREBASE.value:
-        payload["app_instance_id"] = event.get("app_instance_id", "")
-      elif self.payload_type == PayloadTypes.GTAG.value:
-        payload["client_id"] = str(event.get("client_id", ""))
-      payload["user_id"] = str(event.get("user_id", ""))
-      payload["non_personalized_ads"] = self.non_personalized_ads
-      if self.user_properties:
-        payload["user_properties"] = self.user_properties
-      timestamp_micros = self._parse_timestamp_micros(event)
-      if timestamp_micros:
-        payload["timestamp_micros"] = timestamp_micros
-      params = {k: v for k, v in event.items() if self._validate_param(k, v)}
-      payload["events"] = [{
-          "name": event.get("event_name", ""),
-          "params": params,
-      }]
+      payload = self._payload_builder.build(event)
       try:
-        response = self._send_validate_request(payload)
-        self._parse_validate_result(event, response)
+        self._offline_validator.validate(payload)
         valid_events.append((i, payload))
       except errors.DataOutConnectorValueError as error:
         invalid_indices_and_errors.append((i, error.error_num))
 
+    if not valid_events:
+      return valid_events, invalid_indices_and_errors
+
+    if self.validation_policy == ValidationPolicies.ALL.value:
+      valid_events, remote_invalid_events = self._validate_remotely(valid_events)
+      invalid_indices_and_errors.extend(remote_invalid_events)
+    elif self.validation_policy in (
+        ValidationPolicies.FIRST_N.value, ValidationPolicies.SAMPLE_RATE.value
+    ):
+      remote_invalid_events = self._validate_sample_remotely(valid_events)
+      remote_invalid_indices = {index for index, _ in remote_invalid_events}
+      valid_events = [
+          e for e in valid_events if e[0] not in remote_invalid_indices
+      ]
+      invalid_indices_and_errors.extend(remote_invalid_events)
+
+    return valid_events, invalid_indices_and_errors
+
+  def _draw_validation_sample(self, events_count: int) -> List[int]:
+    """Draws the positions of the events validated remotely in a batch."""
+    if self.validation_policy == ValidationPolicies.FIRST_N.value:
+      return list(range(min(self.validation_sample_size, events_count)))
+    if not self.validation_sample_rate:
+      return []
+    sample_size = min(
+        max(1, round(events_count * self.validation_sample_rate)), events_count
+    )
+    return sorted(random.sample(range(events_count), sample_size))
+
+  def _validate_sample_remotely(
+      self, events: List[Tuple[int, Dict[str, Any]]]
+  ) -> List[Tuple[int, errors.ErrorNameIDMap]]:
+    """Validates a sample of the events against the debug endpoint.
+
+    Works as a circuit breaker: when the error rate of the sample is above
+    the configured threshold, the rest of the batch is validated as well.
+
+    Args:
+      events: index-payload tuples of locally valid events.
+
+    Returns:
+      A list of index-error for the events rejected by the debug endpoint.
+    """
+    sample_positions = self._draw_validation_sample(len(events))
+    if not sample_positions:
+      return []
+    sample = [events[p] for p in sample_positions]
+    _, invalid_indices_and_errors = self._validate_remotely(sample)
+    error_rate = len(invalid_indices_and_errors) / len(sample)
+    print(
+        f"Remote validation of {len(sample)} sampled events: "
+        f"error rate {error_rate:.2%}."
+    )
+    if error_rate > self.validation_error_threshold:
+      print(
+          "Sampled error rate is above "
+          f"{self.validation_error_threshold:.2%}, validating the whole batch."
+      )
+      sampled = set(sample_positions)
+      rest = [e for p, e in enumerate(events) if p not in sampled]
+      _, rest_invalid_indices_and_errors = self._validate_remotely(rest)
+      invalid_indices_and_errors.extend(rest_invalid_indices_and_errors)
+    return invalid_indices_and_errors
+
+  def _validate_remotely(
+      self, events: List[Tuple[int, Dict[str, Any]]]
+  ) -> Tuple[List[Tuple[int, Dict[str, Any]]], List[Tuple[int, errors.ErrorNameIDMap]]]:
+    """Validates index-payload tuples against the debug endpoint."""
+    valid_events = []
+    invalid_indices_and_errors = []
+    with futures.ThreadPoolExecutor(self.max_concurrent_requests) as executor:
+      # map keeps the input order of the events
+      results = executor.map(
+          lambda event: self._validate_remotely_one(event[1]), events
+      )
+      for event, error_num in zip(events, results):
+        if error_num is None:
+          valid_events.append(event)
+        else:
+          invalid_indices_and_errors.append((event[0], error_num))
     return valid_events, invalid_indices_and_errors
 
-  def _parse_timestamp_micros(self, event: Dict[str, Any]):
-    t = event.get("timestamp_micros")
-    if t:
-      timestamp_micros = int(t) if t.isdigit() else None
-      return timestamp_micros
+  def _validate_remotely_one(
+      self, payload: Dict[str, Any]
+  ) -> Optional[errors.ErrorNameIDMap]:
+    try:
+      response = self._send_validate_request(payload)
+      self._parse_validate_result(payload, response)
+    except errors.DataOutConnectorValueError as error:
+      return error.error_num
     return None
 
-  def _validate_param(self, key: str, value: Any) -> bool:
-    """Filter out null parameters and reserved keys."""
-    reserved_keys = ['app_instance_id', 'client_id', 'user_id', 'timestamp_micros', 'event_name']
-    result = key not in reserved_keys and value is not None and value != ''
-    return result
+  def _pack_events(
+      self, valid_events: List[Tuple[int, Dict[str, Any]]]
+  ) -> List[_EventPack]:
+    """Packs single-event payloads into multi-event payloads.
+
+    Events can only share a request when every request-level field matches,
+    so events are grouped by client/app instance id, user_id and
+    timestamp_micros (the remaining fields are the same for the whole
+    destination). Packs respect the events per request and payload size limits
+    of the Measurement Protocol.
+
+    Args:
+      valid_events: index-payload tuples of validated single-event payloads.
+
+    Returns:
+      The packs, in the order of their first event.
+    """
+    packs = []
+    open_packs = {}
+    for index, payload in valid_events:
+      key = (
+          payload.get("app_instance_id"),
+          payload.get("client_id"),
+          payload.get("user_id"),
+          payload.get("timestamp_micros"),
+      )
+      event = _dumps(payload["events"][0])
+      pack = open_packs.get(key)
+      if pack is None or not pack.fits(len(event)):
+        pack = _EventPack(payload)
+        open_packs[key] = pack
+        packs.append(pack)
+      pack.add(index, event)
+    return packs
 
   def _parse_validate_result(
       self,
@@ -274,18 +675,25 @@ class Destination:
     validating_payload = dict(payload)
     validating_payload["validationBehavior"] = "ENFORCE_RECOMMENDATIONS"
     try:
-      response = requests.post(self.validate_url, json=validating_payload)
-    except requests.ConnectionError as err:
+      # nothing is collected by the debug endpoint, so 5xx are retried too
+      response = self._transport.post(
+          self.validate_url,
+          json=validating_payload,
+          timeout=self.request_timeout,
+          idempotent=True,
+      )
+    except (requests.ConnectionError, requests.Timeout) as err:
       raise errors.DataOutConnectorValueError(
           error_num=errors.ErrorNameIDMap.RETRIABLE_GA4_HOOK_ERROR_HTTP_ERROR
       ) from err
     return response
 
-  def _send_payload(self, payload: Dict[str, Any]) -> None:
+  def _send_payload(self, body: bytes) -> None:
     """Sends payload to GA via Measurement Protocol REST API.
 
     Args:
-      payload: Parameters containing required data for app conversion tracking.
+      body: Serialized JSON payload containing required data for app
+        conversion tracking.
 
     Returns:
       results: Includes request body, status_code, error_msg, response body and
@@ -295,16 +703,21 @@ class Destination:
     """
 
     if self.debug:
-      self.log.info(
+      print(
           """Debug mode: Simulating sending event to GA4 (data will not
           actually be sent). URL:{}. payload data:{}.""".format(
-              self.post_url, payload
+              self.post_url, body.decode()
           )
       )
       return
 
     try:
-      response = requests.post(self.post_url, json=payload)
+      response = self._transport.post(
+          self.post_url,
+          data=body,
+          headers={"Content-Type": "application/json"},
+          timeout=self.request_timeout,
+      )
       # Success is to be considered between 200 and 299:
       # https://developer.mozilla.org/en-US/docs/Web/HTTP/Status
       if response.status_code < 200 or response.status_code >= 300:
@@ -312,12 +725,23 @@ class Destination:
             msg="Sending payload to GA did not complete successfully.",
             error_num=errors.ErrorNameIDMap.RETRIABLE_GA_HOOK_ERROR_HTTP_ERROR,
         )
-    except requests.ConnectionError:
+    except (requests.ConnectionError, requests.Timeout):
       raise errors.DataOutConnectorSendUnsuccessfulError(
           msg="Sending payload to GA did not complete successfully.",
           error_num=errors.ErrorNameIDMap.RETRIABLE_GA_HOOK_ERROR_HTTP_ERROR,
       )
 
+  def _send_pack(self, pack: _EventPack) -> Optional[errors.ErrorNameIDMap]:
+    """Sends a pack, returning the error of a failed request (if any)."""
+    try:
+      self._send_payload(pack.body())
+    except (
+        errors.DataOutConnectorSendUnsuccessfulError,
+        errors.DataOutConnectorValueError,
+    ) as error:
+      return error.error_num
+    return None
+
   def send_data(
       self, input_data: List[Mapping[str, Any]], dry_run: bool
   ) -> Optional[RunResult]:
@@ -326,20 +750,30 @@ class Destination:
         input_data
     )
 
+    sent_events = valid_events
     if not dry_run:
-      for valid_event in valid_events:
-        try:
-          event = valid_event[1]
-          self._send_payload(event)
-        except (
-            errors.DataOutConnectorSendUnsuccessfulError,
-            errors.DataOutConnectorValueError,
-        ) as error:
-          index = valid_event[0]
-          invalid_indices_and_errors.append((index, error.error_num))
+      packs = self._pack_events(valid_events)
+      print(f"Sending {len(valid_events)} events in {len(packs)} requests.")
+      failed_indices = set()
+      with futures.ThreadPoolExecutor(self.max_concurrent_requests) as executor:
+        results = executor.map(self._send_pack, packs)
+        for pack, error_num in zip(packs, results):
+          if error_num is None:
+            continue
+          # a failed request fails every event it carried
+          for index in pack.indices:
+            failed_indices.add(index)
+            invalid_indices_and_errors.append((index, error_num))
+      sent_events = [e for e in valid_events if e[0] not in failed_indices]
     else:
+      if self.validation_policy == ValidationPolicies.ALL.value:
+        validation = "against the debug endpoint"
+      elif self.validation_policy == ValidationPolicies.NONE.value:
+        validation = "locally"
+      else:
+        validation = "locally, and a sample of them against the debug endpoint"
       print(
-          "Dry-Run: Events will be validated agains the debug endpoint and will not be actually sent."
+          f"Dry-Run: Events were validated {validation} and will not be actually sent."
       )
 
     print(f"Valid events: {valid_events}")
@@ -352,14 +786,19 @@ class Destination:
       print(f"event_index: {event_index}; error_num: {error_num}")
 
     run_result = RunResult(
-        successful_hits=len(valid_events),
+        successful_hits=len(sent_events),
         failed_hits=len(invalid_indices_and_errors),
         error_messages=[str(error[1]) for error in invalid_indices_and_errors],
         dry_run=dry_run,
+        failed_indices=[error[0] for error in invalid_indices_and_errors],
     )
 
     return run_result
 
+  def telemetry(self) -> Mapping[str, Any]:
+    """Returns the HTTP counters of the worker's transport."""
+    return self._transport.stats()
+
   @staticmethod
   def schema() -> Optional[ProtocolSchema]:
     return ProtocolSchema(
@@ -387,6 +826,29 @@ class Destination:
             ("user_properties", Optional[List[_KEY_VALUE_TYPE]], Field(
                 default=None,
                 description="The user properties for the measurement.")),
+            ("validation_policy", Optional[ValidationPolicies], Field(
+                default=ValidationPolicies.ALL.value,
+                description="Events are always validated locally. `all` also checks every event against the GA4 debug endpoint, `first_n` and `sample_rate` only check a sample of each batch (escalating to the whole batch when the sample error rate is above `validation_error_threshold`).",
+                validation="all|none|first_n|sample_rate")),
+            ("validation_sample_size", Optional[int], Field(
+                default=_DEFAULT_VALIDATION_SAMPLE_SIZE,
+                condition_field="validation_policy",
+                condition_target="first_n",
+                description="Number of events at the start of each batch checked against the GA4 debug endpoint.")),
+            ("validation_sample_rate", Optional[float], Field(
+                default=_DEFAULT_VALIDATION_SAMPLE_RATE,
+                condition_field="validation_policy",
+                condition_target="sample_rate",
+                description="Fraction of each batch randomly checked against the GA4 debug endpoint.")),
+            ("validation_error_threshold", Optional[float], Field(
+                default=_DEFAULT_VALIDATION_ERROR_THRESHOLD,
+                description="Sampled error rate above which the whole batch is checked against the GA4 debug endpoint.")),
+            ("max_concurrent_requests", Optional[int], Field(
+                default=_DEFAULT_MAX_CONCURRENT_REQUESTS,
+                description="Maximum number of in-flight requests to the Measurement Protocol.")),
+            ("request_timeout_seconds", Optional[float], Field(
+                default=_DEFAULT_REQUEST_TIMEOUT_SECONDS,
+                description="Timeout of each request to the Measurement Protocol.")),
         ]
     )
 
@@ -14,14 +14,47 @@ See the License for the specific language governing permissions and
 limitations under the License."""
 
 """Google Ads Customer Match destination implementation."""
+import enum
 import json
+import time
+import uuid
 
+from airflow.hooks.postgres_hook import PostgresHook
+from psycopg2 import sql
+from psycopg2.extras import execute_values
 from pydantic import Field
-from typing import Any, Dict, List, Mapping, Optional, Sequence
-from utils import GoogleAdsUtils, ProtocolSchema, RunResult, ValidationResult
-
-# Default batch size of 1000 user identifiers
-_BATCH_SIZE = 1000
+from typing import (Any, Dict, Iterable, Iterator, List, Mapping, Optional,
+                    Sequence, Tuple)
+from utils import (GoogleAdsClientCache, GoogleAdsUtils, HashingUtils,
+                   ProtocolSchema, RunResult, ValidationResult)
+
+# Operations are buffered into a single job per run, so batches are only
+# bounded by memory; large batches let HashingUtils hash them in parallel.
+_BATCH_SIZE = 50000
+
+# Maximum number of operations added to the job by a single request
+_MAX_OPERATIONS_PER_REQUEST = 10000
+
+# The upload job of a run is polled with exponential backoff for at most
+# job_status_timeout_seconds, after which it is left running.
+_DEFAULT_JOB_STATUS_TIMEOUT_SECONDS = 600
+_MIN_JOB_STATUS_POLL_SECONDS = 5
+_MAX_JOB_STATUS_POLL_SECONDS = 60
+
+# Tables (in the Tightlock config database) holding the members of each user
+# list as of the last delta sync, the members staged by each run, and the
+# upload jobs whose outcome was not reported yet.
+_SNAPSHOT_TABLE = "customer_match_snapshot"
+_STAGING_TABLE = "customer_match_staging"
+_JOBS_TABLE = "customer_match_jobs"
+_SNAPSHOT_CURSOR_ITERSIZE = 10000
+
+# Members staged by runs that never recorded a job (e.g. failed runs) are
+# dropped after this interval.
+_STAGING_RETENTION = "7 days"
+
+_CREATE = "create"
+_REMOVE = "remove"
 
 _USER_IDENTIFIER_FIELDS = [
   "email",
@@ -32,6 +65,17 @@ _USER_IDENTIFIER_FIELDS = [
   "postal_code"
 ]
 
+# Fields of a mailing address identifier, which are all set or all unset
+_ADDRESS_FIELDS = ("first_name", "last_name", "country_code", "postal_code")
+
+# Identifier fields hashed by the scrubber, mapped to their normalization rule
+_HASHED_FIELDS = {
+  "email": HashingUtils.EMAIL,
+  "phone": HashingUtils.TEXT,
+  "first_name": HashingUtils.TEXT,
+  "last_name": HashingUtils.TEXT,
+}
+
 
 def _construct_error_message(api_error: Any) -> str:
   """Construct an error message from an API error object."""
@@ -43,67 +87,356 @@ def _construct_error_message(api_error: Any) -> str:
   )
 
 
+class SyncModes(enum.Enum):
+  """How the source rows are synced to the user list."""
+
+  ADD = "add"
+  DELTA = "delta"
+
+
+def _member_keys(user_data: Mapping[str, Any]) -> List[str]:
+  """Canonical (sortable) keys of the user identifiers of a row.
+
+  Customer Match adds and removes users by identifier, so each hashed email,
+  phone number and mailing address is synced as a member of its own; a user
+  whose phone number changed keeps their email in the list.
+  """
+  keys = []
+  for identifier in ("email", "phone"):
+    if identifier in user_data:
+      keys.append(f"{identifier}:{user_data[identifier]}")
+  if "first_name" in user_data:
+    address = {k: user_data[k] for k in _ADDRESS_FIELDS}
+    keys.append(
+      f"address:{json.dumps(address, sort_keys=True, separators=(',', ':'))}")
+  return keys
+
+
+def _member_user_data(member: str) -> Mapping[str, Any]:
+  """The user data of the single identifier of a member key."""
+  identifier, value = member.split(":", 1)
+  if identifier == "address":
+    return json.loads(value)
+  return {identifier: value}
+
+
+def _sort_merge(
+    previous: Iterable[str], current: Iterable[str]
+) -> Iterator[Tuple[str, str]]:
+  """Streams the operations that turn one sorted member list into another.
+
+  Args:
+    previous: The members of the last sync, sorted and without duplicates.
+    current: The members of this run, sorted and without duplicates.
+
+  Yields:
+    (_REMOVE, member) for members only in previous and (_CREATE, member) for
+    members only in current.
+  """
+  previous, current = iter(previous), iter(current)
+  previous_member = next(previous, None)
+  current_member = next(current, None)
+  while previous_member is not None or current_member is not None:
+    if current_member is None or (
+        previous_member is not None and previous_member < current_member):
+      yield _REMOVE, previous_member
+      previous_member = next(previous, None)
+    elif previous_member is None or current_member < previous_member:
+      yield _CREATE, current_member
+      current_member = next(current, None)
+    else:
+      previous_member = next(previous, None)
+      current_member = next(current, None)
+
+
+class _UserListState:
+  """Sync state of a user list, kept in the Tightlock config database.
+
+  Upload jobs are recorded until their outcome is reported, possibly by a
+  later run. In the "delta" sync mode, the members (identifiers, see
+  _member_keys) of a run are staged (keyed by run) as they arrive and diffed
+  against the members of the last sync with a sort-merge over two ordered
+  server-side cursors, so neither list has to fit in memory. Staged members
+  only become the snapshot once the job of their run succeeded. Members are
+  stored with the "C" collation, which orders them like Python compares
+  strings.
+
+  Concurrent runs of a user list stage their members apart, and resolve jobs
+  (hence replace the snapshot) under an advisory lock of the user list.
+  """
+
+  def __init__(self, user_list: str, run_id: str):
+    self._user_list = user_list
+    self._run_id = run_id
+    self._conn = None
+    self.staged_members = 0
+
+  def _connection(self) -> Any:
+    """Connects on first use, creating the tables if needed."""
+    if self._conn is None:
+      self._conn = PostgresHook(postgres_conn_id="tightlock_config").get_conn()
+      with self._conn.cursor() as cursor:
+        cursor.execute(sql.SQL(
+          "CREATE TABLE IF NOT EXISTS {table} ("
+          " user_list TEXT NOT NULL,"
+          ' member TEXT COLLATE "C" NOT NULL,'
+          " PRIMARY KEY (user_list, member))"
+        ).format(table=sql.Identifier(_SNAPSHOT_TABLE)))
+        cursor.execute(sql.SQL(
+          "CREATE TABLE IF NOT EXISTS {table} ("
+          " run_id TEXT NOT NULL,"
+          " user_list TEXT NOT NULL,"
+          ' member TEXT COLLATE "C" NOT NULL,'
+          " staged_at TIMESTAMP NOT NULL DEFAULT now(),"
+          " PRIMARY KEY (run_id, member))"
+        ).format(table=sql.Identifier(_STAGING_TABLE)))
+        cursor.execute(sql.SQL(
+          "CREATE TABLE IF NOT EXISTS {table} ("
+          " job TEXT PRIMARY KEY,"
+          " user_list TEXT NOT NULL,"
+          " run_id TEXT,"
+          " operations BIGINT NOT NULL,"
+          " created_at TIMESTAMP NOT NULL DEFAULT now())"
+        ).format(table=sql.Identifier(_JOBS_TABLE)))
+        cursor.execute(
+          sql.SQL(
+            "DELETE FROM {staging} WHERE staged_at < now() - %s::INTERVAL"
+            " AND NOT EXISTS ("
+            " SELECT 1 FROM {jobs} WHERE {jobs}.run_id = {staging}.run_id)"
+          ).format(
+            staging=sql.Identifier(_STAGING_TABLE),
+            jobs=sql.Identifier(_JOBS_TABLE)),
+          (_STAGING_RETENTION,))
+      self._conn.commit()
+    return self._conn
+
+  def stage(self, members: Sequence[str]) -> None:
+    """Adds members of the current run (duplicates are ignored)."""
+    conn = self._connection()
+    with conn.cursor() as cursor:
+      execute_values(
+        cursor,
+        sql.SQL(
+          "INSERT INTO {table} (run_id, user_list, member) VALUES %s"
+          " ON CONFLICT DO NOTHING"
+        ).format(table=sql.Identifier(_STAGING_TABLE)).as_string(conn),
+        [(self._run_id, self._user_list, member) for member in members],
+        page_size=_SNAPSHOT_CURSOR_ITERSIZE,
+      )
+    conn.commit()
+    self.staged_members += len(members)
+
+  def _ordered_members(self, table: str, key: str, value: str) -> Iterator[str]:
+    with self._connection().cursor(name=f"tightlock_{uuid.uuid4().hex}") as cursor:
+      cursor.itersize = _SNAPSHOT_CURSOR_ITERSIZE
+      cursor.execute(
+        sql.SQL(
+          "SELECT member FROM {table} WHERE {key} = %s ORDER BY member"
+        ).format(table=sql.Identifier(table), key=sql.Identifier(key)),
+        (value,))
+      for (member,) in cursor:
+        yield member
+
+  def diff(self) -> Iterator[Tuple[str, str]]:
+    """Streams the create and remove operations of the current run."""
+    yield from _sort_merge(
+      self._ordered_members(_SNAPSHOT_TABLE, "user_list", self._user_list),
+      self._ordered_members(_STAGING_TABLE, "run_id", self._run_id),
+    )
+    # ends the transaction that held the server-side cursors
+    self._connection().rollback()
+
+  def restage_failures(self, failures: Sequence[Tuple[str, str]]) -> None:
+    """Keeps the snapshot from recording the operations that failed.
+
+    Members of failed creates are dropped from the staged members and
+    members of failed removes are staged, so the next run computes their
+    operations again.
+
+    Args:
+      failures: Operation type-member tuples of the failed operations.
+    """
+    creates = [member for operation, member in failures if operation == _CREATE]
+    removes = [member for operation, member in failures if operation == _REMOVE]
+    conn = self._connection()
+    with conn.cursor() as cursor:
+      if creates:
+        cursor.execute(
+          sql.SQL(
+            "DELETE FROM {table} WHERE run_id = %s AND member = ANY(%s)"
+          ).format(table=sql.Identifier(_STAGING_TABLE)),
+          (self._run_id, creates))
+      if removes:
+        execute_values(
+          cursor,
+          sql.SQL(
+            "INSERT INTO {table} (run_id, user_list, member) VALUES %s"
+            " ON CONFLICT DO NOTHING"
+          ).format(table=sql.Identifier(_STAGING_TABLE)).as_string(conn),
+          [(self._run_id, self._user_list, member) for member in removes],
+          page_size=_SNAPSHOT_CURSOR_ITERSIZE,
+        )
+    conn.commit()
+
+  def discard(self) -> None:
+    """Drops the members staged by the current run."""
+    conn = self._connection()
+    with conn.cursor() as cursor:
+      cursor.execute(
+        sql.SQL("DELETE FROM {table} WHERE run_id = %s").format(
+          table=sql.Identifier(_STAGING_TABLE)),
+        (self._run_id,))
+    conn.commit()
+
+  def add_job(self, job: str, operations: int, staged: bool) -> None:
+    """Records the job of the current run until its outcome is reported.
+
+    Args:
+      job: The resource name of the job.
+      operations: The number of operations added to the job.
+      staged: Whether the members staged by the run become the snapshot of
+        the user list once the job succeeded.
+    """
+    conn = self._connection()
+    with conn.cursor() as cursor:
+      cursor.execute(
+        sql.SQL(
+          "INSERT INTO {table} (job, user_list, run_id, operations)"
+          " VALUES (%s, %s, %s, %s)"
+        ).format(table=sql.Identifier(_JOBS_TABLE)),
+        (job, self._user_list, self._run_id if staged else None, operations))
+    conn.commit()
+
+  def pending_jobs(self) -> List[Tuple[str, int]]:
+    """Returns the recorded jobs and their operations, oldest first."""
+    conn = self._connection()
+    with conn.cursor() as cursor:
+      cursor.execute(
+        sql.SQL(
+          "SELECT job, operations FROM {table} WHERE user_list = %s"
+          " ORDER BY created_at, job"
+        ).format(table=sql.Identifier(_JOBS_TABLE)),
+        (self._user_list,))
+      jobs = cursor.fetchall()
+    conn.rollback()
+    return [(job, operations) for job, operations in jobs]
+
+  def resolve_job(self, job: str, succeeded: bool) -> bool:
+    """Forgets a finished job, replacing the snapshot if it succeeded.
+
+    The members staged by the run of a failed job are dropped, so the
+    previous snapshot is kept and the next run computes their operations
+    again.
+
+    Returns:
+      False if the job was already resolved (by a concurrent run).
+    """
+    conn = self._connection()
+    with conn.cursor() as cursor:
+      params = {
+        "jobs": sql.Identifier(_JOBS_TABLE),
+        "snapshot": sql.Identifier(_SNAPSHOT_TABLE),
+        "staging": sql.Identifier(_STAGING_TABLE),
+      }
+      # held until the commit, so snapshots are replaced one run at a time
+      cursor.execute(
+        "SELECT pg_advisory_xact_lock(hashtext(%s))", (self._user_list,))
+      cursor.execute(
+        sql.SQL("DELETE FROM {jobs} WHERE job = %s RETURNING run_id").format(
+          **params),
+        (job,))
+      row = cursor.fetchone()
+      if row is None:
+        conn.rollback()
+        return False
+      (run_id,) = row
+      if run_id is not None and succeeded:
+        cursor.execute(
+          sql.SQL("DELETE FROM {snapshot} WHERE user_list = %s").format(
+            **params),
+          (self._user_list,))
+        cursor.execute(
+          sql.SQL(
+            "INSERT INTO {snapshot} (user_list, member)"
+            " SELECT user_list, member FROM {staging} WHERE run_id = %s"
+          ).format(**params),
+          (run_id,))
+      if run_id is not None:
+        cursor.execute(
+          sql.SQL("DELETE FROM {staging} WHERE run_id = %s").format(**params),
+          (run_id,))
+    conn.commit()
+    return True
+
+  def close(self) -> None:
+    if self._conn is not None:
+      self._conn.close()
+      self._conn = None
+
+
 class _UserDataScrubber:
   """Util class for scrubbing user identifier data."""
 
-  def __init__(self, debug: bool = False):
+  def __init__(self, debug: bool = False, hashing: Optional[HashingUtils] = None):
     self._debug = debug
-    self._user_data = {}
-    self._utils = GoogleAdsUtils()
+    self.hashing = hashing or HashingUtils()
 
-  def scrub_user_data(self, user_data: Mapping[str, Any]) -> Mapping[str, Any]:
-    """Scrubs the user data this scrubber was created with.
+  def scrub_rows(
+      self, rows: Sequence[Mapping[str, Any]]
+  ) -> Tuple[List[Tuple[int, Mapping[str, Any]]], List[str]]:
+    """Scrubs a batch of user data, hashing its identifiers column by column.
 
     Args:
-      user_data: Dict of user data to scrub.
+      rows: Rows of user data to scrub.
 
-    Raises:
-      ValueError: Raised if any of the required mailing address fields are
-        missing.
+    Returns:
+      Index-scrubbed user data tuples for the valid rows, and an error message
+      for each row with incomplete mailing address fields.
     """
-    # Trimming dict, removing any keys with empty/whitespace string values
-    self._user_data = {k: v for k, v in user_data.items() if v and v.strip()}
-    if self._debug:
-      print(f"Scrubbing user data: {json.dumps(self._user_data, indent=4)}")
-
-    self._scrub_email()
-    self._scrub_phone_number()
-    self._scrub_mailing_name_fields()
+    indices = []
+    trimmed_rows = []
+    failures = []
+    for index, user_data in enumerate(rows):
+      # Trimming dict, removing any keys with empty/whitespace string values
+      trimmed = {k: v for k, v in user_data.items() if v and v.strip()}
+      if self._debug:
+        print(f"Scrubbing user data: {json.dumps(trimmed, indent=4)}")
+      try:
+        self._check_for_all_postal_fields(trimmed)
+      except ValueError as ve:
+        err_msg = f"Could not process data at row '{index}':  {str(ve)}"
+        print(err_msg)
+        failures.append(err_msg)
+        continue
+      indices.append(index)
+      trimmed_rows.append(trimmed)
 
+    scrubbed_rows = self.hashing.hash_columns(trimmed_rows, _HASHED_FIELDS)
     if self._debug:
-      print(f"Scrubbed user data: {json.dumps(self._user_data, indent=4)}")
-    return self._user_data
-
-  def _scrub_email(self) -> None:
-    if self._user_data.get("email", None):
-      self._user_data["email"] = self._utils.normalize_and_hash_email_address(
-        email_address=self._user_data["email"]
-      )
-
-  def _scrub_phone_number(self) -> None:
-    if self._user_data.get("phone", None):
-      self._user_data["phone"] = self._utils.normalize_and_hash(
-        self._user_data["phone"]
-      )
+      for scrubbed in scrubbed_rows:
+        print(f"Scrubbed user data: {json.dumps(scrubbed, indent=4)}")
+    return list(zip(indices, scrubbed_rows)), failures
 
-  def _scrub_mailing_name_fields(self) -> None:
-    self._check_for_all_postal_fields()
+  def scrub_user_data(self, user_data: Mapping[str, Any]) -> Mapping[str, Any]:
+    """Scrubs a single row of user data.
 
-    if self._user_data.get("first_name", None):
-      self._user_data["first_name"] = self._utils.normalize_and_hash(
-        self._user_data["first_name"]
-      )
+    Args:
+      user_data: Dict of user data to scrub.
 
-    if self._user_data.get("last_name", None):
-        self._user_data["last_name"] = self._utils.normalize_and_hash(
-          self._user_data["last_name"]
-      )
+    Raises:
+      ValueError: Raised if any of the required mailing address fields are
+        missing.
+    """
+    scrubbed_rows, failures = self.scrub_rows([user_data])
+    if failures:
+      raise ValueError(failures[0])
+    return scrubbed_rows[0][1]
 
-  def _check_for_all_postal_fields(self) -> None:
+  def _check_for_all_postal_fields(self, user_data: Mapping[str, Any]) -> None:
     required_keys = ("first_name", "last_name", "country_code", "postal_code")
     is_postal_keys_available_flags = []
     for required_key in required_keys:
-      is_postal_keys_available_flags.append(required_key in self._user_data)
+      is_postal_keys_available_flags.append(required_key in user_data)
 
     if not any(is_postal_keys_available_flags):
       if self._debug:
@@ -111,7 +444,7 @@ class _UserDataScrubber:
       return
 
     if not all(is_postal_keys_available_flags):
-      missing_keys = required_keys - self._user_data.keys()
+      missing_keys = required_keys - user_data.keys()
       if self._debug:
         print(
           "Raising exception because the following required mailing "
@@ -130,6 +463,18 @@ class Destination:
 
   Hence, not all fields specified by this destination are required,
   but at least one of them must be supplied.
+
+  In the (default) "add" sync mode every row is added to the user list. In
+  the "delta" sync mode the source is treated as the full list: its user
+  identifiers are diffed against the identifiers of the last sync (see
+  _UserListState) and only the difference is uploaded, as create and remove
+  operations of one identifier each.
+
+  The upload job of a run is polled once its operations were added, for at
+  most `job_status_timeout_seconds`; operations of a failed job are reported
+  as failed. A job still running after that is left running, and its outcome
+  is reported in the telemetry of the first run (of the same user list) that
+  finds it finished.
   """
 
   def __init__(self, config: Dict[str, Any]):
@@ -142,18 +487,49 @@ class Destination:
     self._debug = config.get("debug", False)
     self._customer_id = config.get("login_customer_id")
 
-    self._client = GoogleAdsUtils().build_google_ads_client(self._config)
-    self._offline_user_data_job_service = self._client.get_service(
+    self._utils = GoogleAdsUtils()
+    self._client = self._utils.build_google_ads_client(self._config)
+    self._cache = GoogleAdsClientCache(self._client)
+    self._scrubber = _UserDataScrubber(
+      self._debug,
+      HashingUtils(HashingUtils.modes_from_config(config, _HASHED_FIELDS)))
+    self._offline_user_data_job_service = self._cache.get_service(
       "OfflineUserDataJobService"
     )
-    self._ads_service = self._client.get_service(
+    self._ads_service = self._cache.get_service(
       "GoogleAdsService"
     )
+    job_status_timeout_seconds = config.get("job_status_timeout_seconds")
+    self._job_status_timeout_seconds = float(
+      _DEFAULT_JOB_STATUS_TIMEOUT_SECONDS if job_status_timeout_seconds is None
+      else job_status_timeout_seconds
+    )
+    # Outcomes of the jobs of previous runs, reported as telemetry.
+    self._previous_jobs = {
+      "previous_jobs_succeeded": 0,
+      "previous_jobs_failed": 0,
+      "previous_jobs_failed_operations": 0,
+    }
+    # A single job is created per run (on the first batch) and operations
+    # are added to it in chunks of _MAX_OPERATIONS_PER_REQUEST; the job is
+    # only run once every operation was added (see flush). Operations are
+    # buffered with the (operation type, member) they sync in "delta" mode.
+    self._upload_job_id = None
+    self._added_operations = 0
+    self._pending_operations = []
+    self._failed_members = []
+    self._delta = (
+      (config.get("sync_mode") or SyncModes.ADD.value) == SyncModes.DELTA.value)
+    self._state = _UserListState(
+      f"{self._customer_id}/{config['user_list_id']}", uuid.uuid4().hex)
 
   def send_data(
       self, input_data: List[Mapping[str, Any]], dry_run: bool
   ) -> Optional[RunResult]:
-    """Builds payload and sends data to Google Ads API.
+    """Builds payload and adds the operations to the run's upload job.
+
+    Operations are buffered and added to the job in full-size requests, the
+    remainder being added (and the job run) by flush.
 
     Args:
       input_data: A list of rows to send to the API endpoint.
@@ -166,17 +542,16 @@ class Destination:
       return RunResult(dry_run=dry_run, successful_hits=0, failed_hits=0)
 
     user_data_operations = []
-    failures = []
+    user_members = []
 
     print(f"Processing {len(input_data)} user records")
-    for index, user_data in enumerate(input_data):
-      try:
-        user_operation = self._build_user_data_operation_from_row(user_data)
-        user_data_operations.append(user_operation)
-      except ValueError as ve:
-        err_msg = f"Could not process data at row '{index}':  {str(ve)}"
-        print(err_msg)
-        failures.append(err_msg)
+    scrubbed_rows, failures = self._scrubber.scrub_rows(input_data)
+    for _, scrubbed_user_data in scrubbed_rows:
+      if self._delta:
+        user_members.extend(_member_keys(scrubbed_user_data))
+      else:
+        user_data_operations.append(
+          self._build_user_data_operation(scrubbed_user_data))
     print(
       f"There were '{len(failures)}' user rows that couldn't be processed.")
 
@@ -187,30 +562,207 @@ class Destination:
       print("Running as a dry run, so skipping upload steps.")
       return RunResult(
         dry_run=True,
-        successful_hits=len(user_data_operations) - len(failures),
+        successful_hits=len(scrubbed_rows),
         failed_hits=len(failures),
         error_messages=failures
       )
 
-    upload_job_id = self._create_user_upload_job()
-    add_user_data_request = self._create_add_user_data_request(
-      upload_job_id, user_data_operations
+    result = RunResult(failed_hits=len(failures), error_messages=failures)
+    if self._delta:
+      # the upload is computed (and counted) once the whole source was read
+      self._state.stage(user_members)
+      print(f"Staged members: {self._state.staged_members}")
+      return result
+
+    self._pending_operations.extend(
+      (operation, None) for operation in user_data_operations)
+    result += self._add_full_requests()
+    print(f"Buffered operations: {len(self._pending_operations)}")
+
+    return result
+
+  def flush(self, dry_run: bool) -> Optional[RunResult]:
+    """Adds the buffered operations and runs the upload job of the run.
+
+    Args:
+      dry_run: If True, will not send data to API endpoints.
+
+    Returns: A RunResult summarizing success / failures of the flushed
+      operations, and of the upload job if it finished in time.
+    """
+    result = RunResult(dry_run=dry_run)
+    if dry_run:
+      return result
+
+    try:
+      # before the diff, so that it starts from the latest snapshot
+      self._report_upload_jobs()
+      if self._delta:
+        if not self._state.staged_members:
+          # an empty source would remove every member of the list
+          print("No members were staged, so skipping the delta sync.")
+          return result
+        operation_counts = {_CREATE: 0, _REMOVE: 0}
+        for operation_type, member in self._state.diff():
+          operation = self._build_user_data_operation(
+            _member_user_data(member), remove=operation_type == _REMOVE)
+          self._pending_operations.append((operation, (operation_type, member)))
+          operation_counts[operation_type] += 1
+          result += self._add_full_requests()
+        print(
+          f"Delta sync: {operation_counts[_CREATE]} identifiers to add, "
+          f"{operation_counts[_REMOVE]} identifiers to remove.")
+
+      if self._pending_operations:
+        result += self._add_operations(self._pending_operations)
+        self._pending_operations = []
+
+      if self._failed_members:
+        # after the diff, whose cursors the commit would close
+        self._state.restage_failures(self._failed_members)
+
+      if self._upload_job_id is None:
+        print("No operations were added, so skipping the upload job run.")
+        if self._delta:
+          # the snapshot already holds the staged members
+          self._state.discard()
+        return result
+
+      self._offline_user_data_job_service.run_offline_user_data_job(
+        resource_name=self._upload_job_id
+      )
+      print(f"Running offline user data job '{self._upload_job_id}'.")
+      self._state.add_job(
+        self._upload_job_id, self._added_operations, staged=self._delta)
+      result += self._wait_for_upload_job()
+    finally:
+      self._state.close()
+
+    return result
+
+  def _report_upload_jobs(self) -> Optional[Tuple[bool, str]]:
+    """Reports the recorded upload jobs of the user list that finished.
+
+    Jobs are resolved in the order they ran, stopping at the first one still
+    running, so that delta snapshots replace each other in order too. The
+    outcomes of the jobs of previous runs are added to the telemetry.
+
+    Returns: Whether the job of this run succeeded and its failure reason,
+      or None if it was not resolved.
+    """
+    status_enum = self._client.enums.OfflineUserDataJobStatusEnum
+    for job, operations in self._state.pending_jobs():
+      status, failure_reason = self._job_status(job)
+      if status not in (None, status_enum.SUCCESS, status_enum.FAILED):
+        break
+      succeeded = status == status_enum.SUCCESS
+      if not self._state.resolve_job(job, succeeded):
+        continue
+      if job == self._upload_job_id:
+        return succeeded, failure_reason
+      if succeeded:
+        print(f"Offline user data job '{job}' of a previous run succeeded.")
+        self._previous_jobs["previous_jobs_succeeded"] += 1
+      else:
+        print(
+          f"Offline user data job '{job}' of a previous run failed: "
+          f"{failure_reason}")
+        self._previous_jobs["previous_jobs_failed"] += 1
+        self._previous_jobs["previous_jobs_failed_operations"] += operations
+    return None
+
+  def _wait_for_upload_job(self) -> RunResult:
+    """Polls the upload job of the run until it is resolved or times out.
+
+    Customer Match jobs can take hours to process, so the job is left
+    running once `job_status_timeout_seconds` elapse; a later run reports it
+    (see _report_upload_jobs).
+
+    Returns: A RunResult moving the operations of a failed job from the
+      successful to the failed hits.
+    """
+    deadline = time.monotonic() + self._job_status_timeout_seconds
+    poll_interval = _MIN_JOB_STATUS_POLL_SECONDS
+    while True:
+      outcome = self._report_upload_jobs()
+      if outcome is not None:
+        succeeded, failure_reason = outcome
+        if succeeded:
+          print(f"Offline user data job '{self._upload_job_id}' succeeded.")
+          return RunResult()
+        error_message = (
+          f"Offline user data job '{self._upload_job_id}' failed: "
+          f"{failure_reason}")
+        print(error_message)
+        return RunResult(
+          successful_hits=-self._added_operations,
+          failed_hits=self._added_operations,
+          error_messages=[error_message])
+
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        print(
+          f"Offline user data job '{self._upload_job_id}' is still running; "
+          "its outcome will be reported by a later run.")
+        return RunResult()
+      time.sleep(min(poll_interval, remaining))
+      poll_interval = min(poll_interval * 2, _MAX_JOB_STATUS_POLL_SECONDS)
+
+  def _job_status(self, job: str) -> Tuple[Optional[int], Any]:
+    """Returns the status and failure reason of an upload job.
+
+    The status is None if the job does not exist (anymore).
+    """
+    query = (
+      "SELECT offline_user_data_job.status, "
+      "offline_user_data_job.failure_reason "
+      "FROM offline_user_data_job "
+      f"WHERE offline_user_data_job.resource_name = '{job}'"
     )
+    for row in self._ads_service.search(customer_id=self._customer_id, query=query):
+      return row.offline_user_data_job.status, row.offline_user_data_job.failure_reason
+    return None, "job not found"
+
+  def _add_full_requests(self) -> RunResult:
+    """Adds the buffered operations that fill whole requests to the job."""
+    result = RunResult()
+    while len(self._pending_operations) >= _MAX_OPERATIONS_PER_REQUEST:
+      chunk = self._pending_operations[:_MAX_OPERATIONS_PER_REQUEST]
+      del self._pending_operations[:_MAX_OPERATIONS_PER_REQUEST]
+      result += self._add_operations(chunk)
+    return result
+
+  def _add_operations(
+      self, user_operations: List[Tuple[Any, Optional[Tuple[str, str]]]]
+  ) -> RunResult:
+    """Adds a chunk of operations to the upload job, creating it if needed.
+
+    Args:
+      user_operations: At most _MAX_OPERATIONS_PER_REQUEST operations, with
+        the (operation type, member) they sync in "delta" mode.
+
+    Returns: A RunResult summarizing success / failures of the operations.
+    """
+    if self._upload_job_id is None:
+      self._upload_job_id = self._create_user_upload_job()
 
+    add_user_data_request = self._create_add_user_data_request(
+      self._upload_job_id, [operation for operation, _ in user_operations]
+    )
     response = self._offline_user_data_job_service.add_offline_user_data_job_operations(
       request=add_user_data_request
     )
     response_failures = self._process_response_for_failures(response)
-    failures.append(response_failures)
-
-    self._offline_user_data_job_service.run_offline_user_data_job(
-      resource_name=upload_job_id
-    )
+    self._added_operations += len(user_operations) - len(response_failures)
+    for index in sorted({index for index, _ in response_failures}):
+      member = user_operations[index][1]
+      if member is not None:
+        self._failed_members.append(member)
 
     return RunResult(
-      successful_hits=len(user_data_operations) - len(failures),
-      failed_hits=len(failures),
-      error_messages=failures
+      successful_hits=len(user_operations) - len(response_failures),
+      failed_hits=len(response_failures),
+      error_messages=[error for _, error in response_failures]
     )
 
   def _build_user_data_operation_from_row(
@@ -225,42 +777,46 @@ class Destination:
       A Google Ads OfflineUserDataJobOperation object populated with 1-or-more
       identifiers.
     """
-    scrubber = _UserDataScrubber(self._debug)
-    scrubbed_user_data = scrubber.scrub_user_data(user_data)
+    scrubbed_user_data = self._scrubber.scrub_user_data(user_data)
+    return self._build_user_data_operation(scrubbed_user_data)
 
-    user_data_payload = self._create_user_data_payload(scrubbed_user_data)
-
-    operation = self._client.get_type("OfflineUserDataJobOperation")
-    operation.create = user_data_payload
+  def _build_user_data_operation(
+      self, user_data: Mapping[str, Any], remove: bool = False
+  ) -> Any:
+    """Builds a create (or remove) operation from scrubbed user data."""
+    operation = self._cache.get_type("OfflineUserDataJobOperation")
+    # The UserData payload is filled in place, which works for both proto-plus
+    # and raw protobuf messages (raw protobuf does not allow assigning it).
+    self._populate_user_data_payload(
+      operation.remove if remove else operation.create, user_data)
     return operation
 
-  def _create_user_data_payload(self, user_data: Mapping[str, Any]) -> Any:
+  def _populate_user_data_payload(
+      self, payload: Any, user_data: Mapping[str, Any]
+  ) -> None:
     """Populates the provided Google Ads UserData payload object.
 
     Args:
+      payload:  UserData Google Ads API payload object to populate.
       user_data:  Row of user data with various identifiers.
 
-    Returns:
-      UserData Google Ads API payload object.
-
     Raises:
       ValueError:  Raised if any of the required mailing address fields are
         not present.
     """
-    payload = self._client.get_type("UserData")
 
     if "email" in user_data:
-      user_identifier = self._client.get_type("UserIdentifier")
+      user_identifier = self._cache.get_type("UserIdentifier")
       user_identifier.hashed_email = user_data["email"]
       payload.user_identifiers.append(user_identifier)
 
     if "phone" in user_data:
-      user_identifier = self._client.get_type("UserIdentifier")
+      user_identifier = self._cache.get_type("UserIdentifier")
       user_identifier.hashed_phone_number = user_data["phone"]
       payload.user_identifiers.append(user_identifier)
 
     if "first_name" in user_data:
-      user_identifier = self._client.get_type("UserIdentifier")
+      user_identifier = self._cache.get_type("UserIdentifier")
       address_info = user_identifier.address_info
 
       address_info.hashed_first_name = user_data["first_name"]
@@ -270,8 +826,6 @@ class Destination:
 
       payload.user_identifiers.append(user_identifier)
 
-    return payload
-
   def _create_user_upload_job(self) -> str:
     """Sends a request to create a user data upload job.
 
@@ -282,7 +836,7 @@ class Destination:
       self._config["login_customer_id"],
       self._config["user_list_id"]
     )
-    offline_user_data_job = self._client.get_type("OfflineUserDataJob")
+    offline_user_data_job = self._cache.get_type("OfflineUserDataJob")
     offline_user_data_job.type_ = (
       self._client.enums.OfflineUserDataJobTypeEnum.CUSTOMER_MATCH_USER_LIST)
     offline_user_data_job.customer_match_user_list_metadata.user_list = (
@@ -307,14 +861,16 @@ class Destination:
   def _create_add_user_data_request(
       self, upload_job_id: str, user_operations: List[Any]) -> Any:
     # Create and send a request to add the operations to the job
-    request = self._client.get_type("AddOfflineUserDataJobOperationsRequest")
+    request = self._cache.get_type("AddOfflineUserDataJobOperationsRequest")
     request.resource_name = upload_job_id
-    request.operations = user_operations
+    request.operations.extend(user_operations)
     request.enable_partial_failure = True
 
     return request
 
-  def _process_response_for_failures(self, response: Any) -> Sequence[str]:
+  def _process_response_for_failures(
+      self, response: Any
+  ) -> Sequence[Tuple[int, str]]:
     """Prints and returns partial error details.
     
     Args:
@@ -322,7 +878,9 @@ class Destination:
         returned by the API call to add user operations to the job.
 
     Returns:
-      Sequence of error details, one message per failed user data operation.
+      Sequence of index-error details, one per error of a failed user data
+      operation, where the index is the position of the operation in the
+      request.
     """
     failures = []
     partial_failure_payload = getattr(response, "partial_failure_error", None)
@@ -330,18 +888,26 @@ class Destination:
     if getattr(partial_failure_payload, "code", None) != 0:
       error_details_payload = getattr(partial_failure_payload, "details", [])
       for error_detail in error_details_payload:
-        failure_message_type = self._client.get_type("GoogleAdsFailure")
-        failure_payload = type(failure_message_type).deserialize(
-          error_detail.value
+        failure_payload = self._utils.parse_google_ads_failure(
+          self._client, error_detail.value
         )
 
         for error in failure_payload.errors:
           error_message = _construct_error_message(error)
           print(error_message)
-          failures.append(error_message)
+          failures.append(
+            (error.location.field_path_elements[0].index, error_message))
 
     return failures
 
+  def telemetry(self) -> Mapping[str, Any]:
+    """Returns the hash cache counters and the previous jobs reported."""
+    return {**self._scrubber.hashing.stats(), **self._previous_jobs}
+
+  def close(self) -> None:
+    """Shuts down the hashing process pool of the run."""
+    self._scrubber.hashing.close()
+
   @staticmethod
   def schema() -> Optional[ProtocolSchema]:
     """Returns the required metadata for this destination config.
@@ -371,6 +937,19 @@ class Destination:
         ("refresh_token",
          str,
          Field(description="A Google Ads API refresh token.")),
+        ("use_raw_protobuf",
+         Optional[bool],
+         Field(
+           default=False,
+           description="Builds raw protobuf messages instead of proto-plus "
+                       "wrappers, which is much faster for large uploads.")),
+        ("job_status_timeout_seconds",
+         Optional[float],
+         Field(
+           default=_DEFAULT_JOB_STATUS_TIMEOUT_SECONDS,
+           description="How long to wait for the upload job to finish at "
+                       "the end of a run. Jobs still running are left "
+                       "running, and reported by a later run.")),
 
         # User Data List variables
         ("user_list_id",
@@ -378,6 +957,15 @@ class Destination:
          Field(
            description="ID of the user list this destination will add users "
                        "to.")),
+        ("sync_mode",
+         Optional[SyncModes],
+         Field(
+           default=SyncModes.ADD.value,
+           description="'add' adds every row to the user list. 'delta' "
+                       "treats the source as the full list and only uploads "
+                       "the user identifiers added or removed since the "
+                       "last run.")),
+        *HashingUtils.schema_fields(_HASHED_FIELDS),
       ]
     )
 
@@ -403,4 +991,4 @@ class Destination:
     Returns:
       A ValidationResult for the provided config.
     """
-    return GoogleAdsUtils().validate_google_ads_config(self._config)
+    return self._utils.validate_google_ads_config(self._config)
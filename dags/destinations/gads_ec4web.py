@@ -20,10 +20,14 @@ from collections import defaultdict
 from google.ads.googleads.errors import GoogleAdsException
 from pydantic import Field
 from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
-from utils import GoogleAdsUtils, ProtocolSchema, RunResult, ValidationResult
+from utils import (CustomerBufferMixin, GoogleAdsClientCache, GoogleAdsUtils,
+                   HashingUtils, ProtocolSchema, RunResult, ValidationResult)
 
 _BATCH_SIZE = 2000
 
+# Maximum number of operations of a single upload request
+_MAX_OPERATIONS_PER_REQUEST = 2000
+
 _REQUIRED_FIELDS = [
     "customer_id",
     "conversion_action_id",
@@ -49,12 +53,20 @@ _OTHER_FIELDS = [
     "user_agent"
 ]
 
+# Raw PII fields hashed by the destination, mapped to their normalization rule
+_RAW_PII_FIELDS = {
+    "email": HashingUtils.EMAIL,
+    "phone_number": HashingUtils.TEXT,
+    "first_name": HashingUtils.TEXT,
+    "last_name": HashingUtils.TEXT,
+}
+
 AdjustmentIndicesToAdjustments = List[Tuple[int, Any]]
 CustomerAdjustmentMap = Dict[str, AdjustmentIndicesToAdjustments]
 InvalidAdjustmentIndices = List[Tuple[int, errors.ErrorNameIDMap]]
 
 
-class Destination:
+class Destination(CustomerBufferMixin):
   """Implements DestinationProto protocol for Google Ads EC for Web."""
 
   def __init__(self, config: Dict[str, Any]):
@@ -64,9 +76,17 @@ class Destination:
       config: Configuration object to hold environment variables
     """
     self._config = config  # Keeping a reference for convenience.
-    self._client = GoogleAdsUtils().build_google_ads_client(self._config)
-    self._conversion_upload_service = self._client.get_service(
+    self._utils = GoogleAdsUtils()
+    self._client = self._utils.build_google_ads_client(self._config)
+    # Services, message classes and resource paths are reused across rows.
+    self._cache = GoogleAdsClientCache(self._client)
+    self._hashing = HashingUtils(
+      HashingUtils.modes_from_config(config, _RAW_PII_FIELDS))
+    self._conversion_upload_service = self._cache.get_service(
       "ConversionAdjustmentUploadService")
+    # Adjustments are buffered per customer across batches, so that
+    # customers are uploaded in full-size requests (see flush).
+    self._init_customer_buffer(config, _MAX_OPERATIONS_PER_REQUEST)
 
     print("Initialized Google Ads EC4W Destination class.")
 
@@ -87,28 +107,11 @@ class Destination:
     successfully_uploaded_adjustments = []
 
     if not dry_run:
-      for customer_id, adjustment_data in valid_adjustments.items():
-        adjustment_indices = [data[0] for data in adjustment_data]
-        adjustments = [data[1] for data in adjustment_data]
-
-        try:
-          partial_failures = self._send_request(customer_id, adjustments)
-        except GoogleAdsException as error:
-          # Set every index as failed
-          err_msg = error.error.code().name
-          invalid_indices_and_errors.extend([(index, err_msg) for index in adjustment_indices])
-        else:
-          # Handles partial failures: Checks which adjustments were successfully
-          # sent, and which failed.
-          partial_failure_indices = set(partial_failures.keys())
-
-          for index in range(len(adjustments)):
-            # Maps index from this customer's adjustments back to original input data index.
-            original_index = adjustment_indices[index]
-            if index in partial_failure_indices:
-              invalid_indices_and_errors.append((original_index, partial_failures[index]))
-            else:
-              successfully_uploaded_adjustments.append(original_index)
+      # failures are reported in the rows of the run, like buffered items
+      invalid_indices_and_errors = self._run_indexed(invalid_indices_and_errors)
+      successfully_uploaded_adjustments, send_failures = self._buffer_and_send(
+        valid_adjustments, len(input_data))
+      invalid_indices_and_errors.extend(send_failures)
     else:
       print(
         "Dry-Run: Events will not be sent to the API."
@@ -128,6 +131,7 @@ class Destination:
       failed_hits=len(invalid_indices_and_errors),
       error_messages=[str(error[1]) for error in invalid_indices_and_errors],
       dry_run=dry_run,
+      failed_indices=[error[0] for error in invalid_indices_and_errors],
     )
 
   def _get_valid_and_invalid_adjustments(
@@ -149,6 +153,9 @@ class Destination:
     valid_adjustments = defaultdict(list)
     invalid_indices_and_errors = []
 
+    # Raw PII columns are normalized and hashed for the whole batch at once.
+    adjustments = self._hashing.hash_columns(adjustments, _RAW_PII_FIELDS)
+
     for i, adjustment in enumerate(adjustments):
       valid = True
 
@@ -163,12 +170,11 @@ class Destination:
         continue
 
       # Builds the API adjustment payload.
-      conversion_adjustment = self._client.get_type("ConversionAdjustment")
-      conversion_action_service = self._client.get_service("ConversionActionService")
+      conversion_adjustment = self._cache.get_type("ConversionAdjustment")
 
       customer_id = adjustment.get("customer_id")
 
-      conversion_adjustment.conversion_action = conversion_action_service.conversion_action_path(
+      conversion_adjustment.conversion_action = self._cache.conversion_action_path(
         customer_id, adjustment.get("conversion_action_id", "")
       )
 
@@ -192,37 +198,32 @@ class Destination:
       # Sets the order ID if provided.
       conversion_adjustment.order_id = order_id
 
-      # Populates user_identifier fields
-      user_identifier = self._client.get_type("UserIdentifier")
+      # Populates user_identifier fields (raw PII fields were hashed above)
+      user_identifier = self._cache.get_type("UserIdentifier")
       if hashed_email:
         user_identifier.hashed_email = hashed_email
       elif email:
-        user_identifier.hashed_email = GoogleAdsUtils().normalize_and_hash_email_address(email)
+        user_identifier.hashed_email = email
       
       if hashed_phone_number:
         user_identifier.hashed_phone_number = hashed_phone_number
       elif phone_number:
-        user_identifier.hashed_phone_number = GoogleAdsUtils().normalize_and_hash(phone_number)
+        user_identifier.hashed_phone_number = phone_number
 
       # Checks if all fields required for AddressInfo are available
       if first_name or hashed_first_name:
-        address_info = self._client.get_type("OfflineUserAddressInfo")
-        if hashed_first_name:
-          address_info.hashed_first_name = hashed_first_name
-        elif first_name:
-          address_info.hashed_first_name = GoogleAdsUtils().normalize_and_hash(first_name)
-        if hashed_last_name:
-          address_info.hashed_last_name = hashed_last_name
-        elif last_name:
-          address_info.hashed_last_name = GoogleAdsUtils().normalize_and_hash(last_name)
-        if country_code:
-          address_info.country_code = country_code
-        if postal_code:
-          address_info.postal_code = postal_code
-        
-        required_attrs = ["hashed_first_name", "hashed_last_name", "country_code", "postal_code"]
-        if all([getattr(address_info, attr, False) for attr in required_attrs]):
-          user_identifier.address_info = address_info
+        address_fields = {
+          "hashed_first_name": hashed_first_name or first_name,
+          "hashed_last_name": hashed_last_name or last_name,
+          "country_code": country_code,
+          "postal_code": postal_code,
+        }
+        if all(address_fields.values()):
+          # Filled in place, which works for both proto-plus and raw protobuf
+          # messages (raw protobuf does not allow assigning sub-messages).
+          address_info = user_identifier.address_info
+          for attr, value in address_fields.items():
+            setattr(address_info, attr, value)
         else:
           print(f"Skipping addition of address_info for adjustment {i} due to missing required keys.")
 
@@ -236,12 +237,10 @@ class Destination:
         conversion_adjustment.user_agent = user_agent
 
       if gclid and conversion_date_time:
-        gclid_date_time_pair = self._client.get_type("GclidDateTimePair")
+        gclid_date_time_pair = conversion_adjustment.gclid_date_time_pair
         gclid_date_time_pair.gclid = gclid
         gclid_date_time_pair.conversion_date_time = conversion_date_time
 
-        conversion_adjustment.gclid_date_time_pair = gclid_date_time_pair
-
       conversion_adjustment.user_identifiers.append(user_identifier)
 
       valid_adjustments[customer_id].append((i, conversion_adjustment))
@@ -258,7 +257,7 @@ class Destination:
     Returns: An empty dict if no partial failures exist, or a dict of the index
       mapped to the error message.
     """
-    request = self._client.get_type("UploadConversionAdjustmentsRequest")
+    request = self._cache.get_type("UploadConversionAdjustmentsRequest")
     request.customer_id = customer_id
     request.conversion_adjustments.extend(adjustments)
     request.partial_failure = True
@@ -271,8 +270,16 @@ class Destination:
       print(f"Caught GoogleAdsException: {error}")
       raise
 
-    return GoogleAdsUtils().get_partial_failures(self._client, adjustment_upload_response)
+    return self._utils.get_partial_failures(self._client, adjustment_upload_response)
+
+
+  def telemetry(self) -> Mapping[str, Any]:
+    """Returns the hash cache counters and buffered rows of the run."""
+    return {**self._hashing.stats(), **super().telemetry()}
 
+  def close(self) -> None:
+    """Shuts down the hashing process pool of the run."""
+    self._hashing.close()
 
   @staticmethod
   def schema() -> Optional[ProtocolSchema]:
@@ -291,6 +298,9 @@ class Destination:
         ("developer_token", str, Field(description="A Google Ads Developer Token.")),
         ("login_customer_id", str, Field(description="A Google Ads Login Customer ID (without hyphens).")),
         ("refresh_token", str, Field(description="A Google Ads API refresh token.")),
+        ("use_raw_protobuf", Optional[bool], Field(default=False, description="Builds raw protobuf messages instead of proto-plus wrappers, which is much faster for large uploads.")),
+        *CustomerBufferMixin.schema_fields(),
+        *HashingUtils.schema_fields(_RAW_PII_FIELDS),
       ]
     )
 
@@ -316,5 +326,5 @@ class Destination:
     Returns:
       A ValidationResult for the provided config.
     """
-    return GoogleAdsUtils().validate_google_ads_config(self._config)
+    return self._utils.validate_google_ads_config(self._config)
 
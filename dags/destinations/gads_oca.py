@@ -20,10 +20,14 @@ from collections import defaultdict
 from google.ads.googleads.errors import GoogleAdsException
 from pydantic import Field
 from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
-from utils import GoogleAdsUtils, ProtocolSchema, RunResult, ValidationResult
+from utils import (CustomerBufferMixin, GoogleAdsClientCache, GoogleAdsUtils,
+                   ProtocolSchema, RunResult, ValidationResult)
 
 _BATCH_SIZE = 2000
 
+# Maximum number of operations of a single upload request
+_MAX_OPERATIONS_PER_REQUEST = 2000
+
 _DEFAULT_CURRENCY_CODE = "USD"
 
 _REQUIRED_FIELDS = [
@@ -45,7 +49,7 @@ CustomerAdjustmentMap = Dict[str, AdjustmentIndicesToAdjustments]
 InvalidAdjustmentIndices = List[Tuple[int, errors.ErrorNameIDMap]]
 
 
-class Destination:
+class Destination(CustomerBufferMixin):
   """Implements DestinationProto protocol for Google Ads Conversion Adjustments."""
 
   def __init__(self, config: Dict[str, Any]):
@@ -55,9 +59,15 @@ class Destination:
       config: Configuration object to hold environment variables
     """
     self._config = config  # Keeping a reference for convenience.
-    self._client = GoogleAdsUtils().build_google_ads_client(self._config)
-    self._conversion_upload_service = self._client.get_service(
+    self._utils = GoogleAdsUtils()
+    self._client = self._utils.build_google_ads_client(self._config)
+    # Services, message classes and resource paths are reused across rows.
+    self._cache = GoogleAdsClientCache(self._client)
+    self._conversion_upload_service = self._cache.get_service(
       "ConversionAdjustmentUploadService")
+    # Adjustments are buffered per customer across batches, so that
+    # customers are uploaded in full-size requests (see flush).
+    self._init_customer_buffer(config, _MAX_OPERATIONS_PER_REQUEST)
 
     print("Initialized Google Ads OCA Destination class.")
 
@@ -78,28 +88,11 @@ class Destination:
     successfully_uploaded_adjustments = []
 
     if not dry_run:
-      for customer_id, adjustment_data in valid_adjustments.items():
-        adjustment_indices = [data[0] for data in adjustment_data]
-        adjustments = [data[1] for data in adjustment_data]
-
-        try:
-          partial_failures = self._send_request(customer_id, adjustments)
-        except GoogleAdsException as error:
-          # Set every index as failed
-          err_msg = error.error.code().name
-          invalid_indices_and_errors.extend([(index, err_msg) for index in adjustment_indices])
-        else:
-          # Handles partial failures: Checks which adjustments were successfully
-          # sent, and which failed.
-          partial_failure_indices = set(partial_failures.keys())
-
-          for index in range(len(adjustments)):
-            # Maps index from this customer's adjustments back to original input data index.
-            original_index = adjustment_indices[index]
-            if index in partial_failure_indices:
-              invalid_indices_and_errors.append((original_index, partial_failures[index]))
-            else:
-              successfully_uploaded_adjustments.append(original_index)
+      # failures are reported in the rows of the run, like buffered items
+      invalid_indices_and_errors = self._run_indexed(invalid_indices_and_errors)
+      successfully_uploaded_adjustments, send_failures = self._buffer_and_send(
+        valid_adjustments, len(input_data))
+      invalid_indices_and_errors.extend(send_failures)
     else:
       print(
         "Dry-Run: Events will not be sent to the API."
@@ -119,6 +112,7 @@ class Destination:
       failed_hits=len(invalid_indices_and_errors),
       error_messages=[str(error[1]) for error in invalid_indices_and_errors],
       dry_run=dry_run,
+      failed_indices=[error[0] for error in invalid_indices_and_errors],
     )
 
   def _get_valid_and_invalid_adjustments(
@@ -154,12 +148,11 @@ class Destination:
         continue
 
       # Builds the API adjustment payload.
-      conversion_adjustment = self._client.get_type("ConversionAdjustment")
-      conversion_action_service = self._client.get_service("ConversionActionService")
+      conversion_adjustment = self._cache.get_type("ConversionAdjustment")
 
       customer_id = adjustment.get("customer_id")
 
-      conversion_adjustment.conversion_action = conversion_action_service.conversion_action_path(
+      conversion_adjustment.conversion_action = self._cache.conversion_action_path(
         customer_id, adjustment.get("conversion_action_id", "")
       )
 
@@ -171,7 +164,6 @@ class Destination:
       adjustment_date_time = adjustment.get("adjustment_date_time", "")
       
       # Make sure that "falsy" values still default to _DEFAULT_CURRENCY_CODE
-      restatement_value = self._client.get_type("RestatementValue")
       adjusted_value = float(adjustment.get("adjusted_value", ""))
       currency_code = adjustment.get("currency_code", False) or _DEFAULT_CURRENCY_CODE
 
@@ -180,19 +172,17 @@ class Destination:
         conversion_adjustment.order_id = order_id
 
       # Specifies optional fields
+      # Sub-messages are filled in place, which works for both proto-plus and
+      # raw protobuf messages (raw protobuf does not allow assigning them).
       if gclid and conversion_date_time:
-        gclid_date_time_pair = self._client.get_type("GclidDateTimePair")
+        gclid_date_time_pair = conversion_adjustment.gclid_date_time_pair
         gclid_date_time_pair.gclid = gclid
         gclid_date_time_pair.conversion_date_time = conversion_date_time
 
-        conversion_adjustment.gclid_date_time_pair = gclid_date_time_pair
-
-
-      restatement_value = self._client.get_type("RestatementValue")
+      restatement_value = conversion_adjustment.restatement_value
       restatement_value.adjusted_value = adjusted_value
       restatement_value.currency_code = currency_code
 
-      conversion_adjustment.restatement_value = restatement_value
       conversion_adjustment.adjustment_date_time = adjustment_date_time
 
 
@@ -210,7 +200,7 @@ class Destination:
     Returns: An empty dict if no partial failures exist, or a dict of the index
       mapped to the error message.
     """
-    request = self._client.get_type("UploadConversionAdjustmentsRequest")
+    request = self._cache.get_type("UploadConversionAdjustmentsRequest")
     request.customer_id = customer_id
     request.conversion_adjustments.extend(adjustments)
     request.partial_failure = True
@@ -223,7 +213,7 @@ class Destination:
       print(f"Caught GoogleAdsException: {error}")
       raise
 
-    return GoogleAdsUtils().get_partial_failures(self._client, adjustment_upload_response)
+    return self._utils.get_partial_failures(self._client, adjustment_upload_response)
 
 
   @staticmethod
@@ -243,6 +233,8 @@ class Destination:
         ("developer_token", str, Field(description="A Google Ads Developer Token.")),
         ("login_customer_id", str, Field(description="A Google Ads Login Customer ID (without hyphens).")),
         ("refresh_token", str, Field(description="A Google Ads API refresh token.")),
+        ("use_raw_protobuf", Optional[bool], Field(default=False, description="Builds raw protobuf messages instead of proto-plus wrappers, which is much faster for large uploads.")),
+        *CustomerBufferMixin.schema_fields(),
       ]
     )
 
@@ -268,5 +260,5 @@ class Destination:
     Returns:
       A ValidationResult for the provided config.
     """
-    return GoogleAdsUtils().validate_google_ads_config(self._config)
+    return self._utils.validate_google_ads_config(self._config)
 
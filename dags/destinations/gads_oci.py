@@ -20,10 +20,14 @@ from collections import defaultdict
 from google.ads.googleads.errors import GoogleAdsException
 from pydantic import Field
 from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
-from utils import GoogleAdsUtils, ProtocolSchema, RunResult, ValidationResult
+from utils import (CustomerBufferMixin, GoogleAdsClientCache, GoogleAdsUtils,
+                   ProtocolSchema, RunResult, ValidationResult)
 
 _BATCH_SIZE = 2000
 
+# Maximum number of operations of a single upload request
+_MAX_OPERATIONS_PER_REQUEST = 2000
+
 _DEFAULT_CURRENCY_CODE = "USD"
 
 _REQUIRED_FIELDS = [
@@ -50,7 +54,7 @@ CustomerConversionMap = Dict[str, ConversionIndicesToConversions]
 InvalidConversionIndices = List[Tuple[int, errors.ErrorNameIDMap]]
 
 
-class Destination:
+class Destination(CustomerBufferMixin):
   """Implements DestinationProto protocol for Google Ads OCI."""
 
   def __init__(self, config: Dict[str, Any]):
@@ -60,9 +64,15 @@ class Destination:
       config: Configuration object to hold environment variables
     """
     self._config = config  # Keeping a reference for convenience.
-    self._client = GoogleAdsUtils().build_google_ads_client(self._config)
-    self._conversion_upload_service = self._client.get_service(
+    self._utils = GoogleAdsUtils()
+    self._client = self._utils.build_google_ads_client(self._config)
+    # Services, message classes and resource paths are reused across rows.
+    self._cache = GoogleAdsClientCache(self._client)
+    self._conversion_upload_service = self._cache.get_service(
       "ConversionUploadService")
+    # Conversions are buffered per customer across batches, so that
+    # customers are uploaded in full-size requests (see flush).
+    self._init_customer_buffer(config, _MAX_OPERATIONS_PER_REQUEST)
     self._debug = config.get("debug", False)
 
     print("Initialized Google Ads OCI Destination class.")
@@ -84,28 +94,11 @@ class Destination:
     successfully_uploaded_conversions = []
 
     if not dry_run:
-      for customer_id, conversion_data in valid_conversions.items():
-        conversion_indices = [data[0] for data in conversion_data]
-        conversions = [data[1] for data in conversion_data]
-
-        try:
-          partial_failures = self._send_request(customer_id, conversions)
-        except GoogleAdsException as error:
-          # Set every index as failed
-          err_msg = error.error.code().name
-          invalid_indices_and_errors.extend([(index, err_msg) for index in conversion_indices])
-        else:
-          # Handles partial failures: Checks which conversions were successfully
-          # sent, and which failed.
-          partial_failure_indices = set(partial_failures.keys())
-
-          for index in range(len(conversions)):
-            # Maps index from this customer's conversions back to original input data index.
-            original_index = conversion_indices[index]
-            if index in partial_failure_indices:
-              invalid_indices_and_errors.append((original_index, partial_failures[index]))
-            else:
-              successfully_uploaded_conversions.append(original_index)
+      # failures are reported in the rows of the run, like buffered items
+      invalid_indices_and_errors = self._run_indexed(invalid_indices_and_errors)
+      successfully_uploaded_conversions, send_failures = self._buffer_and_send(
+        valid_conversions, len(input_data))
+      invalid_indices_and_errors.extend(send_failures)
     else:
       print(
         "Dry-Run: Events will not be sent to the API."
@@ -125,6 +118,7 @@ class Destination:
       failed_hits=len(invalid_indices_and_errors),
       error_messages=[str(error[1]) for error in invalid_indices_and_errors],
       dry_run=dry_run,
+      failed_indices=[error[0] for error in invalid_indices_and_errors],
     )
 
   def _get_valid_and_invalid_conversions(
@@ -168,12 +162,11 @@ class Destination:
         continue
 
       # Builds the API click payload.
-      click_conversion = self._client.get_type("ClickConversion")
-      conversion_action_service = self._client.get_service("ConversionActionService")
+      click_conversion = self._cache.get_type("ClickConversion")
 
       customer_id = conversion.get("customer_id")
 
-      click_conversion.conversion_action = conversion_action_service.conversion_action_path(
+      click_conversion.conversion_action = self._cache.conversion_action_path(
         customer_id, conversion.get("conversion_action_id", "")
       )
 
@@ -199,8 +192,8 @@ class Destination:
 
       # Adds custom variable ID and value if set.
       if conversion_custom_variable_id and conversion_custom_variable_value:
-        conversion_custom_variable = self._client.get_type("CustomVariable")
-        conversion_custom_variable.conversion_custom_variable = self._conversion_upload_service.conversion_custom_variable_path(
+        conversion_custom_variable = self._cache.get_type("CustomVariable")
+        conversion_custom_variable.conversion_custom_variable = self._cache.conversion_custom_variable_path(
           customer_id, conversion_custom_variable_id
         )
         conversion_custom_variable.value = conversion_custom_variable_value
@@ -220,7 +213,7 @@ class Destination:
     Returns: An empty dict if no partial failures exist, or a dict of the index
       mapped to the error message.
     """
-    request = self._client.get_type("UploadClickConversionsRequest")
+    request = self._cache.get_type("UploadClickConversionsRequest")
     request.customer_id = customer_id
     request.conversions.extend(conversions)
     request.partial_failure = True
@@ -233,7 +226,7 @@ class Destination:
       print(f"Caught GoogleAdsException: {error}")
       raise
 
-    return GoogleAdsUtils().get_partial_failures(self._client, conversion_upload_response)
+    return self._utils.get_partial_failures(self._client, conversion_upload_response)
 
 
   @staticmethod
@@ -253,6 +246,8 @@ class Destination:
         ("developer_token", str, Field(description="A Google Ads Developer Token.")),
         ("login_customer_id", str, Field(description="A Google Ads Login Customer ID (without hyphens).")),
         ("refresh_token", str, Field(description="A Google Ads API refresh token.")),
+        ("use_raw_protobuf", Optional[bool], Field(default=False, description="Builds raw protobuf messages instead of proto-plus wrappers, which is much faster for large uploads.")),
+        *CustomerBufferMixin.schema_fields(),
       ]
     )
 
@@ -278,4 +273,4 @@ class Destination:
     Returns:
       A ValidationResult for the provided config.
     """
-    return GoogleAdsUtils().validate_google_ads_config(self._config)
+    return self._utils.validate_google_ads_config(self._config)
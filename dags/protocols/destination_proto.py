@@ -22,7 +22,18 @@ from utils import ProtocolSchema, RunResult, ValidationResult
 
 @runtime_checkable
 class DestinationProto(Protocol):
-  """Common set of methods that must be implemented by all destinations."""
+  """Common set of methods that must be implemented by all destinations.
+
+  Destinations that buffer rows across batches may also implement an
+  optional `flush(dry_run) -> Optional[RunResult]` method, called once at the
+  end of a run to send whatever is still buffered.
+
+  Destinations may also implement an optional `telemetry() -> Mapping[str,
+  Any]` method, whose counters are published with the progress of the run.
+  Destinations holding resources beyond a run (e.g. process pools) may
+  implement an optional `close()` method, called at the end of every run,
+  including failed ones.
+  """
 
   def __init__(self, config: Dict[str, Any]):
     """Init method for DestinationProto.
@@ -17,12 +17,21 @@
 from typing import (Any, Dict, List, Mapping, Optional, Protocol, Sequence,
                     runtime_checkable)
 
-from utils import ProtocolSchema, ValidationResult
+from utils import ProtocolSchema, QueryOptions, ValidationResult
 
 
 @runtime_checkable
 class SourceProto(Protocol):
-  """Common set of methods that must be implemented by all sources."""
+  """Common set of methods that must be implemented by all sources.
+
+  Sources that consume from a queue may also implement an optional
+  `acknowledge(run_result)` method, called with the RunResult of each batch
+  handled by the destination of a non dry-run (or, for destinations that
+  flush, of the whole run), so that failed entries (see
+  RunResult.failed_indices) can be left unacknowledged. Sources holding
+  connections or cursors may implement an optional `close()` method, called
+  at the end of every run, including failed ones.
+  """
 
   def __init__(self, config: Dict[str, Any]):
     """Init method for SourceProto.
@@ -39,6 +48,7 @@ class SourceProto(Protocol):
       offset: int,
       limit: int,
       reusable_credentials: Optional[Sequence[Mapping[str, Any]]],
+      query_options: Optional[QueryOptions],
   ) -> List[Mapping[str, Any]]:
     """Retrieves data from the target source.
     
@@ -49,11 +59,26 @@ class SourceProto(Protocol):
       limit: The maximum number of records to return.
       reusable_credentials: An auxiliary list of reusable credentials
         that may be shared by multiple sources.
+      query_options: Optional connection-level field mappings and row
+        filters, to be compiled into the underlying source query.
     Returns:
       A list of field-value mappings retrieved from the target data source.
     """
     ...
 
+  def estimate_total_rows(
+      self, query_options: Optional[QueryOptions]
+  ) -> Optional[int]:
+    """Estimates the number of rows a run will read, for progress reporting.
+
+    Args:
+      query_options: Optional connection-level field mappings and row
+        filters that will be used by get_data.
+    Returns:
+      An estimated row count, or None when no cheap estimate is available.
+    """
+    ...
+
   @staticmethod
   def schema() -> Optional[ProtocolSchema]:
     """Returns the required metadata for this source config.
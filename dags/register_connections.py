@@ -31,7 +31,7 @@ from airflow.models import Variable
 from airflow.operators.python_operator import PythonOperator
 from protocols.destination_proto import DestinationProto
 from protocols.source_proto import SourceProto
-from utils import RunResult
+from utils import ProgressTracker, QueryOptions, RunResult
 
 
 class DAGBuilder:
@@ -107,6 +107,10 @@ class DAGBuilder:
 
     start_date = datetime.datetime(2023, 1, 1, 0, 0, 0)
 
+    # parsed at registration time so malformed options are reported as
+    # registration errors
+    query_options = QueryOptions.from_connection(connection)
+
     @dag(
         dag_id=connection_id,
         is_paused_upon_creation=False,
@@ -124,15 +128,55 @@ class DAGBuilder:
             target_source.get_data,
             fields=fields,
             limit=batch_size,
-            reusable_credentials=reusable_credentials
+            reusable_credentials=reusable_credentials,
+            query_options=query_options,
         )
-        data = get_data(offset=offset)
-        run_result = RunResult(0, 0, [], dry_run)
-        while data:
-          run_result += target_destination.send_data(data, dry_run)
-          offset += batch_size
+        # sources that consume from a queue (e.g. redis_stream) only
+        # acknowledge entries once the destination sent them successfully
+        acknowledge = getattr(target_source, "acknowledge", None)
+        # destinations that buffer rows across batches send what is left at
+        # the end of the run, so acknowledgements wait for the flush
+        flush = getattr(target_destination, "flush", None)
+        telemetry = getattr(target_destination, "telemetry", None)
+        # sources holding connections or cursors (and destinations holding
+        # process pools) release them, even when the run fails
+        close_source = getattr(target_source, "close", None)
+        close_destination = getattr(target_destination, "close", None)
+        try:
+          try:
+            total_rows = target_source.estimate_total_rows(query_options)
+          except Exception:  # pylint: disable=broad-except
+            print(f"Row estimate error: {traceback.format_exc()}")
+            total_rows = None
+          progress_tracker = ProgressTracker(
+              publish=lambda progress: task_instance.xcom_push(
+                  "run_progress", asdict(progress)
+              ),
+              total_rows=total_rows,
+          )
           data = get_data(offset=offset)
-
+          run_result = RunResult(0, 0, [], dry_run)
+          while data:
+            batch_result = target_destination.send_data(data, dry_run)
+            run_result += batch_result
+            if acknowledge and not dry_run and not flush:
+              acknowledge(batch_result)
+            progress_tracker.update(
+                len(data), telemetry() if telemetry else None
+            )
+            offset += batch_size
+            data = get_data(offset=offset)
+
+          if flush:
+            run_result += flush(dry_run)
+            if acknowledge and not dry_run:
+              acknowledge(run_result)
+          progress_tracker.finish(telemetry() if telemetry else None)
+        finally:
+          if close_source:
+            close_source()
+          if close_destination:
+            close_destination()
         task_instance.xcom_push("run_result", asdict(run_result))
 
       PythonOperator(
@@ -16,13 +16,20 @@
 
 import json
 import tempfile
-from typing import Any, Dict, List, Mapping, Optional, Sequence
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
 from google.auth.exceptions import RefreshError
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
 from pydantic import Field
-from utils import ProtocolSchema, SchemaUtils, ValidationResult
+from utils import ProtocolSchema, QueryOptions, SchemaUtils, ValidationResult
+
+_QUERY_PARAMETER_TYPES = (
+    (bool, "BOOL"),
+    (int, "INT64"),
+    (float, "FLOAT64"),
+    (str, "STRING"),
+)
 
 
 class Source:
@@ -47,6 +54,48 @@ class Source:
     else:
       self.client = bigquery.Client()
     self.location = f"{config.get('dataset')}.{config.get('table')}"
+    self._table_columns = None
+
+  def _get_table_columns(self) -> Sequence[str]:
+    if self._table_columns is None:
+      table = self.client.get_table(self.location)
+      self._table_columns = [f.name for f in table.schema]
+    return self._table_columns
+
+  @staticmethod
+  def _query_parameter(name: str, value: Any) -> bigquery.ScalarQueryParameter:
+    for python_type, parameter_type in _QUERY_PARAMETER_TYPES:
+      if isinstance(value, python_type):
+        return bigquery.ScalarQueryParameter(name, parameter_type, value)
+    return bigquery.ScalarQueryParameter(name, "STRING", str(value))
+
+  def _build_query(
+      self, fields: Sequence[str], offset: int, limit: int,
+      query_options: QueryOptions
+  ) -> Tuple[str, List[bigquery.ScalarQueryParameter]]:
+    table_columns = self._get_table_columns()
+    # only project fields whose source column exists, as BigQuery rejects
+    # unknown columns
+    selected_fields = [
+        f for f in fields if query_options.source_column(f) in table_columns
+    ]
+    quote = lambda name: f"`{name}`"
+    select_list = query_options.build_select_list(selected_fields, quote, quote)
+
+    parameters = []
+    def literal(value: Any) -> str:
+      name = f"p{len(parameters)}"
+      parameters.append(self._query_parameter(name, value))
+      return f"@{name}"
+    where_clause = query_options.build_where_clause(quote, literal)
+
+    query = (
+        f"SELECT {select_list or '*'}"
+        f" FROM `{self.location}`"
+        f"{f' WHERE {where_clause}' if where_clause else ''}"
+        f" LIMIT {limit} OFFSET {offset}"
+    )
+    return query, parameters
 
   def get_data(
       self,
@@ -54,14 +103,14 @@ class Source:
       offset: int,
       limit: int,
       reusable_credentials: Optional[Sequence[Mapping[str, Any]]],
+      query_options: Optional[QueryOptions],
   ) -> List[Mapping[str, Any]]:
     """get_data implemention for BigQuery source."""
-    query = (
-        f"SELECT *"
-        f" FROM `{self.location}`"
-        f" LIMIT {limit} OFFSET {offset}"
+    query, parameters = self._build_query(
+        fields, offset, limit, query_options or QueryOptions()
     )
-    query_job = self.client.query(query)
+    job_config = bigquery.QueryJobConfig(query_parameters=parameters)
+    query_job = self.client.query(query, job_config=job_config)
 
     rows = []
     for element in query_job.result():
@@ -74,6 +123,14 @@ class Source:
 
     return rows
 
+  def estimate_total_rows(
+      self, query_options: Optional[QueryOptions]
+  ) -> Optional[int]:
+    if query_options and query_options.filters:
+      # table metadata cannot account for filters
+      return None
+    return self.client.get_table(self.location).num_rows
+
   @staticmethod
   def schema() -> Optional[ProtocolSchema]:
     return ProtocolSchema(
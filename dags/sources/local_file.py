@@ -14,20 +14,163 @@
  limitations under the License.
  """
 
-from typing import Any, Dict, List, Mapping, Optional, Sequence
+import collections
+import hashlib
+from concurrent import futures
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
+from airflow.models import Variable
 from pydantic import Field
-from utils import DrillMixin, ProtocolSchema, ValidationResult
+from utils import (DrillMixin, ProtocolSchema, QueryOptions, RunResult,
+                   ValidationResult)
+
+_DEFAULT_MAX_PARALLEL_FILES = 4
+_CHECKPOINTS_VARIABLE_PREFIX = "local_file_checkpoints_"
+
+
+class _PartitionReader:
+  """Reads the part files of a directory in parallel.
+
+  Each file is paged independently (sequentially within the file, in
+  parallel across files) and keeps its own row checkpoint, so the OFFSET
+  scans stay local to a single part file. Rows are handed out in batches of
+  the requested size, in completion order.
+
+  Checkpoints count the rows of each file handed out and acknowledged (i.e.
+  handled by the destination), so a failed run can resume from them.
+  """
+
+  def __init__(
+      self,
+      source: DrillMixin,
+      paths: Sequence[str],
+      fields: Sequence[str],
+      query_options: Optional[QueryOptions],
+      page_size: int,
+      max_workers: int,
+      checkpoints: Optional[Mapping[str, Any]] = None,
+  ):
+    self._source = source
+    self._fields = fields
+    self._query_options = query_options
+    self._page_size = page_size
+    self._max_workers = max_workers
+    checkpoints = checkpoints or {}
+    self.completed_paths = [
+        path for path in checkpoints.get("completed", []) if path in paths
+    ]
+    self._read_rows = {
+        path: checkpoints.get("rows", {}).get(path, 0) for path in paths
+    }
+    self._handed_out_rows = dict(self._read_rows)
+    self._acknowledged_rows = dict(self._read_rows)
+    self._read_paths = set(self.completed_paths)
+    self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    self._pending_paths = collections.deque(
+        path for path in paths if path not in self._read_paths
+    )
+    self._in_flight = {}
+    self._buffer: collections.deque[Tuple[str, Mapping[str, Any]]] = (
+        collections.deque()
+    )
+    self._schedule_pending()
+
+  def _read_page(self, path: str, offset: int) -> List[Mapping[str, Any]]:
+    rows = self._source.get_drill_data(
+        path, self._fields, offset, self._page_size, self._query_options
+    )
+    # get_drill_data returns no rows when the query fails, so an empty page
+    # is only taken as the end of a file that can be read
+    if not rows and not self._source.validate_drill(path).is_valid:
+      raise RuntimeError(f"Cannot read {path} from row {offset}.")
+    return rows
+
+  def _schedule(self, path: str) -> None:
+    future = self._executor.submit(
+        self._read_page, path, self._read_rows[path]
+    )
+    self._in_flight[future] = path
+
+  def _schedule_pending(self) -> None:
+    while self._pending_paths and len(self._in_flight) < self._max_workers:
+      self._schedule(self._pending_paths.popleft())
+
+  def read(self, limit: int) -> List[Mapping[str, Any]]:
+    try:
+      while len(self._buffer) < limit and self._in_flight:
+        done, _ = futures.wait(
+            self._in_flight, return_when=futures.FIRST_COMPLETED
+        )
+        for future in done:
+          path = self._in_flight.pop(future)
+          rows = future.result()
+          self._buffer.extend((path, row) for row in rows)
+          self._read_rows[path] += len(rows)
+          if len(rows) == self._page_size:
+            self._schedule(path)
+          else:
+            self._read_paths.add(path)
+            print(f"Finished reading {path} ({self._read_rows[path]} rows).")
+        self._schedule_pending()
+    except BaseException:
+      self.close()
+      raise
+
+    if not self._in_flight:
+      self.close()
+
+    rows = []
+    for _ in range(min(limit, len(self._buffer))):
+      path, row = self._buffer.popleft()
+      self._handed_out_rows[path] += 1
+      rows.append(row)
+    return rows
+
+  def acknowledge(self) -> None:
+    """Advances the checkpoints past the rows handed out so far."""
+    self._acknowledged_rows = dict(self._handed_out_rows)
+    buffered_paths = {path for path, _ in self._buffer}
+    self.completed_paths = sorted(self._read_paths - buffered_paths)
+
+  def checkpoints(self) -> Dict[str, Any]:
+    return {
+        "rows": self._acknowledged_rows,
+        "completed": self.completed_paths,
+    }
+
+  @property
+  def finished(self) -> bool:
+    return (not self._in_flight and not self._pending_paths
+            and not self._buffer)
+
+  def close(self) -> None:
+    """Stops reading, dropping the pages not started yet."""
+    self._executor.shutdown(wait=False, cancel_futures=True)
 
 
 class Source(DrillMixin):
-  """Implements SourceProto protocol for Drill Local Files."""
+  """Implements SourceProto protocol for Drill Local Files.
+
+  When `location` is a directory with several part files, the files are read
+  in parallel (see _PartitionReader) instead of one OFFSET scan over the
+  whole directory. Their checkpoints are kept in an Airflow Variable until
+  every file was read, so a failed run resumes the files where it stopped.
+  """
 
   def __init__(self, config: Dict[str, Any]):
     self.config = config
     self.location = self.config["location"]
     self.conn_name = "dfs"
     self.path = f"{self.conn_name}.`data/{self.location}`"
+    self.max_parallel_files = int(
+        self.config.get("max_parallel_files") or _DEFAULT_MAX_PARALLEL_FILES
+    )
+    self._partition_reader = None
+    self._checkpoints_variable = None
+
+  def _file_path(self, file_name: str) -> str:
+    location = self.location.rstrip("/")
+    return f"{self.conn_name}.`data/{location}/{file_name}`"
 
   def get_data(
       self,
@@ -35,8 +178,70 @@ class Source(DrillMixin):
       offset: int,
       limit: int,
       reusable_credentials: Optional[Sequence[Mapping[str, Any]]],
+      query_options: Optional[QueryOptions],
   ) -> List[Mapping[str, Any]]:
-    return self.get_drill_data(self.path, fields, offset, limit)
+    if offset == 0:
+      self.close()
+      self._partition_reader = None
+      file_names = self.list_drill_files(self.path)
+      if len(file_names) > 1 and self.max_parallel_files > 1:
+        print(f"Reading {len(file_names)} part files from {self.path}.")
+        # the same files may be read by connections with other fields
+        run_key = hashlib.sha256(
+            f"{self.location}|{list(fields)}|{query_options!r}".encode()
+        ).hexdigest()
+        self._checkpoints_variable = f"{_CHECKPOINTS_VARIABLE_PREFIX}{run_key}"
+        checkpoints = Variable.get(
+            self._checkpoints_variable, default_var=None, deserialize_json=True
+        )
+        if checkpoints:
+          print(f"Resuming from the checkpoints of a failed run: {checkpoints}")
+        self._partition_reader = _PartitionReader(
+            self,
+            [self._file_path(name) for name in file_names],
+            fields,
+            query_options,
+            limit,
+            self.max_parallel_files,
+            checkpoints,
+        )
+    if self._partition_reader:
+      return self._partition_reader.read(limit)
+    return self.get_drill_data(self.path, fields, offset, limit, query_options)
+
+  def acknowledge(self, run_result: RunResult) -> None:
+    """Persists the file checkpoints once the destination handled the rows."""
+    del run_result  # rows of files are not read again, even when they failed
+    if not self._partition_reader:
+      return
+    self._partition_reader.acknowledge()
+    if self._partition_reader.finished:
+      Variable.delete(self._checkpoints_variable)
+    else:
+      Variable.set(
+          self._checkpoints_variable,
+          self._partition_reader.checkpoints(),
+          serialize_json=True,
+      )
+
+  def close(self) -> None:
+    if self._partition_reader:
+      self._partition_reader.close()
+
+  def estimate_total_rows(
+      self, query_options: Optional[QueryOptions]
+  ) -> Optional[int]:
+    """Counts rows from Parquet metadata, the only count that needs no scan.
+
+    Other formats (and filtered reads) would be scanned twice, once to be
+    counted and once to be read, so no estimate is returned for them.
+    """
+    if query_options and query_options.filters:
+      return None
+    file_names = self.list_drill_files(self.path) or [self.location]
+    if not all(name.endswith(".parquet") for name in file_names):
+      return None
+    return self.count_drill_rows(self.path)
 
   @staticmethod
   def schema() -> Optional[ProtocolSchema]:
@@ -44,7 +249,10 @@ class Source(DrillMixin):
         "local_file",
         [
             ("location", str, Field(
-                description="The path to your local file, relative to the container 'data' folder."))
+                description="The path to your local file, relative to the container 'data' folder. Directories of part files are read in parallel.")),
+            ("max_parallel_files", Optional[int], Field(
+                default=_DEFAULT_MAX_PARALLEL_FILES,
+                description="Maximum number of part files read concurrently when the location is a directory.")),
         ]
     )
 
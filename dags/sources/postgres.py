@@ -0,0 +1,242 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+import threading
+import uuid
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+import psycopg2
+from psycopg2 import pool, sql
+from pydantic import Field
+from utils import ProtocolSchema, QueryOptions, ValidationResult
+
+_DEFAULT_HOST = "postgres"
+_DEFAULT_PORT = 5432
+_DEFAULT_SCHEMA_NAME = "public"
+
+_MIN_POOL_CONNECTIONS = 1
+_MAX_POOL_CONNECTIONS = 4
+
+# Number of rows transferred per network round trip by the server-side cursor.
+_CURSOR_ITERSIZE = 5000
+
+# Connection pools are shared by every Source instance living in the same
+# worker process (keyed by DSN), so consecutive batches and connections that
+# read from the same database reuse established connections.
+_POOLS: Dict[str, pool.ThreadedConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _get_pool(dsn: str) -> pool.ThreadedConnectionPool:
+  with _POOLS_LOCK:
+    if dsn not in _POOLS:
+      _POOLS[dsn] = pool.ThreadedConnectionPool(
+          _MIN_POOL_CONNECTIONS, _MAX_POOL_CONNECTIONS, dsn=dsn
+      )
+    return _POOLS[dsn]
+
+
+class Source:
+  """Implements SourceProto protocol for Postgres.
+
+  Rows are streamed through a named (server-side) cursor that is kept open
+  across consecutive get_data calls, so each batch is a single FETCH on an
+  already running query instead of a new LIMIT/OFFSET scan.
+  """
+
+  def __init__(self, config: Dict[str, Any]):
+    self.config = config
+    self.table_schema = config.get("schema_name") or _DEFAULT_SCHEMA_NAME
+    self.table = config["table"]
+    self.dsn = psycopg2.extensions.make_dsn(
+        host=config.get("host") or _DEFAULT_HOST,
+        port=config.get("port") or _DEFAULT_PORT,
+        dbname=config.get("database"),
+        user=config.get("user"),
+        password=config.get("password"),
+    )
+    self._table_columns = None
+    self._conn = None
+    self._cursor = None
+    self._columns = []
+    self._position = 0
+    self._exhausted = False
+
+  def _get_table_columns(self, conn) -> Sequence[str]:
+    if self._table_columns is None:
+      with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns"
+            " WHERE table_schema = %s AND table_name = %s",
+            (self.table_schema, self.table),
+        )
+        self._table_columns = [row[0] for row in cursor.fetchall()]
+    return self._table_columns
+
+  def _build_query(
+      self, conn, columns: Sequence[str], query_options: QueryOptions
+  ) -> sql.Composed:
+    column = lambda name: sql.Identifier(name).as_string(conn)
+    literal = lambda value: sql.Literal(value).as_string(conn)
+    query = sql.SQL("SELECT {columns} FROM {table}").format(
+        columns=sql.SQL(query_options.build_select_list(columns, column, column)),
+        table=sql.Identifier(self.table_schema, self.table),
+    )
+    # row filters come from the connection's QueryOptions, whose columns are
+    # checked and composed as identifiers and values as literals
+    where_clause = query_options.build_where_clause(column, literal)
+    if where_clause:
+      query += sql.SQL(" WHERE {}").format(sql.SQL(where_clause))
+    return query
+
+  def _open_cursor(
+      self, fields: Sequence[str], offset: int, query_options: QueryOptions
+  ) -> None:
+    """Opens a server-side cursor positioned at the provided offset."""
+    self._close_cursor()
+    self._conn = _get_pool(self.dsn).getconn()
+    table_columns = self._get_table_columns(self._conn)
+    # project only the requested fields that actually exist in the table
+    self._columns = [
+        f for f in fields if query_options.source_column(f) in table_columns
+    ]
+    self._position = offset
+    self._exhausted = False
+    if not self._columns:
+      print(f"None of the fields {fields} exist in {self.table_schema}.{self.table}.")
+      self._exhausted = True
+      return
+    self._cursor = self._conn.cursor(name=f"tightlock_{uuid.uuid4().hex}")
+    self._cursor.itersize = _CURSOR_ITERSIZE
+    self._cursor.execute(
+        self._build_query(self._conn, self._columns, query_options)
+    )
+    if offset:
+      self._cursor.scroll(offset)
+
+  def _close_cursor(self) -> None:
+    cursor, self._cursor = self._cursor, None
+    conn, self._conn = self._conn, None
+    broken = False
+    try:
+      if cursor is not None:
+        cursor.close()
+      if conn is not None:
+        # ends the read-only transaction that held the named cursor
+        conn.rollback()
+    except psycopg2.Error:
+      broken = True
+    if conn is not None:
+      # a broken connection is discarded instead of going back to the pool
+      _get_pool(self.dsn).putconn(conn, close=broken)
+
+  def close(self) -> None:
+    """Releases the cursor and connection of the run, even if it failed."""
+    self._close_cursor()
+    self._exhausted = False
+
+  def get_data(
+      self,
+      fields: Sequence[str],
+      offset: int,
+      limit: int,
+      reusable_credentials: Optional[Sequence[Mapping[str, Any]]],
+      query_options: Optional[QueryOptions],
+  ) -> List[Mapping[str, Any]]:
+    """get_data implemention for Postgres source."""
+    if self._exhausted and offset == self._position:
+      return []
+    if self._cursor is None or offset != self._position:
+      self._open_cursor(fields, offset, query_options or QueryOptions())
+      if self._exhausted:
+        return []
+
+    try:
+      rows = self._cursor.fetchmany(limit)
+    except psycopg2.Error:
+      self._close_cursor()
+      raise
+    self._position = offset + limit
+    if len(rows) < limit:
+      self._exhausted = True
+      self._close_cursor()
+
+    return [dict(zip(self._columns, row)) for row in rows]
+
+  def estimate_total_rows(
+      self, query_options: Optional[QueryOptions]
+  ) -> Optional[int]:
+    """Uses the planner row estimate, which accounts for filters for free."""
+    conn = _get_pool(self.dsn).getconn()
+    try:
+      table_columns = self._get_table_columns(conn)
+      if not table_columns:
+        return None
+      query = self._build_query(
+          conn, table_columns[:1], query_options or QueryOptions()
+      )
+      with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("EXPLAIN (FORMAT JSON) ") + query)
+        plan = cursor.fetchone()[0]
+      return int(plan[0]["Plan"]["Plan Rows"])
+    finally:
+      conn.rollback()
+      _get_pool(self.dsn).putconn(conn)
+
+  @staticmethod
+  def schema() -> Optional[ProtocolSchema]:
+    return ProtocolSchema(
+        "postgres",
+        [
+            ("host", Optional[str], Field(
+                default=_DEFAULT_HOST,
+                description="The Postgres host. Defaults to the Postgres instance that ships with Tightlock.")),
+            ("port", Optional[int], Field(
+                default=_DEFAULT_PORT,
+                description="The Postgres port.")),
+            ("database", str, Field(
+                description="The name of your Postgres database.")),
+            ("user", str, Field(
+                description="The Postgres user.")),
+            ("password", str, Field(
+                description="The Postgres password.")),
+            ("schema_name", Optional[str], Field(
+                default=_DEFAULT_SCHEMA_NAME,
+                description="The Postgres schema that contains the table.")),
+            ("table", str, Field(
+                description="The name of your Postgres table.")),
+        ]
+    )
+
+  def validate(self) -> ValidationResult:
+    try:
+      conn = psycopg2.connect(self.dsn)
+    except psycopg2.Error as e:
+      return ValidationResult(False, [f"Could not connect to Postgres: {e}"])
+    try:
+      with conn.cursor() as cursor:
+        cursor.execute(
+            sql.SQL("SELECT 1 FROM {table} LIMIT 0").format(
+                table=sql.Identifier(self.table_schema, self.table)
+            )
+        )
+      return ValidationResult(True, [])
+    except psycopg2.Error:
+      return ValidationResult(
+          False, [f"Table {self.table_schema}.{self.table} is not found."]
+      )
+    finally:
+      conn.close()
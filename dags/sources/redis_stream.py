@@ -0,0 +1,305 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+import time
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+import redis
+from pydantic import Field
+from utils import ProtocolSchema, QueryOptions, RunResult, ValidationResult
+
+_DEFAULT_HOST = "redis"
+_DEFAULT_PORT = 6379
+_DEFAULT_DB = 0
+_DEFAULT_CONSUMER_GROUP = "tightlock"
+_DEFAULT_CONSUMER_NAME = "tightlock"
+_DEFAULT_MAX_WAIT_SECONDS = 5
+# Entries delivered to a consumer that died without acknowledging them are
+# claimed back by the next run once they have been idle for this long.
+_DEFAULT_CLAIM_IDLE_SECONDS = 300
+_CLAIM_PAGE_SIZE = 1000
+# Entries delivered more often than this are moved to the dead-letter stream
+# instead of being delivered again.
+_DEFAULT_MAX_DELIVERIES = 5
+_DEAD_LETTER_STREAM_SUFFIX = ":dead_letter"
+
+StreamEntry = Tuple[str, Optional[Dict[str, str]]]
+
+
+class Source:
+  """Implements SourceProto protocol for Redis Streams.
+
+  Entries are consumed through a consumer group. The offset argument of
+  get_data is ignored: every call returns the next entries delivered to this
+  consumer, waiting at most `max_wait_seconds` for a batch to fill up. Entries
+  are acknowledged once the destination accepted them, so failed entries
+  (or the entries of failed runs) are delivered again by the next run, up to
+  `max_deliveries` times before they are moved to a dead-letter stream.
+  """
+
+  def __init__(self, config: Dict[str, Any]):
+    self.config = config
+    self.stream = config["stream"]
+    self.consumer_group = config.get("consumer_group") or _DEFAULT_CONSUMER_GROUP
+    self.consumer_name = config.get("consumer_name") or _DEFAULT_CONSUMER_NAME
+    self.max_wait_seconds = float(
+        config.get("max_wait_seconds") or _DEFAULT_MAX_WAIT_SECONDS
+    )
+    self.claim_idle_ms = int(
+        float(config.get("claim_idle_seconds") or _DEFAULT_CLAIM_IDLE_SECONDS)
+        * 1000
+    )
+    self.max_deliveries = int(
+        config.get("max_deliveries") or _DEFAULT_MAX_DELIVERIES
+    )
+    self.dead_letter_stream = (
+        config.get("dead_letter_stream")
+        or f"{self.stream}{_DEAD_LETTER_STREAM_SUFFIX}"
+    )
+    self.client = redis.Redis(
+        host=config.get("host") or _DEFAULT_HOST,
+        port=int(config.get("port") or _DEFAULT_PORT),
+        db=int(config.get("db") or _DEFAULT_DB),
+        password=config.get("password") or None,
+        decode_responses=True,
+    )
+    # Cursor over this consumer's pending entries list, replayed before
+    # reading new entries. None once the pending entries are exhausted.
+    self._pending_cursor = None
+    self._unacked_ids = []
+
+  def _ensure_consumer_group(self) -> None:
+    try:
+      self.client.xgroup_create(
+          self.stream, self.consumer_group, id="0", mkstream=True
+      )
+    except redis.ResponseError as e:
+      # BUSYGROUP: the consumer group already exists
+      if "BUSYGROUP" not in str(e):
+        raise
+
+  def _claim_stale_entries(self) -> None:
+    """Moves entries left pending by other consumers to this consumer."""
+    start_id = "0-0"
+    while True:
+      result = self.client.xautoclaim(
+          self.stream,
+          self.consumer_group,
+          self.consumer_name,
+          min_idle_time=self.claim_idle_ms,
+          start_id=start_id,
+          count=_CLAIM_PAGE_SIZE,
+      )
+      start_id = result[0]
+      if start_id == "0-0":
+        break
+
+  def _start_run(self) -> None:
+    self._ensure_consumer_group()
+    self._claim_stale_entries()
+    self._pending_cursor = "0"
+    self._unacked_ids = []
+
+  def _dead_letter(self, entries: List[StreamEntry]) -> List[StreamEntry]:
+    """Moves the pending entries delivered too often to the dead-letter stream.
+
+    Returns:
+      The entries to deliver again.
+    """
+    deliveries = {
+        pending["message_id"]: pending["times_delivered"]
+        for pending in self.client.xpending_range(
+            self.stream,
+            self.consumer_group,
+            min=entries[0][0],
+            max=entries[-1][0],
+            count=len(entries),
+            consumername=self.consumer_name,
+        )
+    }
+    undeliverable = [
+        (entry_id, values) for entry_id, values in entries
+        # trimmed entries (without values) are acknowledged by get_data
+        if values and deliveries.get(entry_id, 0) > self.max_deliveries
+    ]
+    if not undeliverable:
+      return entries
+    print(
+        f"Moving {len(undeliverable)} entries delivered more than"
+        f" {self.max_deliveries} times to {self.dead_letter_stream}."
+    )
+    with self.client.pipeline() as pipeline:
+      for entry_id, values in undeliverable:
+        pipeline.xadd(
+            self.dead_letter_stream, dict(values, original_id=entry_id)
+        )
+      pipeline.xack(
+          self.stream,
+          self.consumer_group,
+          *[entry_id for entry_id, _ in undeliverable],
+      )
+      pipeline.execute()
+    undeliverable_ids = {entry_id for entry_id, _ in undeliverable}
+    return [entry for entry in entries if entry[0] not in undeliverable_ids]
+
+  def _read(self, count: int, block_ms: int) -> List[StreamEntry]:
+    while self._pending_cursor is not None:
+      response = self.client.xreadgroup(
+          self.consumer_group,
+          self.consumer_name,
+          {self.stream: self._pending_cursor},
+          count=count,
+      )
+      entries = response[0][1] if response else []
+      if not entries:
+        self._pending_cursor = None
+        break
+      self._pending_cursor = entries[-1][0]
+      entries = self._dead_letter(entries)
+      if entries:
+        return entries
+
+    response = self.client.xreadgroup(
+        self.consumer_group,
+        self.consumer_name,
+        {self.stream: ">"},
+        count=count,
+        block=block_ms,
+    )
+    return response[0][1] if response else []
+
+  def get_data(
+      self,
+      fields: Sequence[str],
+      offset: int,
+      limit: int,
+      reusable_credentials: Optional[Sequence[Mapping[str, Any]]],
+      query_options: Optional[QueryOptions],
+  ) -> List[Mapping[str, Any]]:
+    """get_data implemention for Redis Streams source."""
+    if query_options and (query_options.field_mappings or query_options.filters):
+      # there is no query to push these into for a stream
+      raise ValueError(
+          "redis_stream sources do not support field mappings or filters."
+      )
+    if offset == 0:
+      self._start_run()
+
+    rows = []
+    deadline = time.monotonic() + self.max_wait_seconds
+    while len(rows) < limit:
+      remaining_ms = int((deadline - time.monotonic()) * 1000)
+      if remaining_ms <= 0:
+        break
+      entries = self._read(limit - len(rows), remaining_ms)
+      if not entries:
+        break
+      trimmed_ids = []
+      for entry_id, values in entries:
+        # values is None for pending entries that were trimmed from the stream
+        if values:
+          self._unacked_ids.append(entry_id)
+          rows.append({f: values[f] for f in fields if f in values})
+        else:
+          trimmed_ids.append(entry_id)
+      if trimmed_ids:
+        # there is nothing left to deliver, they would stay pending forever
+        self.client.xack(self.stream, self.consumer_group, *trimmed_ids)
+    return rows
+
+  def acknowledge(self, run_result: RunResult) -> None:
+    """Acknowledges the entries returned since the last acknowledgement.
+
+    Only the entries the destination accepted are acknowledged, the failed
+    ones staying pending to be delivered again by the next run. When the
+    destination does not report which rows failed, entries are only
+    acknowledged if none of them failed (delivery is at least once).
+
+    Args:
+      run_result: The result of sending the entries to the destination.
+    """
+    if run_result.failed_indices is not None:
+      failed_indices = set(run_result.failed_indices)
+      accepted_ids = [
+          entry_id for index, entry_id in enumerate(self._unacked_ids)
+          if index not in failed_indices
+      ]
+    elif not run_result.failed_hits:
+      accepted_ids = self._unacked_ids
+    else:
+      accepted_ids = []
+    if accepted_ids:
+      self.client.xack(self.stream, self.consumer_group, *accepted_ids)
+    self._unacked_ids = []
+
+  def estimate_total_rows(
+      self, query_options: Optional[QueryOptions]
+  ) -> Optional[int]:
+    """Entries not yet delivered to the group plus entries pending an ack."""
+    for group in self.client.xinfo_groups(self.stream):
+      if group["name"] == self.consumer_group:
+        if group.get("lag") is None:
+          return None
+        return group["lag"] + group["pending"]
+    return self.client.xlen(self.stream)
+
+  @staticmethod
+  def schema() -> Optional[ProtocolSchema]:
+    return ProtocolSchema(
+        "redis_stream",
+        [
+            ("stream", str, Field(
+                description="The name (key) of the Redis Stream to consume.")),
+            ("host", Optional[str], Field(
+                default=_DEFAULT_HOST,
+                description="The Redis host. Defaults to the Redis instance that ships with Tightlock.")),
+            ("port", Optional[int], Field(
+                default=_DEFAULT_PORT,
+                description="The Redis port.")),
+            ("db", Optional[int], Field(
+                default=_DEFAULT_DB,
+                description="The Redis logical database.")),
+            ("password", Optional[str], Field(
+                default=None,
+                description="The Redis password, if any.")),
+            ("consumer_group", Optional[str], Field(
+                default=_DEFAULT_CONSUMER_GROUP,
+                description="The consumer group used to track delivered entries.")),
+            ("consumer_name", Optional[str], Field(
+                default=_DEFAULT_CONSUMER_NAME,
+                description="The consumer name inside the consumer group.")),
+            ("max_wait_seconds", Optional[float], Field(
+                default=_DEFAULT_MAX_WAIT_SECONDS,
+                description="Maximum time to wait for a batch to fill up before it is sent. The run ends when no entries arrive within this time.")),
+            ("claim_idle_seconds", Optional[float], Field(
+                default=_DEFAULT_CLAIM_IDLE_SECONDS,
+                description="Unacknowledged entries idle for longer than this are claimed back and re-delivered.")),
+            ("max_deliveries", Optional[int], Field(
+                default=_DEFAULT_MAX_DELIVERIES,
+                description="Entries delivered more often than this without being acknowledged are moved to the dead-letter stream instead of being delivered again.")),
+            ("dead_letter_stream", Optional[str], Field(
+                default=None,
+                description="The stream undeliverable entries are moved to. Defaults to the stream name followed by `:dead_letter`.")),
+        ]
+    )
+
+  def validate(self) -> ValidationResult:
+    try:
+      self.client.ping()
+      self._ensure_consumer_group()
+    except redis.RedisError as e:
+      return ValidationResult(False, [f"Redis Stream {self.stream} is not reachable: {e}"])
+    return ValidationResult(True, [])
@@ -0,0 +1,99 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Microbenchmark of the GA4 MP per-event payload building and encoding.
+
+Compares the previous per-event path (payload rebuilt key by key, params
+filtered through a per-call reserved keys list, json.dumps encoding) with
+_PayloadBuilder and the serialized event packs.
+
+Run from the dags folder: python -m tests.benchmark_ga4mp
+"""
+
+import json
+import timeit
+
+from destinations.ga4mp import _PayloadBuilder, _dumps
+
+_EVENTS = 10000
+_REPEAT = 5
+
+_USER_PROPERTIES = {"tier": {"value": "gold"}}
+_ROWS = [
+    {
+        "client_id": f"{i}.1700000000",
+        "user_id": f"user_{i}",
+        "event_name": "purchase",
+        "timestamp_micros": "1700000000000000",
+        "currency": "USD",
+        "value": i * 1.5,
+        "transaction_id": f"T{i}",
+        "coupon": None,
+        "items": "",
+        "session_id": "123",
+    }
+    for i in range(_EVENTS)
+]
+
+
+def _legacy_validate_param(key, value):
+  reserved_keys = ["app_instance_id", "client_id", "user_id", "timestamp_micros", "event_name"]
+  return key not in reserved_keys and value is not None and value != ""
+
+
+def _legacy_parse_timestamp_micros(event):
+  t = event.get("timestamp_micros")
+  if t:
+    return int(t) if t.isdigit() else None
+  return None
+
+
+def _legacy_build(event):
+  payload = {}
+  payload["client_id"] = str(event.get("client_id", ""))
+  payload["user_id"] = str(event.get("user_id", ""))
+  payload["non_personalized_ads"] = False
+  payload["user_properties"] = _USER_PROPERTIES
+  timestamp_micros = _legacy_parse_timestamp_micros(event)
+  if timestamp_micros:
+    payload["timestamp_micros"] = timestamp_micros
+  params = {k: v for k, v in event.items() if _legacy_validate_param(k, v)}
+  payload["events"] = [{"name": event.get("event_name", ""), "params": params}]
+  return payload
+
+
+def _legacy_run():
+  for row in _ROWS:
+    json.dumps(_legacy_build(row)).encode()
+
+
+def _builder_run(builder):
+  for row in _ROWS:
+    _dumps(builder.build(row)["events"][0])
+
+
+def main():
+  builder = _PayloadBuilder("gtag", False, _USER_PROPERTIES)
+  legacy = min(timeit.repeat(_legacy_run, number=1, repeat=_REPEAT))
+  compiled = min(timeit.repeat(lambda: _builder_run(builder), number=1, repeat=_REPEAT))
+  print(f"encoder: {_dumps.__module__}")
+  print(f"legacy:   {legacy / _EVENTS * 1e6:.2f} us/event")
+  print(f"compiled: {compiled / _EVENTS * 1e6:.2f} us/event")
+  print(f"speedup:  {legacy / compiled:.2f}x")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,124 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Microbenchmark of the per-row message construction of Ads destinations.
+
+Builds the ClickConversion, ConversionAdjustment and
+OfflineUserDataJobOperation messages of a batch with proto-plus wrappers and
+with raw protobuf messages (`use_raw_protobuf`). No request is sent: clients
+are built offline with anonymous credentials.
+
+Run from the dags folder: python -m tests.benchmark_gads [api_version]
+"""
+
+import sys
+import timeit
+
+from destinations import gads_customermatch, gads_ec4web, gads_oca, gads_oci
+from google.ads.googleads.client import GoogleAdsClient
+from google.auth.credentials import AnonymousCredentials
+from utils import GoogleAdsUtils
+
+_ROWS = 2000
+_REPEAT = 5
+
+_CONFIG = {
+    "client_id": "client_id",
+    "client_secret": "client_secret",
+    "developer_token": "developer_token",
+    "login_customer_id": "1234567890",
+    "refresh_token": "refresh_token",
+    "user_list_id": "1",
+}
+
+_OCI_ROWS = [{
+    "customer_id": str(1000000000 + i % 10),
+    "conversion_action_id": "123",
+    "conversion_date_time": "2023-01-01 00:00:00+00:00",
+    "conversion_value": "1.5",
+    "gclid": f"gclid_{i}",
+    "conversion_custom_variable_id": "456",
+    "conversion_custom_variable_value": "value",
+} for i in range(_ROWS)]
+
+_OCA_ROWS = [{
+    "customer_id": str(1000000000 + i % 10),
+    "conversion_action_id": "123",
+    "adjustment_date_time": "2023-01-02 00:00:00+00:00",
+    "adjusted_value": "2.5",
+    "gclid": f"gclid_{i}",
+    "conversion_date_time": "2023-01-01 00:00:00+00:00",
+} for i in range(_ROWS)]
+
+_EC4WEB_ROWS = [{
+    "customer_id": str(1000000000 + i % 10),
+    "conversion_action_id": "123",
+    "order_id": f"order_{i}",
+    "hashed_email": "a" * 64,
+    "hashed_first_name": "b" * 64,
+    "hashed_last_name": "c" * 64,
+    "country_code": "US",
+    "postal_code": "10001",
+} for i in range(_ROWS)]
+
+_CUSTOMER_MATCH_ROWS = [{
+    "email": f"user.{i}@example.com",
+    "phone": "+1 555 0100",
+} for i in range(_ROWS)]
+
+_BUILDERS = [
+    ("ClickConversion", gads_oci,
+     lambda d: d._get_valid_and_invalid_conversions(_OCI_ROWS)),
+    ("ConversionAdjustment (restatement)", gads_oca,
+     lambda d: d._get_valid_and_invalid_adjustments(_OCA_ROWS)),
+    ("ConversionAdjustment (enhancement)", gads_ec4web,
+     lambda d: d._get_valid_and_invalid_adjustments(_EC4WEB_ROWS)),
+    ("OfflineUserDataJobOperation", gads_customermatch,
+     lambda d: [d._build_user_data_operation_from_row(r) for r in _CUSTOMER_MATCH_ROWS]),
+]
+
+
+def _offline_client(config, version):
+  return GoogleAdsClient(
+      credentials=AnonymousCredentials(),
+      developer_token=config["developer_token"],
+      use_proto_plus=not config.get("use_raw_protobuf", False),
+      version=version,
+  )
+
+
+def main():
+  # defaults to the API version of the destinations
+  api_version = sys.argv[1] if len(sys.argv) > 1 else None
+  default_version = GoogleAdsUtils.build_google_ads_client.__defaults__[0]
+  GoogleAdsUtils.build_google_ads_client = (
+      lambda self, config: _offline_client(config, api_version or default_version))
+
+  for message_name, module, build in _BUILDERS:
+    timings = {}
+    for use_raw_protobuf in (False, True):
+      destination = module.Destination(
+          dict(_CONFIG, use_raw_protobuf=use_raw_protobuf))
+      timings[use_raw_protobuf] = min(timeit.repeat(
+          lambda: build(destination), number=1, repeat=_REPEAT)) / _ROWS
+    print(
+        f"{message_name}: proto-plus {timings[False] * 1e6:.1f} us/row, "
+        f"raw protobuf {timings[True] * 1e6:.1f} us/row "
+        f"({timings[False] / timings[True]:.1f}x)")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,165 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Tests for the CM360 OCI destination."""
+import threading
+from types import SimpleNamespace
+
+from destinations import cm360oci
+from googleapiclient.errors import HttpError
+from utils import GoogleApiUtils
+
+_CONFIG = {
+    "profile_id": "1",
+    "encryptionEntityType": "DCM_ADVERTISER",
+    "encryptionEntityId": "2",
+    "encryptionEntitySource": "DATA_TRANSFER",
+    "kind": "dfareporting#encryptionInfo",
+    "access_token": "access_token",
+    "refresh_token": "refresh_token",
+    "token_uri": "https://oauth2.googleapis.com/token",
+    "client_id": "client_id",
+    "client_secret": "client_secret",
+    "max_requests_per_second": 1000,
+}
+
+
+def _conversion(i):
+  return {
+      "floodlightConfigurationId": "1",
+      "floodlightActivityId": "2",
+      "timestamp_micros": "1700000000000000",
+      "value": "1",
+      "quantity": "1",
+      "ordinal": str(i),
+      "gclid": f"gclid_{i}",
+  }
+
+
+class _FakeRequest:
+  def __init__(self, service, body):
+    self._service = service
+    self._body = body
+
+  def execute(self, **kwargs):
+    with self._service.lock:
+      self._service.requested_sizes.append(len(self._body["conversions"]))
+    return {"hasFailures": False, "status": []}
+
+
+class _FakeService:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.requested_sizes = []
+
+  def conversions(self):
+    return self
+
+  def batchinsert(self, profileId, body):  # pylint: disable=invalid-name
+    return _FakeRequest(self, body)
+
+
+def test_service_is_built_once_and_requests_are_split(monkeypatch):
+  service = _FakeService()
+  builds = []
+  monkeypatch.setattr(
+      GoogleApiUtils,
+      "build_service",
+      lambda self, *args, **kwargs: builds.append(args) or service)
+  destination = cm360oci.Destination(_CONFIG)
+  batch = [_conversion(i) for i in range(destination.batch_size())]
+
+  results = [destination.send_data(batch, dry_run=False) for _ in range(2)]
+
+  assert builds == [("dfareporting", "v4")]
+  assert sorted(service.requested_sizes) == [1000] * 8
+  assert all(result.successful_hits == 4000 for result in results)
+
+
+class _PartiallyFailingService(_FakeService):
+  """Rejects ordinal 3 and fails ordinal 5 once with an internal error."""
+
+  def __init__(self):
+    super().__init__()
+    self.internal_errors_left = 1
+
+  def batchinsert(self, profileId, body):  # pylint: disable=invalid-name
+    service = self
+    size = len(body["conversions"])
+
+    class _Request:
+      def execute(self, **kwargs):
+        service.requested_sizes.append(size)
+        statuses = []
+        for conversion in body["conversions"]:
+          errors = []
+          if conversion["ordinal"] == "3":
+            errors = [{"code": "INVALID_ARGUMENT", "message": "bad gclid"}]
+          elif conversion["ordinal"] == "5" and service.internal_errors_left:
+            service.internal_errors_left -= 1
+            errors = [{"code": "INTERNAL", "message": "try again"}]
+          statuses.append({"errors": errors})
+        return {"hasFailures": True, "status": statuses}
+
+    return _Request()
+
+
+def test_only_failed_conversions_are_retried(monkeypatch):
+  service = _PartiallyFailingService()
+  monkeypatch.setattr(
+      GoogleApiUtils, "build_service", lambda self, *args, **kwargs: service)
+  monkeypatch.setattr(cm360oci, "_RETRY_BACKOFF_SECONDS", 0)
+  destination = cm360oci.Destination(_CONFIG)
+
+  result = destination.send_data(
+      [_conversion(i) for i in range(10)], dry_run=False)
+
+  assert service.requested_sizes == [10, 1]
+  assert result.successful_hits == 9
+  assert result.error_messages == ["INVALID_ARGUMENT: bad gclid"]
+
+
+class _UnavailableRequest:
+  def execute(self, **kwargs):
+    raise HttpError(
+        SimpleNamespace(status=503, reason="Service Unavailable"), b"")
+
+
+class _UnavailableOnceService(_FakeService):
+  """Fails the first batchinsert request with a 503."""
+
+  def batchinsert(self, profileId, body):  # pylint: disable=invalid-name
+    if not self.requested_sizes:
+      self.requested_sizes.append(len(body["conversions"]))
+      return _UnavailableRequest()
+    return _FakeRequest(self, body)
+
+
+def test_unavailable_requests_are_retried_only_with_ordinals(monkeypatch):
+  monkeypatch.setattr(cm360oci, "_RETRY_BACKOFF_SECONDS", 0)
+  results = []
+  for ordinal in ("1", ""):
+    service = _UnavailableOnceService()
+    monkeypatch.setattr(
+        GoogleApiUtils, "build_service", lambda self, *args, **kwargs: service)
+    destination = cm360oci.Destination(_CONFIG)
+    conversions = [dict(_conversion(i), ordinal=ordinal) for i in range(2)]
+    results.append(destination.send_data(conversions, dry_run=False))
+
+  # CM360 deduplicates conversions with ordinals, which are sent again
+  assert results[0].successful_hits == 2
+  # the others may have been inserted by the failed request
+  assert results[1].failed_hits == 2
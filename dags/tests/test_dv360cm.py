@@ -0,0 +1,233 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Tests for the DV360 Customer Match destination."""
+import json
+import pathlib
+from types import SimpleNamespace
+
+from destinations import dv360cm
+from destinations.dv360cm import SERVICE_URL, Destination
+from googleapiclient import discovery_cache
+from googleapiclient.errors import HttpError
+import utils
+
+_CONFIG = {
+    "advertiser_id": "123",
+    "audience_name": "tightlock audience",
+    "payload_type": "contact_info",
+    "refresh_token": "refresh_token",
+    "client_id": "client_id",
+    "client_secret": "client_secret",
+}
+
+
+class _FakeRequest:
+  def __init__(self, response, error=None):
+    self._response = response
+    self._error = error
+
+  def execute(self, **kwargs):
+    if self._error:
+      raise self._error
+    return self._response
+
+
+class _FakeAudiencesResource:
+  def __init__(self):
+    self.calls = []
+
+  def list(self, **kwargs):
+    self.calls.append("list")
+    return _FakeRequest({"firstAndThirdPartyAudiences": []})
+
+  def create(self, **kwargs):
+    self.calls.append("create")
+    return _FakeRequest({
+        "name": "firstAndThirdPartyAudiences/456",
+        "firstAndThirdPartyAudienceId": "456",
+    })
+
+  def editCustomerMatchMembers(self, **kwargs):  # pylint: disable=invalid-name
+    self.calls.append(f"edit {kwargs['firstAndThirdPartyAudienceId']}")
+    return _FakeRequest({"firstAndThirdPartyAudienceId": "456"})
+
+
+def _invalid_argument(message, field=None):
+  error = {"code": 400, "message": message, "status": "INVALID_ARGUMENT"}
+  if field:
+    error["details"] = [{
+        "@type": "type.googleapis.com/google.rpc.BadRequest",
+        "fieldViolations": [{"field": field, "description": message}],
+    }]
+  return HttpError(
+      SimpleNamespace(status=400, reason="Bad Request"),
+      json.dumps({"error": error}).encode())
+
+
+class _RejectingAudiencesResource:
+  """Rejects requests containing the "bad" hashed email as invalid."""
+
+  def __init__(self, error=None):
+    self.requests = []
+    self._error = error
+
+  def list(self, **kwargs):
+    return _FakeRequest({"firstAndThirdPartyAudiences": []})
+
+  def create(self, **kwargs):
+    self.requests.append("create")
+    return self._request(kwargs["body"]["contactInfoList"]["contactInfos"],
+                         "contactInfoList", {"firstAndThirdPartyAudienceId": "456"})
+
+  def editCustomerMatchMembers(self, **kwargs):  # pylint: disable=invalid-name
+    self.requests.append("edit")
+    return self._request(kwargs["body"]["addedContactInfoList"]["contactInfos"],
+                         "addedContactInfoList", {})
+
+  @property
+  def requested_sizes(self):
+    return [size for size in self.requests if isinstance(size, int)]
+
+  def _request(self, contact_infos, list_field, response):
+    self.requests.append(len(contact_infos))
+    for position, ids in enumerate(contact_infos):
+      if ids["hashedEmails"] == ["bad"]:
+        return _FakeRequest(None, self._error or _invalid_argument(
+            "Invalid hashed email.",
+            f"{list_field}.contactInfos[{position}].hashedEmails[0]"))
+    return _FakeRequest(response)
+
+
+def _entries(count, bad_positions):
+  entries = [{"hashed_email": f"{i}"} for i in range(count)]
+  for position in bad_positions:
+    entries[position] = {"hashed_email": "bad"}
+  return entries
+
+
+def test_service_is_built_from_the_cached_discovery_document(
+    monkeypatch, tmp_path
+):
+  monkeypatch.setattr(utils, "_DISCOVERY_CACHE_DIR", tmp_path)
+  # any document exposing the audiences resource will do
+  document = pathlib.Path(
+      discovery_cache.__file__
+  ).parent / "documents" / "displayvideo.v1.json"
+  utils._DiscoveryDocumentCache(tmp_path, 60).set(
+      SERVICE_URL, document.read_text()
+  )
+  destination = Destination(_CONFIG)
+
+  assert destination._client is None  # not built at construction time
+  assert hasattr(destination.client, "editCustomerMatchMembers")
+
+
+def test_audience_is_looked_up_once_per_run():
+  destination = Destination(_CONFIG)
+  audiences = _FakeAudiencesResource()
+  destination._client = audiences
+
+  for _ in range(3):
+    destination.send_data([{"email": "user@example.com"}], dry_run=False)
+
+  assert audiences.calls == ["list", "create", "edit 456", "edit 456"]
+
+
+def test_invalid_entries_are_isolated_by_bisection(monkeypatch):
+  monkeypatch.setattr(dv360cm, "_MAX_ENTRIES_PER_REQUEST", 4)
+  destination = Destination(dict(_CONFIG, max_concurrent_requests=1))
+  audiences = _RejectingAudiencesResource()
+  destination._client = audiences
+  destination._audience_id = "456"
+
+  result = destination.send_data(_entries(8, [5]), dry_run=False)
+
+  assert result.successful_hits == 7
+  assert result.failed_hits == 1
+  # [0-3] succeeds, [4-7] is bisected down to the bad entry
+  assert audiences.requested_sizes == [4, 4, 2, 2, 1, 1]
+
+
+def test_errors_independent_of_the_entries_are_not_bisected(monkeypatch):
+  monkeypatch.setattr(dv360cm, "_MAX_ENTRIES_PER_REQUEST", 4)
+  destination = Destination(dict(_CONFIG, max_concurrent_requests=1))
+  destination._audience_id = "456"
+
+  not_found = _RejectingAudiencesResource(HttpError(
+      SimpleNamespace(status=400, reason="Bad Request"),
+      b'{"error": {"code": 400, "message": "Audience not found."}}'))
+  destination._client = not_found
+  assert destination.send_data(_entries(4, [0]), dry_run=False).failed_hits == 4
+  assert not_found.requested_sizes == [4]
+
+
+def test_member_data_errors_are_bisected_to_the_depth_limit(monkeypatch):
+  monkeypatch.setattr(dv360cm, "_MAX_ENTRIES_PER_REQUEST", 4)
+  destination = Destination(dict(_CONFIG, max_concurrent_requests=1))
+  destination._audience_id = "456"
+
+  # both halves fail with the same error, which is still narrowed down
+  unindexed = _RejectingAudiencesResource(
+      _invalid_argument("Invalid contactInfos."))
+  destination._client = unindexed
+  assert destination.send_data(_entries(4, [0, 3]), dry_run=False).failed_hits == 2
+  assert unindexed.requested_sizes == [4, 2, 2, 1, 1, 1, 1]
+
+
+def test_audience_creation_is_bisected(monkeypatch):
+  monkeypatch.setattr(dv360cm, "_MAX_ENTRIES_PER_REQUEST", 4)
+  destination = Destination(dict(_CONFIG, max_concurrent_requests=1))
+  audiences = _RejectingAudiencesResource()
+  destination._client = audiences
+
+  result = destination.send_data(_entries(8, [0]), dry_run=False)
+
+  assert result.successful_hits == 7
+  assert result.failed_hits == 1
+  assert destination._audience_id == "456"
+  # the audience is created with [2-3], then [0-1] is bisected and [4-7] added
+  assert audiences.requests == [
+      "create", 4, "create", 2, "create", 2,
+      "edit", 1, "edit", 1, "edit", 4,
+  ]
+
+
+def test_failed_audience_creation_fails_every_entry(monkeypatch):
+  monkeypatch.setattr(dv360cm, "_MAX_ENTRIES_PER_REQUEST", 4)
+  destination = Destination(dict(_CONFIG, max_concurrent_requests=1))
+  audiences = _RejectingAudiencesResource(OSError("connection reset"))
+  destination._client = audiences
+
+  result = destination.send_data(_entries(8, [0]), dry_run=False)
+
+  assert result.failed_hits == 8
+  assert audiences.requests == ["create", 4]
+  assert "connection reset" in result.error_messages[-1]
+
+
+def test_audience_creation_without_id_fails_the_other_entries(monkeypatch):
+  monkeypatch.setattr(dv360cm, "_MAX_ENTRIES_PER_REQUEST", 4)
+  destination = Destination(dict(_CONFIG, max_concurrent_requests=1))
+  audiences = _FakeAudiencesResource()
+  audiences.create = lambda **kwargs: _FakeRequest({})
+  destination._client = audiences
+
+  result = destination.send_data(_entries(8, []), dry_run=False)
+
+  assert result.successful_hits == 4
+  assert result.failed_hits == 4
+  assert "returned no audience id" in result.error_messages[-1]
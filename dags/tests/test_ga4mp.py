@@ -0,0 +1,220 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Tests for the GA4 Measurement Protocol destination."""
+import json
+import threading
+from http import server
+
+import errors
+import pytest
+from destinations.ga4mp import Destination, _OfflineValidator
+
+_CONFIG = {
+    "api_secret": "secret",
+    "payload_type": "gtag",
+    "measurement_id": "G-TEST",
+}
+
+
+def _single_event_payload(client_id, timestamp_micros, name):
+  return {
+      "client_id": client_id,
+      "user_id": "",
+      "non_personalized_ads": False,
+      "timestamp_micros": timestamp_micros,
+      "events": [{"name": name, "params": {}}],
+  }
+
+
+def test_every_event_is_validated_remotely_by_default():
+  assert Destination(_CONFIG).validation_policy == "all"
+
+
+def test_pack_events_groups_by_request_fields():
+  destination = Destination(_CONFIG)
+  valid_events = [
+      (i, _single_event_payload("a", 1, f"event_{i}")) for i in range(30)
+  ]
+  valid_events.append((30, _single_event_payload("b", 1, "other_client")))
+  valid_events.append((31, _single_event_payload("a", 2, "other_timestamp")))
+
+  packs = destination._pack_events(valid_events)
+
+  assert [len(pack.indices) for pack in packs] == [25, 5, 1, 1]
+  assert packs[0].indices == list(range(25))
+  assert packs[1].indices == list(range(25, 30))
+  bodies = [json.loads(pack.body()) for pack in packs]
+  assert bodies[2]["client_id"] == "b"
+  assert bodies[3]["timestamp_micros"] == 2
+  assert [e["name"] for e in bodies[0]["events"]] == [
+      f"event_{i}" for i in range(25)
+  ]
+  assert all(pack.size == len(pack.body()) for pack in packs)
+
+
+class _StubMeasurementProtocolHandler(server.BaseHTTPRequestHandler):
+  """Local stub of the /mp/collect and /debug/mp/collect endpoints."""
+
+  received_events = []
+  validated_events = []
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+    if self.path.startswith("/debug/mp/collect"):
+      name = body["events"][0]["name"]
+      self.validated_events.append(name)
+      messages = []
+      if name.startswith("bad"):
+        messages.append({"fieldPath": "events", "description": "invalid"})
+      response = json.dumps({"validationMessages": messages}).encode()
+      self.send_response(200)
+      self.send_header("Content-Length", str(len(response)))
+      self.end_headers()
+      self.wfile.write(response)
+    else:
+      self.received_events.extend(e["name"] for e in body["events"])
+      self.send_response(204)
+      self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+
+@pytest.fixture
+def stub_server():
+  _StubMeasurementProtocolHandler.received_events = []
+  _StubMeasurementProtocolHandler.validated_events = []
+  httpd = server.ThreadingHTTPServer(
+      ("127.0.0.1", 0), _StubMeasurementProtocolHandler
+  )
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield f"http://127.0.0.1:{httpd.server_port}"
+  httpd.shutdown()
+  httpd.server_close()
+
+
+def _stub_destination(stub_server, **config):
+  destination = Destination(dict(_CONFIG, **config))
+  destination.post_url = f"{stub_server}/mp/collect"
+  destination.validate_url = f"{stub_server}/debug/mp/collect"
+  return destination
+
+
+def test_send_data_against_stub(stub_server):
+  destination = _stub_destination(
+      stub_server, max_concurrent_requests=4, validation_policy="all"
+  )
+  input_data = [
+      {"client_id": str(i % 3), "event_name": f"event_{i}"} for i in range(60)
+  ]
+
+  run_result = destination.send_data(input_data, dry_run=False)
+
+  assert run_result.successful_hits == 60
+  assert run_result.failed_hits == 0
+  assert sorted(_StubMeasurementProtocolHandler.received_events) == sorted(
+      f"event_{i}" for i in range(60)
+  )
+
+
+def test_sampled_validation_escalates_to_whole_batch(stub_server):
+  input_data = [{"client_id": "a", "event_name": "bad_event"}] + [
+      {"client_id": "a", "event_name": f"event_{i}"} for i in range(9)
+  ]
+  input_data.append({"client_id": "a", "event_name": "bad_event"})
+
+  healthy_destination = _stub_destination(
+      stub_server, validation_policy="first_n", validation_sample_size=2
+  )
+  healthy_result = healthy_destination.send_data(input_data[1:], dry_run=True)
+  assert len(_StubMeasurementProtocolHandler.validated_events) == 2
+  # the bad event at the end of the batch is not sampled
+  assert healthy_result.failed_hits == 0
+
+  _StubMeasurementProtocolHandler.validated_events = []
+  failing_destination = _stub_destination(
+      stub_server, validation_policy="first_n", validation_sample_size=2
+  )
+  failing_result = failing_destination.send_data(input_data, dry_run=True)
+  assert len(_StubMeasurementProtocolHandler.validated_events) == 11
+  assert failing_result.failed_hits == 2
+
+
+def test_explicit_zero_validation_settings_are_kept(stub_server):
+  input_data = [{"client_id": "a", "event_name": "bad_event"}] + [
+      {"client_id": "a", "event_name": f"event_{i}"} for i in range(9)
+  ]
+
+  no_sample_destination = _stub_destination(
+      stub_server, validation_policy="sample_rate", validation_sample_rate=0
+  )
+  assert no_sample_destination.validation_sample_rate == 0
+  no_sample_result = no_sample_destination.send_data(input_data, dry_run=True)
+  assert _StubMeasurementProtocolHandler.validated_events == []
+  assert no_sample_result.failed_hits == 0
+
+  strict_destination = _stub_destination(
+      stub_server,
+      validation_policy="first_n",
+      validation_sample_size=2,
+      validation_error_threshold=0,
+  )
+  assert strict_destination.validation_error_threshold == 0
+  strict_result = strict_destination.send_data(input_data, dry_run=True)
+  # any sampled error escalates to the whole batch
+  assert len(_StubMeasurementProtocolHandler.validated_events) == 10
+  assert strict_result.failed_hits == 1
+
+
+def test_offline_validator_parses_json_string_items():
+  validator = _OfflineValidator("gtag")
+  payload = _single_event_payload("a", None, "purchase")
+  del payload["timestamp_micros"]
+  payload["events"][0]["params"]["items"] = '[{"item_id": "sku", "price": 1}]'
+
+  validator.validate(payload)
+
+
+@pytest.mark.parametrize(
+    "event_override,error_num",
+    [
+        ({"client_id": ""},
+         errors.ErrorNameIDMap.GA4_HOOK_ERROR_VALUE_REQUIRED_CLIENT_ID),
+        ({"timestamp_micros": 1},
+         errors.ErrorNameIDMap.GA4_HOOK_ERROR_VALUE_INVALID_TIMESTAMP_MICROS),
+        ({"events": [{"name": "session_start", "params": {}}]},
+         errors.ErrorNameIDMap.GA4_HOOK_ERROR_VALUE_INVALID_EVENTS),
+        ({"events": [{"name": "purchase", "params": {"google_x": "1"}}]},
+         errors.ErrorNameIDMap.GA4_HOOK_ERROR_VALUE_INVALID_EVENTS_PARAMS),
+        ({"events": [{"name": "purchase", "params": {"items": [{"price": 1}]}}]},
+         errors.ErrorNameIDMap.GA4_HOOK_ERROR_VALUE_INVALID_EVENTS_PARAMS_ITEMS),
+        ({"events": [{"name": "purchase", "params": {"items": "[{"}}]},
+         errors.ErrorNameIDMap.GA4_HOOK_ERROR_VALUE_INVALID_EVENTS_PARAMS_ITEMS),
+        ({"user_properties": {"user_id": {"value": "1"}}},
+         errors.ErrorNameIDMap.GA4_HOOK_ERROR_VALUE_INVALID_USER_PROPERTIES),
+    ]
+)
+def test_offline_validator_rejects_invalid_payloads(event_override, error_num):
+  validator = _OfflineValidator("gtag")
+  payload = _single_event_payload("a", None, "purchase")
+  del payload["timestamp_micros"]
+  validator.validate(payload)  # the base payload is valid
+
+  with pytest.raises(errors.DataOutConnectorValueError) as error:
+    validator.validate(dict(payload, **event_override))
+  assert error.value.error_num == error_num
@@ -0,0 +1,430 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Tests for the Google Ads Customer Match destination."""
+from types import SimpleNamespace
+
+import psycopg2
+import pytest
+from destinations import gads_customermatch
+from utils import GoogleAdsUtils
+
+_CONFIG = {
+    "client_id": "client_id",
+    "client_secret": "client_secret",
+    "developer_token": "developer_token",
+    "login_customer_id": "1234567890",
+    "refresh_token": "refresh_token",
+    "user_list_id": "1",
+}
+
+_RUNNING = 3
+_SUCCESS = 4
+_FAILED = 5
+
+
+class _FakeMessage:
+  def __init__(self):
+    self.operations = []
+
+  def __getattr__(self, name):
+    value = _FakeMessage()
+    setattr(self, name, value)
+    return value
+
+
+class _FakeJobService:
+  def __init__(self):
+    self.jobs_created = 0
+    self.added_operations = []
+    self.operations = []
+    self.jobs_run = []
+    self.rejected = []  # positions of the operations failing partially
+
+  def create_offline_user_data_job(self, customer_id, job):
+    self.jobs_created += 1
+    return SimpleNamespace(resource_name=f"jobs/{self.jobs_created}")
+
+  def add_offline_user_data_job_operations(self, request):
+    self.added_operations.append(len(request.operations))
+    self.operations.extend(request.operations)
+    errors = [
+        SimpleNamespace(
+            location=SimpleNamespace(
+                field_path_elements=[SimpleNamespace(index=index)]),
+            message="Invalid identifier.", error_code=1)
+        for index in range(len(request.operations))
+        if index in self.rejected
+    ]
+    # parse_google_ads_failure is patched to return the detail as is
+    details = [SimpleNamespace(value=SimpleNamespace(errors=errors))]
+    return SimpleNamespace(partial_failure_error=SimpleNamespace(
+        code=3 if errors else 0, details=details))
+
+  def run_offline_user_data_job(self, resource_name):
+    self.jobs_run.append(resource_name)
+
+
+class _FakeAdsService:
+  def __init__(self):
+    self.job_status = _SUCCESS
+
+  def user_list_path(self, customer_id, user_list_id):
+    return f"customers/{customer_id}/userLists/{user_list_id}"
+
+  def search(self, customer_id, query):
+    job = SimpleNamespace(status=self.job_status, failure_reason=0)
+    return [SimpleNamespace(offline_user_data_job=job)]
+
+
+class _FakeGoogleAdsClient:
+  enums = SimpleNamespace(
+      OfflineUserDataJobTypeEnum=SimpleNamespace(CUSTOMER_MATCH_USER_LIST=7),
+      OfflineUserDataJobStatusEnum=SimpleNamespace(
+          SUCCESS=_SUCCESS, FAILED=_FAILED),
+  )
+
+  def __init__(self):
+    self.services = {
+        "OfflineUserDataJobService": _FakeJobService(),
+        "GoogleAdsService": _FakeAdsService(),
+    }
+
+  def get_service(self, name):
+    return self.services[name]
+
+  def get_type(self, name):
+    return _FakeMessage()
+
+
+class _FakeConfigDatabase:
+  """The Customer Match tables of a fake Tightlock config database."""
+
+  def __init__(self):
+    self.snapshot = set()
+    self.staging = set()
+    self.jobs = []
+    self.locks = []
+
+
+class _FakeConfigCursor:
+
+  def __init__(self, db):
+    self._db = db
+    self._result = []
+    self.itersize = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def __iter__(self):
+    return iter(self._result)
+
+  def fetchone(self):
+    return self._result[0] if self._result else None
+
+  def fetchall(self):
+    return self._result
+
+  def execute(self, query, params=None):
+    if not isinstance(query, str):
+      query = query.as_string(None)
+    db = self._db
+    self._result = []
+    if query.startswith("SELECT pg_advisory_xact_lock"):
+      db.locks.append(params[0])
+    elif query.startswith('DELETE FROM "customer_match_staging" WHERE staged_at'):
+      pass  # nothing staged by the tests is stale
+    elif query.startswith('SELECT member FROM "customer_match_snapshot"'):
+      self._result = sorted(
+          (m,) for user_list, m in db.snapshot if user_list == params[0])
+    elif query.startswith('SELECT member FROM "customer_match_staging"'):
+      self._result = sorted(
+          (m,) for run_id, _, m in db.staging if run_id == params[0])
+    elif query.startswith('INSERT INTO "customer_match_jobs"'):
+      db.jobs.append(params)
+    elif query.startswith("SELECT job, operations"):
+      self._result = [
+          (job, operations) for job, user_list, _, operations in db.jobs
+          if user_list == params[0]
+      ]
+    elif query.startswith('DELETE FROM "customer_match_jobs"'):
+      for job in db.jobs:
+        if job[0] == params[0]:
+          db.jobs.remove(job)
+          self._result = [(job[2],)]
+    elif query.startswith('DELETE FROM "customer_match_snapshot"'):
+      db.snapshot = {row for row in db.snapshot if row[0] != params[0]}
+    elif query.startswith('INSERT INTO "customer_match_snapshot"'):
+      db.snapshot |= {(l, m) for r, l, m in db.staging if r == params[0]}
+    elif query.startswith(
+        'DELETE FROM "customer_match_staging" WHERE run_id = %s AND member'):
+      db.staging = {
+          row for row in db.staging
+          if row[0] != params[0] or row[2] not in params[1]
+      }
+    elif query.startswith('DELETE FROM "customer_match_staging"'):
+      db.staging = {row for row in db.staging if row[0] != params[0]}
+
+
+class _FakeConfigConnection:
+
+  def __init__(self, db):
+    self._db = db
+    self.closed = False
+
+  def cursor(self, name=None):
+    return _FakeConfigCursor(self._db)
+
+  def commit(self):
+    pass
+
+  def rollback(self):
+    pass
+
+  def close(self):
+    self.closed = True
+
+
+@pytest.fixture(name="config_db")
+def fixture_config_db(monkeypatch):
+  db = _FakeConfigDatabase()
+  monkeypatch.setattr(
+      gads_customermatch, "PostgresHook",
+      lambda postgres_conn_id: SimpleNamespace(
+          get_conn=lambda: _FakeConfigConnection(db)))
+  monkeypatch.setattr(
+      psycopg2.extensions, "quote_ident", lambda name, context: f'"{name}"')
+  monkeypatch.setattr(
+      gads_customermatch, "execute_values",
+      lambda cursor, query, rows, page_size: db.staging.update(rows))
+  return db
+
+
+def _destination(monkeypatch, client, **config):
+  monkeypatch.setattr(
+      GoogleAdsUtils, "build_google_ads_client", lambda self, config: client)
+  monkeypatch.setattr(
+      GoogleAdsUtils, "parse_google_ads_failure", lambda self, client, value: value)
+  destination = gads_customermatch.Destination(dict(_CONFIG, **config))
+  monkeypatch.setattr(
+      destination, "_build_user_data_operation",
+      lambda user_data, remove=False: (
+          "remove" if remove else "create", user_data))
+  return destination
+
+
+def test_one_upload_job_per_run(monkeypatch, config_db):
+  client = _FakeGoogleAdsClient()
+  monkeypatch.setattr(gads_customermatch, "_MAX_OPERATIONS_PER_REQUEST", 2500)
+  destination = _destination(monkeypatch, client)
+
+  results = [
+      destination.send_data([{"email": "a@example.com"}] * 1000, False)
+      for _ in range(6)
+  ]
+  flush_result = destination.flush(False)
+
+  job_service = client.services["OfflineUserDataJobService"]
+  assert job_service.jobs_created == 1
+  assert job_service.added_operations == [2500, 2500, 1000]
+  assert job_service.jobs_run == ["jobs/1"]
+  assert sum(r.successful_hits for r in results) == 5000
+  assert flush_result.successful_hits == 1000
+  assert not flush_result.error_messages
+  assert config_db.jobs == []
+
+
+def test_failed_upload_job_moves_operations_to_failed(monkeypatch, config_db):
+  client = _FakeGoogleAdsClient()
+  client.services["GoogleAdsService"].job_status = _FAILED
+  destination = _destination(monkeypatch, client)
+
+  send_result = destination.send_data([{"email": "a@example.com"}] * 10, False)
+  run_result = send_result + destination.flush(False)
+
+  assert run_result.successful_hits == 0
+  assert run_result.failed_hits == 10
+  assert run_result.error_messages == ["Offline user data job 'jobs/1' failed: 0"]
+
+
+def test_upload_job_is_polled_until_it_finished(monkeypatch, config_db):
+  client = _FakeGoogleAdsClient()
+  ads_service = client.services["GoogleAdsService"]
+  ads_service.job_status = _RUNNING
+  sleeps = []
+
+  def sleep(seconds):
+    sleeps.append(seconds)
+    if len(sleeps) == 3:
+      ads_service.job_status = _FAILED
+
+  monkeypatch.setattr(gads_customermatch.time, "sleep", sleep)
+  destination = _destination(monkeypatch, client)
+  send_result = destination.send_data([{"email": "a@example.com"}] * 10, False)
+  run_result = send_result + destination.flush(False)
+
+  assert sleeps == [5, 10, 20]
+  assert run_result.successful_hits == 0
+  assert run_result.failed_hits == 10
+  assert config_db.jobs == []
+
+
+def test_running_upload_job_is_reported_by_a_later_run(
+    monkeypatch, config_db):
+  client = _FakeGoogleAdsClient()
+  ads_service = client.services["GoogleAdsService"]
+  ads_service.job_status = _RUNNING
+  destination = _destination(
+      monkeypatch, client, job_status_timeout_seconds=0)
+  destination.send_data([{"email": "a@example.com"}] * 10, False)
+  assert destination.flush(False).successful_hits == 10
+  assert config_db.jobs == [("jobs/1", "1234567890/1", None, 10)]
+
+  ads_service.job_status = _SUCCESS
+  destination = _destination(
+      monkeypatch, client, job_status_timeout_seconds=0)
+  destination.send_data([{"email": "a@example.com"}] * 5, False)
+  run_result = destination.flush(False)
+
+  # the job of the previous run does not change the counts of this one
+  assert run_result.successful_hits == 5
+  assert run_result.failed_hits == 0
+  assert destination.telemetry()["previous_jobs_succeeded"] == 1
+  assert config_db.jobs == []
+
+
+def test_sort_merge_streams_delta_operations():
+  previous = ["a", "b", "d", "f"]
+  current = ["b", "c", "d", "e", "g"]
+
+  operations = list(gads_customermatch._sort_merge(previous, current))
+
+  assert operations == [
+      ("remove", "a"), ("create", "c"), ("create", "e"), ("remove", "f"),
+      ("create", "g"),
+  ]
+
+
+def test_member_keys_are_canonical_per_identifier():
+  address = {
+      "postal_code": "z", "country_code": "c", "last_name": "l",
+      "first_name": "f",
+  }
+  members = gads_customermatch._member_keys(
+      {"phone": "p", "email": "e", "unrelated": "x", **address})
+
+  assert members == [
+      "email:e", "phone:p",
+      'address:{"country_code":"c","first_name":"f","last_name":"l",'
+      '"postal_code":"z"}',
+  ]
+  assert [gads_customermatch._member_user_data(m) for m in members] == [
+      {"email": "e"}, {"phone": "p"}, address,
+  ]
+
+
+def _delta_run(monkeypatch, client, emails):
+  destination = _destination(monkeypatch, client, sync_mode="delta")
+  destination.send_data([{"email": email} for email in emails], False)
+  return destination
+
+
+def _sent_operations(client, start=0):
+  operations = client.services["OfflineUserDataJobService"].operations[start:]
+  return sorted(operation_type for operation_type, _ in operations)
+
+
+def test_delta_sync_commits_snapshot_of_succeeded_job(monkeypatch, config_db):
+  client = _FakeGoogleAdsClient()
+
+  _delta_run(monkeypatch, client, ["a@example.com", "b@example.com"]).flush(False)
+  assert _sent_operations(client) == ["create", "create"]
+  assert len(config_db.snapshot) == 2
+
+  _delta_run(monkeypatch, client, ["b@example.com", "c@example.com"]).flush(False)
+  assert _sent_operations(client, start=2) == ["create", "remove"]
+  assert len(config_db.snapshot) == 2
+  assert config_db.staging == set()
+  assert config_db.locks == ["1234567890/1"] * 2
+
+
+def test_delta_sync_diffs_each_identifier(monkeypatch, config_db):
+  client = _FakeGoogleAdsClient()
+  job_service = client.services["OfflineUserDataJobService"]
+  destination = _destination(monkeypatch, client, sync_mode="delta")
+  destination.send_data([{"email": "a@example.com", "phone": "+1"}], False)
+  destination.flush(False)
+
+  destination = _destination(monkeypatch, client, sync_mode="delta")
+  destination.send_data([{"email": "a@example.com", "phone": "+2"}], False)
+  destination.flush(False)
+
+  # the email of the user is neither removed nor added again
+  (create, created), (remove, removed) = sorted(job_service.operations[2:])
+  assert (create, remove) == ("create", "remove")
+  assert created.keys() == removed.keys() == {"phone"}
+  assert created != removed
+
+
+def test_failed_delta_operations_are_retried(monkeypatch, config_db):
+  client = _FakeGoogleAdsClient()
+  job_service = client.services["OfflineUserDataJobService"]
+  job_service.rejected = [1]
+  result = _delta_run(
+      monkeypatch, client, ["a@example.com", "b@example.com"]).flush(False)
+  assert result.failed_hits == 1
+  assert len(config_db.snapshot) == 1
+
+  job_service.rejected = []
+  _delta_run(monkeypatch, client, ["a@example.com", "b@example.com"]).flush(False)
+  assert job_service.operations[2:] == job_service.operations[1:2]
+  assert len(config_db.snapshot) == 2
+
+
+def test_failed_delta_job_keeps_previous_snapshot(monkeypatch, config_db):
+  client = _FakeGoogleAdsClient()
+  ads_service = client.services["GoogleAdsService"]
+  _delta_run(monkeypatch, client, ["a@example.com"]).flush(False)
+  snapshot = set(config_db.snapshot)
+
+  ads_service.job_status = _FAILED
+  failed_result = _delta_run(
+      monkeypatch, client, ["b@example.com"]).flush(False)
+  assert failed_result.failed_hits == 2
+  assert config_db.snapshot == snapshot
+  assert config_db.staging == set()
+
+  # the operations of the failed job are computed again
+  ads_service.job_status = _SUCCESS
+  _delta_run(monkeypatch, client, ["b@example.com"]).flush(False)
+  assert _sent_operations(client, start=3) == ["create", "remove"]
+  assert config_db.snapshot != snapshot
+
+
+def test_concurrent_delta_runs_stage_apart(monkeypatch, config_db):
+  client = _FakeGoogleAdsClient()
+  first_run = _delta_run(monkeypatch, client, ["a@example.com"])
+  second_run = _delta_run(monkeypatch, client, ["b@example.com"])
+
+  first_run.flush(False)
+  assert _sent_operations(client) == ["create"]
+  second_run.flush(False)
+  assert _sent_operations(client, start=1) == ["create", "remove"]
+  assert len(config_db.snapshot) == 1
@@ -0,0 +1,122 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Tests for the local file source."""
+import pytest
+from sources import local_file
+from utils import RunResult, ValidationResult
+
+_FILES = {
+    name: [{"id": f"{name}_{i}"} for i in range(5)]
+    for name in ("part_0.csv", "part_1.csv", "part_2.csv")
+}
+
+
+class _FakeVariable:
+  values = {}
+
+  @classmethod
+  def get(cls, key, default_var=None, deserialize_json=False):
+    return cls.values.get(key, default_var)
+
+  @classmethod
+  def set(cls, key, value, serialize_json=False):
+    cls.values[key] = value
+
+  @classmethod
+  def delete(cls, key):
+    cls.values.pop(key, None)
+
+
+@pytest.fixture
+def source_class(monkeypatch):
+  _FakeVariable.values = {}
+  monkeypatch.setattr(local_file, "Variable", _FakeVariable)
+  monkeypatch.setattr(
+      local_file.Source, "list_drill_files", lambda self, path: sorted(_FILES))
+
+  def get_drill_data(self, path, fields, offset, limit, query_options=None):
+    name = path.split("/")[-1].rstrip("`")
+    if name in self.failing_files:
+      # like DrillMixin, failed queries return no rows
+      return []
+    return _FILES[name][offset:offset + limit]
+
+  def validate_drill(self, path):
+    name = path.split("/")[-1].rstrip("`")
+    return ValidationResult(name not in self.failing_files, [])
+
+  monkeypatch.setattr(local_file.Source, "get_drill_data", get_drill_data)
+  monkeypatch.setattr(local_file.Source, "validate_drill", validate_drill)
+  return local_file.Source
+
+
+def _source(source_class, failing_files=()):
+  source = source_class({"location": "events", "max_parallel_files": 2})
+  source.failing_files = set(failing_files)
+  return source
+
+
+def _read(source, offset):
+  return source.get_data(["id"], offset, 4, None, None)
+
+
+def test_failed_run_resumes_from_acknowledged_checkpoints(source_class):
+  source = _source(source_class)
+  first_batch = _read(source, 0)
+  source.acknowledge(RunResult(successful_hits=4))
+  # the run fails before the next batch is acknowledged
+  _read(source, 4)
+  source.close()
+
+  source = _source(source_class)
+  rows = []
+  offset = 0
+  while batch := _read(source, offset):
+    rows += batch
+    source.acknowledge(RunResult(successful_hits=len(batch)))
+    offset += 4
+
+  all_ids = sorted(row["id"] for rows_ in _FILES.values() for row in rows_)
+  assert sorted(row["id"] for row in first_batch + rows) == all_ids
+  assert not _FakeVariable.values
+
+
+def test_unreadable_file_fails_the_run(source_class):
+  source = _source(source_class, failing_files=["part_1.csv"])
+
+  with pytest.raises(RuntimeError):
+    offset = 0
+    while _read(source, offset):
+      offset += 4
+
+  assert source._partition_reader._executor._shutdown
+
+
+@pytest.mark.parametrize("file_names,expected_estimate", [
+    (["part_0.csv", "part_1.csv"], None),
+    (["part_0.parquet", "part_1.parquet"], 42),
+])
+def test_rows_are_only_counted_from_parquet_metadata(
+    monkeypatch, file_names, expected_estimate
+):
+  monkeypatch.setattr(
+      local_file.Source, "list_drill_files", lambda self, path: file_names)
+  monkeypatch.setattr(
+      local_file.Source, "count_drill_rows", lambda self, path: 42)
+  source = local_file.Source({"location": "events"})
+
+  assert source.estimate_total_rows(None) == expected_estimate
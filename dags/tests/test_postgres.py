@@ -0,0 +1,157 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Tests for the Postgres source."""
+import psycopg2
+import pytest
+from sources import postgres
+from utils import QueryOptions
+
+_CONFIG = {
+    "database": "db",
+    "user": "user",
+    "password": "password",
+    "table": "events",
+}
+
+_ROWS = [(f"client_{i}", i) for i in range(10)]
+
+
+class _FakeCursor:
+  def __init__(self, conn, name):
+    self._conn = conn
+    self.name = name
+    self._position = 0
+    self._result = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def execute(self, query, params=None):
+    if isinstance(query, str):
+      self._result = [("client_id",), ("value",)]
+    else:
+      self._conn.queries.append(query.as_string(self._conn))
+
+  def fetchall(self):
+    return self._result
+
+  def scroll(self, offset):
+    self._conn.scrolls.append(offset)
+    self._position += offset
+
+  def fetchmany(self, size):
+    if self._conn.fail_fetch:
+      raise psycopg2.OperationalError("server closed the connection")
+    rows = _ROWS[self._position:self._position + size]
+    self._position += size
+    return rows
+
+  def close(self):
+    pass
+
+
+class _FakeConnection:
+  def __init__(self):
+    self.queries = []
+    self.scrolls = []
+    self.named_cursors = 0
+    self.fail_fetch = False
+
+  def cursor(self, name=None):
+    self.named_cursors += bool(name)
+    return _FakeCursor(self, name)
+
+  def rollback(self):
+    pass
+
+
+class _FakePool:
+  def __init__(self):
+    self.conn = _FakeConnection()
+    self.checked_out = 0
+    self.discarded = 0
+
+  def getconn(self):
+    self.checked_out += 1
+    return self.conn
+
+  def putconn(self, conn, close=False):
+    self.checked_out -= 1
+    self.discarded += close
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+  fake_pool = _FakePool()
+  monkeypatch.setattr(postgres, "_get_pool", lambda dsn: fake_pool)
+  monkeypatch.setattr(
+      psycopg2.extensions, "quote_ident", lambda name, context: f'"{name}"')
+  return fake_pool
+
+
+def _get_data(source, offset, limit=4):
+  return source.get_data(["client_id", "value"], offset, limit, None, None)
+
+
+def test_cursor_is_reused_across_batches(fake_pool):
+  source = postgres.Source(_CONFIG)
+
+  batches = [_get_data(source, offset) for offset in (0, 4, 8, 12)]
+
+  assert [len(batch) for batch in batches] == [4, 4, 2, 0]
+  assert batches[1][0] == {"client_id": "client_4", "value": 4}
+  assert fake_pool.conn.named_cursors == 1
+  assert fake_pool.conn.scrolls == []
+  assert fake_pool.checked_out == 0
+
+
+def test_resumed_run_scrolls_to_offset(fake_pool):
+  source = postgres.Source(_CONFIG)
+
+  batch = _get_data(source, 6)
+
+  assert fake_pool.conn.scrolls == [6]
+  assert [row["value"] for row in batch] == [6, 7, 8, 9]
+
+
+def test_connection_filters_are_the_where_clause(fake_pool):
+  source = postgres.Source(_CONFIG)
+  query_options = QueryOptions.from_connection(
+      {"filters": [{"column": "value", "operator": "is not null"}]})
+
+  source.get_data(["client_id", "value"], 0, 4, None, query_options)
+
+  assert fake_pool.conn.queries == [
+      'SELECT "client_id", "value" FROM "public"."events" WHERE "value" IS NOT NULL'
+  ]
+
+
+def test_close_releases_connection_of_failed_run(fake_pool):
+  source = postgres.Source(_CONFIG)
+  _get_data(source, 0)
+  assert fake_pool.checked_out == 1
+
+  source.close()
+  assert fake_pool.checked_out == 0
+
+  fake_pool.conn.fail_fetch = True
+  with pytest.raises(psycopg2.OperationalError):
+    _get_data(source, 0)
+  assert fake_pool.checked_out == 0
@@ -0,0 +1,113 @@
+"""
+ Copyright 2023 Google LLC
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+      https://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+ """
+
+"""Tests for the Redis Streams source."""
+import pytest
+from sources.redis_stream import Source
+from utils import RunResult
+
+fakeredis = pytest.importorskip("fakeredis")
+
+_CONFIG = {"stream": "events", "max_wait_seconds": 0.1}
+
+
+@pytest.fixture
+def client():
+  return fakeredis.FakeRedis(decode_responses=True)
+
+
+def _source(client):
+  source = Source(_CONFIG)
+  source.client = client
+  return source
+
+
+def _get_data(source, offset=0):
+  return source.get_data(["client_id"], offset, 10, None, None)
+
+
+def _pending(client):
+  return client.xpending("events", "tightlock")["pending"]
+
+
+def test_successful_batches_are_acknowledged(client):
+  for i in range(3):
+    client.xadd("events", {"client_id": str(i)})
+  source = _source(client)
+
+  rows = _get_data(source)
+  source.acknowledge(RunResult(successful_hits=3))
+
+  assert rows == [{"client_id": "0"}, {"client_id": "1"}, {"client_id": "2"}]
+  assert _pending(client) == 0
+
+
+def test_failed_batches_are_delivered_again(client):
+  for i in range(3):
+    client.xadd("events", {"client_id": str(i)})
+  source = _source(client)
+
+  _get_data(source)
+  source.acknowledge(RunResult(successful_hits=2, failed_hits=1))
+
+  assert _pending(client) == 3
+  # the next run replays the pending entries
+  next_source = _source(client)
+  assert len(_get_data(next_source)) == 3
+  next_source.acknowledge(RunResult(successful_hits=3))
+  assert _pending(client) == 0
+
+
+def test_only_failed_rows_are_delivered_again(client):
+  for i in range(3):
+    client.xadd("events", {"client_id": str(i)})
+  source = _source(client)
+
+  _get_data(source)
+  source.acknowledge(
+      RunResult(successful_hits=2, failed_hits=1, failed_indices=[1]))
+
+  assert _pending(client) == 1
+  assert _get_data(_source(client)) == [{"client_id": "1"}]
+
+
+def test_entries_delivered_too_often_are_dead_lettered(client):
+  client.xadd("events", {"client_id": "0"})
+  source = Source(dict(_CONFIG, max_deliveries=2))
+  source.client = client
+
+  deliveries = 0
+  while _get_data(source):
+    deliveries += 1
+    source.acknowledge(
+        RunResult(failed_hits=1, failed_indices=[0]))
+
+  assert deliveries == 2
+  assert _pending(client) == 0
+  [(_, values)] = client.xrange("events:dead_letter")
+  assert values["client_id"] == "0"
+
+
+def test_trimmed_pending_entries_are_acknowledged(client):
+  entry_ids = [client.xadd("events", {"client_id": str(i)}) for i in range(3)]
+  source = _source(client)
+  _get_data(source)
+  client.xdel("events", *entry_ids[:2])
+
+  rows = _get_data(_source(client))
+
+  assert rows == [{"client_id": "2"}]
+  assert _pending(client) == 1
@@ -16,7 +16,21 @@
 
 """Test utility methods."""
 
-from dags.utils import DrillMixin 
+import datetime
+import threading
+from http import server
+from types import SimpleNamespace
+
+import grpc
+import psycopg2
+import pytest
+from dags import utils
+from dags.utils import (CustomerBuffer, CustomerBufferMixin, DrillMixin,
+                        GoogleAdsClientCache,
+                        GoogleAdsUtils, HashingUtils, ProgressTracker,
+                        HttpTransport, OAuthTokenCache, QueryOptions,
+                        RateLimiter, RunResult, SharedRateLimiter)
+from google.ads.googleads.errors import GoogleAdsException
 
 def test_parse_data():
   drill_mixin = DrillMixin()
@@ -24,3 +38,484 @@ def test_parse_data():
   test_rows = [("abc", 1), ("cde", 2)]
   result = drill_mixin._parse_data(test_fields, test_rows)
   assert {"str_field": "cde", "int_field": 2} in result
+
+
+def test_query_options_compile():
+  query_options = QueryOptions.from_connection({
+      "field_mappings": {
+          "client_id": "cid",
+          "value": {"source": "revenue", "cast": "DOUBLE"}
+      },
+      "filters": [
+          {"column": "event_name", "operator": "in", "value": ["purchase", "it's"]},
+          {"column": "revenue", "operator": ">", "value": 0},
+      ]
+  })
+  column = lambda name: f"t.`{name}`"
+  alias = lambda name: f"`{name}`"
+  select_list = query_options.build_select_list(
+      ["client_id", "value", "event_name"], column, alias)
+  where_clause = query_options.build_where_clause(
+      column, QueryOptions.sql_literal)
+  assert select_list == (
+      "t.`cid` AS `client_id`, CAST(t.`revenue` AS DOUBLE) AS `value`,"
+      " t.`event_name`")
+  assert where_clause == (
+      "t.`event_name` IN ('purchase', 'it''s') AND t.`revenue` > 0")
+
+
+@pytest.mark.parametrize(
+    "connection",
+    [
+        {"field_mappings": {"value": "revenue; DROP TABLE t"}},
+        {"field_mappings": {"value": {"source": "revenue", "cast": "INT); --"}}},
+        {"filters": [{"column": "revenue", "operator": "OR 1=1 --", "value": 0}]},
+        {"filters": [{"column": "event_name", "operator": "IN", "value": "a"}]},
+    ]
+)
+def test_query_options_rejects_invalid_options(connection):
+  with pytest.raises(ValueError):
+    QueryOptions.from_connection(connection)
+
+
+def test_progress_tracker_publishes_eta():
+  published = []
+  tracker = ProgressTracker(published.append, total_rows=100)
+  tracker.progress.started_at -= 10  # pretend the run started 10s ago
+  tracker.update(25)
+  assert tracker.progress.eta_seconds == pytest.approx(30, rel=0.01)
+  tracker.finish()
+  progress = published[-1]
+  assert progress.rows_done == 25
+  assert progress.batches_done == 1
+  assert progress.done
+
+
+class _FakeRpcError:
+  def code(self):
+    return grpc.StatusCode.INTERNAL
+
+
+def test_send_requests_per_customer_remaps_failures():
+  def send_request(customer_id, items):
+    if customer_id == "broken":
+      raise GoogleAdsException(_FakeRpcError(), None, None, None)
+    # the second item of every request fails
+    return {1: f"failed {items[1]}"}
+
+  successful, failed = GoogleAdsUtils().send_requests_per_customer(
+      send_request,
+      {
+          "a": [(0, "a0"), (2, "a1"), (4, "a2")],
+          "b": [(1, "b0"), (3, "b1")],
+          "broken": [(5, "c0")],
+      },
+      max_concurrent_requests=2,
+  )
+
+  assert sorted(successful) == [0, 1, 4]
+  assert sorted(failed) == [(2, "failed a1"), (3, "failed b1"), (5, "INTERNAL")]
+
+
+def test_customer_buffer_releases_full_requests():
+  buffer = CustomerBuffer(
+      request_size=2, max_buffered_items=10, max_buffer_seconds=3600
+  )
+
+  ready = buffer.add({"a": [(0, "a0")], "b": [(1, "b0"), (2, "b1"), (3, "b2")]})
+  assert ready == {"b": [(1, "b0"), (2, "b1")]}
+  ready = buffer.add({"a": [(4, "a1")]})
+  assert ready == {"a": [(0, "a0"), (4, "a1")]}
+  assert len(buffer) == 1
+  assert buffer.drain() == {"b": [(3, "b2")]}
+  assert len(buffer) == 0
+
+
+def test_run_results_add_up_failed_indices():
+  known = RunResult(successful_hits=1, failed_hits=1, failed_indices=[1])
+  successful = RunResult(successful_hits=2)
+  unknown = RunResult(failed_hits=1)
+
+  assert (known + successful + known).failed_indices == [1, 1]
+  assert (known + unknown).failed_indices is None
+
+
+class _BufferedDestination(CustomerBufferMixin):
+  def __init__(self):
+    self._utils = GoogleAdsUtils()
+    self._init_customer_buffer({"max_concurrent_requests": 1}, 2)
+    self.requests = []
+
+  def _send_request(self, customer_id, items):
+    self.requests.append((customer_id, items))
+    return {}
+
+
+def test_customer_buffer_mixin_offsets_indices_per_run():
+  destination = _BufferedDestination()
+
+  successful, _ = destination._buffer_and_send({"a": [(1, "a0")]}, 2)
+  assert successful == []
+  successful, _ = destination._buffer_and_send({"a": [(0, "a1")]}, 1)
+  # indices of the second batch are offset by the rows of the first one
+  assert successful == [1, 2]
+  destination._buffer_and_send({"b": [(0, "b0")]}, 1)
+  assert destination.telemetry() == {"buffered_rows": 1}
+  # e.g. rows of the next batch failing validation
+  assert destination._run_indexed([(0, "error")]) == [(4, "error")]
+  assert destination.flush(dry_run=False).successful_hits == 1
+  assert destination.telemetry() == {"buffered_rows": 0}
+
+  # the rows of a new run are indexed from the start again
+  destination._buffer_and_send({"b": [(0, "b1"), (1, "b2")]}, 2)
+  assert destination.requests[-1] == ("b", ["b1", "b2"])
+  assert destination._rows_seen == 2
+
+
+class _FakeConversionActionService:
+  def conversion_action_path(self, customer_id, conversion_action_id):
+    return f"customers/{customer_id}/conversionActions/{conversion_action_id}"
+
+
+class _FakeClickConversion:
+  pass
+
+
+class _FakeGoogleAdsClient:
+  def __init__(self):
+    self.calls = []
+
+  def get_service(self, name):
+    self.calls.append(name)
+    return _FakeConversionActionService()
+
+  def get_type(self, name):
+    self.calls.append(name)
+    return _FakeClickConversion()
+
+
+def test_google_ads_client_cache_reuses_services_and_types():
+  client = _FakeGoogleAdsClient()
+  cache = GoogleAdsClientCache(client)
+
+  messages = [cache.get_type("ClickConversion") for _ in range(3)]
+  paths = [cache.conversion_action_path("123", "456") for _ in range(3)]
+  cache.conversion_action_path("123", "789")
+
+  assert all(isinstance(m, _FakeClickConversion) for m in messages)
+  assert len({id(m) for m in messages}) == 3  # new message per call
+  assert paths == ["customers/123/conversionActions/456"] * 3
+  assert client.calls == ["ClickConversion", "ConversionActionService"]
+
+
+@pytest.mark.parametrize("min_parallel_values", [1000, 1])
+def test_hash_columns_matches_single_value_hashing(monkeypatch, min_parallel_values):
+  monkeypatch.setattr(utils.os, "cpu_count", lambda: 2)
+  monkeypatch.setattr(utils, "_HASHING_CHUNK_SIZE", 2)
+  rows = [
+      {"email": " First.Last@GMail.com", "phone": "+1 555 0100 "},
+      {"email": "first.last@example.com", "phone": ""},
+      {"email": None, "phone": "+1 555 0101"},
+  ]
+
+  hashing = HashingUtils(min_parallel_values=min_parallel_values)
+  hashed_rows = hashing.hash_columns(
+      rows, {"email": HashingUtils.EMAIL, "phone": HashingUtils.TEXT})
+  hashing.close()
+  assert hashing._pool is None
+
+  google_ads_utils = GoogleAdsUtils()
+  assert hashed_rows == [
+      {
+          "email": google_ads_utils.normalize_and_hash("firstlast@gmail.com"),
+          "phone": google_ads_utils.normalize_and_hash("+1 555 0100"),
+      },
+      {
+          "email": google_ads_utils.normalize_and_hash("first.last@example.com"),
+          "phone": "",
+      },
+      {
+          "email": None,
+          "phone": google_ads_utils.normalize_and_hash("+1 555 0101"),
+      },
+  ]
+  assert rows[0]["email"] == " First.Last@GMail.com"  # input rows are copied
+
+
+def test_hash_columns_detects_hashed_columns():
+  google_ads_utils = GoogleAdsUtils()
+  digest = google_ads_utils.normalize_and_hash("user@example.com")
+  rows = [{"email": digest, "phone": digest}] * 3 + [
+      {"email": "Other@Example.com", "phone": "Other@Example.com"}
+  ]
+  columns = {"email": HashingUtils.EMAIL, "phone": HashingUtils.TEXT}
+
+  auto_rows = HashingUtils().hash_columns(rows, columns)
+  modes_rows = HashingUtils({"email": "raw", "phone": "hashed"}).hash_columns(
+      rows, columns)
+
+  # raw values of a detected column are still hashed
+  other_digest = google_ads_utils.normalize_and_hash("other@example.com")
+  assert [r["email"] for r in auto_rows] == [digest] * 3 + [other_digest]
+  assert modes_rows[0]["email"] == google_ads_utils.normalize_and_hash(digest)
+  assert [r["phone"] for r in modes_rows] == [r["phone"] for r in rows]
+
+
+def test_hash_columns_detects_uppercase_digests():
+  digest = GoogleAdsUtils().normalize_and_hash("user@example.com")
+  rows = [{"email": digest.upper()}] * 2 + [{"email": digest}]
+
+  auto_rows = HashingUtils().hash_columns(rows, {"email": HashingUtils.EMAIL})
+  hashed_rows = HashingUtils({"email": "hashed"}).hash_columns(
+      rows, {"email": HashingUtils.EMAIL})
+
+  assert [r["email"] for r in auto_rows] == [digest] * 3
+  assert [r["email"] for r in hashed_rows] == [digest] * 3
+
+
+def test_hash_values_memoizes_repeated_values():
+  hashing = HashingUtils(max_cached_values=4)
+
+  first = hashing.hash_values(["a", "b", "a", "c"])
+  second = hashing.hash_values(["a", "d", "e"])
+
+  assert first[0] == first[2] == second[0]
+  assert second[1] == GoogleAdsUtils().normalize_and_hash("d")
+  # the repeated "a" of the first batch is hashed once, then is a cache hit
+  assert hashing.stats() == {
+      "hash_cache_hits": 2, "hash_cache_misses": 5, "hash_cache_size": 3,
+  }
+
+
+def test_rate_limiter_spaces_out_calls(monkeypatch):
+  now = [100.0]
+  sleeps = []
+  monkeypatch.setattr(utils.time, "monotonic", lambda: now[0])
+  monkeypatch.setattr(utils.time, "sleep", sleeps.append)
+  rate_limiter = RateLimiter(4)
+
+  for _ in range(3):
+    rate_limiter.acquire()
+
+  assert sleeps == [0.25, 0.5]
+
+
+class _FakeRateLimitConnection:
+  """Connection to a fake rate_limits table, whose clock is frozen at 0."""
+
+  def __init__(self, next_call_times):
+    self._next_call_times = next_call_times
+    self._result = None
+    self.autocommit = False
+
+  def cursor(self):
+    return self
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def execute(self, query, params=None):
+    if query.startswith("INSERT"):
+      key, interval = params["key"], params["interval"]
+      next_call_time = max(self._next_call_times.get(key, 0.0), 0.0) + interval
+      self._next_call_times[key] = next_call_time
+      self._result = (next_call_time - interval,)
+
+  def fetchone(self):
+    return self._result
+
+  def close(self):
+    pass
+
+
+def test_shared_rate_limiter_spaces_out_calls_across_processes(monkeypatch):
+  next_call_times = {}
+  monkeypatch.setattr(
+      utils, "PostgresHook",
+      lambda postgres_conn_id: SimpleNamespace(
+          get_conn=lambda: _FakeRateLimitConnection(next_call_times)))
+  sleeps = []
+  monkeypatch.setattr(utils.time, "sleep", sleeps.append)
+  # e.g. the limiters of two tasks running on different workers
+  rate_limiters = [SharedRateLimiter("profile", 4) for _ in range(2)]
+
+  for rate_limiter in rate_limiters * 2:
+    rate_limiter.acquire()
+  SharedRateLimiter("other profile", 4).acquire()
+
+  assert sleeps == [0.25, 0.5, 0.75]
+
+
+def test_shared_rate_limiter_falls_back_to_local_spacing(monkeypatch):
+  now = [100.0]
+  sleeps = []
+  monkeypatch.setattr(utils.time, "monotonic", lambda: now[0])
+  monkeypatch.setattr(utils.time, "sleep", sleeps.append)
+
+  def unavailable(postgres_conn_id):
+    raise psycopg2.OperationalError("database unavailable")
+
+  monkeypatch.setattr(utils, "PostgresHook", unavailable)
+  rate_limiter = SharedRateLimiter("profile", 4)
+
+  for _ in range(3):
+    rate_limiter.acquire()
+
+  assert sleeps == [0.25, 0.5]
+
+
+class _ThrottlingHandler(server.BaseHTTPRequestHandler):
+  """Throttles (or, for /unavailable paths, fails) the first request of each
+  path, then answers it."""
+
+  throttled_paths = set()
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    self.rfile.read(int(self.headers["Content-Length"]))
+    self.do_GET()
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    if self.path not in self.throttled_paths:
+      self.throttled_paths.add(self.path)
+      self.send_response(503 if self.path.startswith("/unavailable") else 429)
+      self.send_header("Retry-After", "0")
+      self.send_header("Content-Length", "0")
+      self.end_headers()
+      return
+    body = b'{"ok": true}'
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+def test_http_transport_retries_throttled_requests():
+  _ThrottlingHandler.throttled_paths = set()
+  httpd = server.ThreadingHTTPServer(("127.0.0.1", 0), _ThrottlingHandler)
+  threading.Thread(target=httpd.serve_forever, daemon=True).start()
+  url = f"http://127.0.0.1:{httpd.server_port}"
+  transport = HttpTransport()
+  observed_statuses = []
+  transport.add_metrics_hook(
+      lambda method, url, status, seconds: observed_statuses.append(status))
+
+  try:
+    response = transport.post(f"{url}/requests", data=b"{}")
+    httplib2_response, content = transport.httplib2_adapter().request(
+        f"{url}/httplib2", "POST", body=b"{}")
+  finally:
+    httpd.shutdown()
+    httpd.server_close()
+
+  assert response.json() == {"ok": True}
+  assert httplib2_response.status == 200
+  assert content == b'{"ok": true}'
+  assert observed_statuses == [200, 200]
+  stats = transport.stats()
+  assert (stats["http_requests"], stats["http_retries"]) == (2, 2)
+
+
+def test_http_transport_retries_only_idempotent_failures():
+  _ThrottlingHandler.throttled_paths = set()
+  httpd = server.ThreadingHTTPServer(("127.0.0.1", 0), _ThrottlingHandler)
+  threading.Thread(target=httpd.serve_forever, daemon=True).start()
+  url = f"http://127.0.0.1:{httpd.server_port}"
+  transport = HttpTransport()
+
+  try:
+    statuses = [
+        # a POST may have been processed by the failing server
+        transport.post(f"{url}/unavailable/post", data=b"{}").status_code,
+        transport.request("GET", f"{url}/unavailable/get").status_code,
+        # idempotent POSTs are opted into 5xx retries
+        transport.post(f"{url}/unavailable/idempotent", data=b"{}",
+                       idempotent=True).status_code,
+        # callers retrying on their own get the throttled response back
+        transport.post(
+            f"{url}/throttled", data=b"{}", retry=False).status_code,
+    ]
+  finally:
+    httpd.shutdown()
+    httpd.server_close()
+
+  assert statuses == [503, 200, 200, 429]
+  assert transport.stats()["http_retries"] == 2
+
+
+class _FakeTokenConnection:
+  """Connection to a fake oauth_token_cache table."""
+
+  def __init__(self, rows):
+    self._rows = rows
+    self._result = None
+    self.queries = []
+
+  def cursor(self):
+    return self
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def execute(self, query, params=None):
+    self.queries.append(query.split(" (")[0])
+    if query.startswith("SELECT access_token"):
+      self._result = self._rows.get(params[0])
+    elif query.startswith("INSERT"):
+      self._rows[params[0]] = (params[1], params[2])
+
+  def fetchone(self):
+    return self._result
+
+  def commit(self):
+    pass
+
+  def rollback(self):
+    pass
+
+  def close(self):
+    pass
+
+
+def test_oauth_token_cache_shares_valid_tokens(monkeypatch):
+  rows = {}
+  connections = []
+
+  def get_conn(self):
+    connections.append(_FakeTokenConnection(rows))
+    return connections[-1]
+
+  monkeypatch.setattr(
+      utils, "PostgresHook",
+      lambda postgres_conn_id: type("Hook", (), {"get_conn": get_conn})())
+  now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+  refreshes = []
+
+  def refresh(expires_in):
+    refreshes.append(expires_in)
+    return f"token_{len(refreshes)}", now + expires_in
+
+  cache = OAuthTokenCache()
+  key = cache._key("client_id", "refresh_token")
+  tokens = [
+      cache._get_or_refresh(key, lambda: refresh(datetime.timedelta(minutes=2)))[0],
+      # about to expire, hence refreshed
+      cache._get_or_refresh(key, lambda: refresh(datetime.timedelta(hours=1)))[0],
+      cache._get_or_refresh(key, lambda: refresh(datetime.timedelta(hours=1)))[0],
+  ]
+
+  assert tokens == ["token_1", "token_2", "token_2"]
+  assert len(refreshes) == 2
+  # the connection (and table) is set up once
+  assert len(connections) == 1
+  assert connections[0].queries.count(
+      "CREATE TABLE IF NOT EXISTS oauth_token_cache") == 1
+  assert "refresh_token" not in str(rows)
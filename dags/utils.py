@@ -16,23 +16,77 @@ limitations under the License."""
 """Utility functions for DAGs."""
 
 from collections import defaultdict
+import datetime
+import enum
 import importlib
+import itertools
+import multiprocessing
 import os
 import pathlib
+import random
 import sys
+import tempfile
+import threading
 import re
 import hashlib
+import time
 import traceback
+from concurrent import futures
 from dataclasses import dataclass, field
-from typing import Any, List, Dict, Mapping, Sequence, Tuple
+from typing import (Any, Callable, Dict, Iterable, List, Mapping, Optional,
+                    Sequence, Tuple)
 
+from airflow.hooks.postgres_hook import PostgresHook
 from airflow.providers.apache.drill.hooks.drill import DrillHook
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from google.ads.googleads.client import GoogleAdsClient
+from google.ads.googleads.errors import GoogleAdsException
+import google.oauth2.credentials
+import httplib2
+import psycopg2
+import requests
+from googleapiclient import discovery
+from googleapiclient.discovery_cache.base import Cache
+from googleapiclient.errors import HttpError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 _TABLE_ALIAS = "t"
 _DEFAULT_GOOGLE_ADS_API_VERSION = "v14"
 
+# Minimum interval between two progress publications of a running connection.
+_PROGRESS_PUBLISH_INTERVAL_SECONDS = 5
+
+_FILTER_OPERATORS = frozenset([
+  "=", "!=", "<>", "<", "<=", ">", ">=",
+  "IN", "NOT IN", "LIKE", "IS NULL", "IS NOT NULL"])
+_IDENTIFIER_REGEX = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_CAST_TYPE_REGEX = re.compile(r"^[A-Za-z][A-Za-z0-9_ ]*(\(\d+(,\s*\d+)?\))?$")
+
+_GMAIL_DOMAIN_REGEX = re.compile(r"^(gmail|googlemail)\.com$")
+
+# Columns with fewer values than this are hashed in the calling process, as
+# shipping them to the process pool costs more than hashing them.
+_MIN_PARALLEL_HASHING_VALUES = 20000
+# Workers of the hashing process pool, which shares the host with other tasks.
+_MAX_HASHING_WORKERS = 4
+_HASHING_CHUNK_SIZE = 10000
+# Values sampled per column to detect columns of already hashed identifiers.
+_HASH_DETECTION_SAMPLE_SIZE = 100
+_SHA256_HEX_REGEX = re.compile(r"^[0-9a-f]{64}$", re.IGNORECASE)
+# Distinct values whose hashes are memoized by a HashingUtils instance.
+_DEFAULT_MAX_CACHED_HASHES = 100000
+
+# Discovery documents fetched remotely are cached on disk for this long.
+_DISCOVERY_CACHE_DIR = pathlib.Path(tempfile.gettempdir()) / "tightlock_discovery"
+_DISCOVERY_CACHE_MAX_AGE_SECONDS = 24 * 60 * 60
+
+GOOGLE_OAUTH_TOKEN_URI = "https://oauth2.googleapis.com/token"
+_OAUTH_TOKEN_TABLE = "oauth_token_cache"
+# Shared access tokens are only reused while valid for at least this long.
+_OAUTH_TOKEN_MIN_VALIDITY = datetime.timedelta(minutes=5)
+_RATE_LIMIT_TABLE = "rate_limits"
+
 _REQUIRED_GOOGLE_ADS_CREDENTIALS = frozenset([
   "client_id",
   "client_secret",
@@ -59,19 +113,243 @@ class ValidationResult:
 
 @dataclass
 class RunResult:
-  """Class for reporting the result of a DAG run."""
+  """Class for reporting the result of a DAG run.
+
+  failed_indices, when reported by the destination, are the positions of the
+  failed rows in the input of send_data (for destinations buffering rows
+  across batches, see flush, in the rows of the run). They are None when the
+  failed rows are not known.
+  """
 
   successful_hits: int = 0
   failed_hits: int = 0
   error_messages: Sequence[str] = field(default_factory=lambda: [])
   dry_run: bool = False
+  failed_indices: Optional[Sequence[int]] = None
 
   def __add__(self, other: "RunResult") -> "RunResult":
     sh = self.successful_hits + other.successful_hits
     fh = self.failed_hits + other.failed_hits
     em = self.error_messages + other.error_messages
     dr = self.dry_run or other.dry_run
-    return RunResult(sh, fh, em, dr)
+    if any(result.failed_hits and result.failed_indices is None
+           for result in (self, other)):
+      fi = None
+    else:
+      fi = [*(self.failed_indices or []), *(other.failed_indices or [])]
+    return RunResult(sh, fh, em, dr, fi)
+
+
+@dataclass
+class FieldMapping:
+  """Maps a destination field to a source column, optionally casting it."""
+
+  source: str
+  cast: Optional[str] = None
+
+
+@dataclass
+class RowFilter:
+  """A row filter condition on a source column."""
+
+  column: str
+  operator: str
+  value: Any = None
+
+
+@dataclass
+class QueryOptions:
+  """Connection-level field mappings and row filters.
+
+  Sources compile these options into the query they run, so unneeded rows
+  and columns never leave the underlying storage. Connections define them as:
+
+    "field_mappings": {
+      "client_id": "cid",
+      "value": {"source": "revenue", "cast": "DOUBLE"}
+    },
+    "filters": [
+      {"column": "event_name", "operator": "IN", "value": ["purchase"]},
+      {"column": "revenue", "operator": ">", "value": 0}
+    ]
+
+  Mapping keys are destination fields and filters refer to source columns.
+  """
+
+  field_mappings: Mapping[str, FieldMapping] = field(default_factory=dict)
+  filters: Sequence[RowFilter] = field(default_factory=list)
+
+  @classmethod
+  def from_connection(cls, connection: Mapping[str, Any]) -> "QueryOptions":
+    """Parses and validates the query options of a connection config.
+
+    Raises:
+      ValueError: If a mapping or filter is malformed.
+    """
+    field_mappings = {}
+    for target, mapping in (connection.get("field_mappings") or {}).items():
+      if isinstance(mapping, str):
+        mapping = FieldMapping(source=mapping)
+      else:
+        mapping = FieldMapping(**mapping)
+      for name in (target, mapping.source):
+        QueryOptions._check_identifier(name)
+      if mapping.cast and not _CAST_TYPE_REGEX.match(mapping.cast):
+        raise ValueError(f"Invalid cast type: {mapping.cast}")
+      field_mappings[target] = mapping
+
+    filters = []
+    for row_filter in connection.get("filters") or []:
+      row_filter = RowFilter(**row_filter)
+      QueryOptions._check_identifier(row_filter.column)
+      row_filter.operator = row_filter.operator.strip().upper()
+      if row_filter.operator not in _FILTER_OPERATORS:
+        raise ValueError(f"Unsupported filter operator: {row_filter.operator}")
+      if (row_filter.operator in ("IN", "NOT IN")
+          and not isinstance(row_filter.value, (list, tuple))):
+        raise ValueError(f"Filter operator {row_filter.operator} requires a list value.")
+      filters.append(row_filter)
+
+    return cls(field_mappings, filters)
+
+  @staticmethod
+  def _check_identifier(name: str) -> None:
+    if not _IDENTIFIER_REGEX.match(name):
+      raise ValueError(f"Invalid column name: {name}")
+
+  @staticmethod
+  def sql_literal(value: Any) -> str:
+    """Renders a value as an inline SQL literal (for engines without bind params)."""
+    if value is None:
+      return "NULL"
+    if isinstance(value, bool):
+      return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+      return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+  def source_column(self, target: str) -> str:
+    """Returns the source column that feeds the provided destination field."""
+    mapping = self.field_mappings.get(target)
+    return mapping.source if mapping else target
+
+  def build_select_list(
+      self, fields: Sequence[str], column: Callable[[str], str],
+      alias: Callable[[str], str]) -> str:
+    """Builds the projection for the destination fields.
+
+    Args:
+      fields: The destination fields, in order.
+      column: Renders a (quoted) source column reference.
+      alias: Renders a (quoted) output column alias.
+    """
+    select_list = []
+    for target in fields:
+      mapping = self.field_mappings.get(target)
+      if mapping is None:
+        select_list.append(column(target))
+        continue
+      expression = column(mapping.source)
+      if mapping.cast:
+        expression = f"CAST({expression} AS {mapping.cast})"
+      select_list.append(f"{expression} AS {alias(target)}")
+    return ", ".join(select_list)
+
+  def build_where_clause(
+      self, column: Callable[[str], str], literal: Callable[[Any], str]) -> str:
+    """Builds the conjunction of all filters, or an empty string.
+
+    Args:
+      column: Renders a (quoted) source column reference.
+      literal: Renders a value, either inline or as a bind parameter.
+    """
+    conditions = []
+    for row_filter in self.filters:
+      target = column(row_filter.column)
+      operator = row_filter.operator
+      if operator in ("IS NULL", "IS NOT NULL"):
+        conditions.append(f"{target} {operator}")
+      elif operator in ("IN", "NOT IN"):
+        values = ", ".join(literal(v) for v in row_filter.value)
+        conditions.append(f"{target} {operator} ({values})")
+      else:
+        conditions.append(f"{target} {operator} {literal(row_filter.value)}")
+    return " AND ".join(conditions)
+
+
+@dataclass
+class RunProgress:
+  """Class for reporting the progress of a running DAG."""
+
+  rows_done: int = 0
+  batches_done: int = 0
+  total_rows: Optional[int] = None
+  rows_per_second: float = 0.0
+  eta_seconds: Optional[float] = None
+  started_at: float = 0.0
+  updated_at: float = 0.0
+  done: bool = False
+  # counters reported by the destination (see DestinationProto)
+  telemetry: Dict[str, Any] = field(default_factory=dict)
+
+
+class ProgressTracker:
+  """Tracks the progress of a run and periodically publishes it.
+
+  Args:
+    publish: Callable that stores a RunProgress somewhere readable while the
+      run is still going (e.g. an XCom).
+    total_rows: Optional estimate of the number of rows of the run.
+  """
+
+  def __init__(
+      self,
+      publish: Callable[[RunProgress], None],
+      total_rows: Optional[int] = None,
+  ):
+    now = time.time()
+    self._publish = publish
+    self._last_published_at = 0.0
+    self.progress = RunProgress(
+        total_rows=total_rows, started_at=now, updated_at=now
+    )
+    self._publish_progress(force=True)
+
+  def _publish_progress(self, force: bool = False) -> None:
+    now = time.time()
+    if force or now - self._last_published_at >= _PROGRESS_PUBLISH_INTERVAL_SECONDS:
+      try:
+        self._publish(self.progress)
+      except Exception:  # pylint: disable=broad-except
+        # progress is informative only and must never fail a run
+        print(f"Progress publication error: {traceback.format_exc()}")
+      self._last_published_at = now
+
+  def update(
+      self, rows: int, telemetry: Optional[Mapping[str, Any]] = None
+  ) -> None:
+    """Records a processed batch with the provided number of rows."""
+    progress = self.progress
+    if telemetry is not None:
+      progress.telemetry = dict(telemetry)
+    progress.rows_done += rows
+    progress.batches_done += 1
+    progress.updated_at = time.time()
+    elapsed = progress.updated_at - progress.started_at
+    if elapsed > 0:
+      progress.rows_per_second = progress.rows_done / elapsed
+    if progress.total_rows is not None and progress.rows_per_second > 0:
+      remaining_rows = max(progress.total_rows - progress.rows_done, 0)
+      progress.eta_seconds = remaining_rows / progress.rows_per_second
+    self._publish_progress()
+
+  def finish(self, telemetry: Optional[Mapping[str, Any]] = None) -> None:
+    if telemetry is not None:
+      self.progress.telemetry = dict(telemetry)
+    self.progress.done = True
+    self.progress.eta_seconds = 0.0
+    self.progress.updated_at = time.time()
+    self._publish_progress(force=True)
 
 
 class SchemaUtils:
@@ -112,9 +390,136 @@ class DagUtils:
     return modules
 
 
+class CustomerBuffer:
+  """Buffers index-item tuples per customer across the batches of a run.
+
+  Full-size requests are released as soon as a customer has enough items,
+  while remainders are held until the buffer grows over `max_buffered_items`
+  or its oldest item is older than `max_buffer_seconds` (or the run ends, see
+  `drain`), so each customer is uploaded with as few requests as possible.
+
+  Args:
+    request_size: Maximum number of items of a single request.
+    max_buffered_items: Buffered items that trigger a full flush.
+    max_buffer_seconds: Buffering time that triggers a full flush.
+  """
+
+  def __init__(
+      self, request_size: int, max_buffered_items: int, max_buffer_seconds: float
+  ):
+    self._request_size = request_size
+    self._max_buffered_items = max_buffered_items
+    self._max_buffer_seconds = max_buffer_seconds
+    self._buffer = defaultdict(list)
+    self._buffered_items = 0
+    self._buffered_since = None
+
+  def __len__(self) -> int:
+    return self._buffered_items
+
+  def add(
+      self, items_by_customer: Mapping[str, List[Tuple[int, Any]]]
+  ) -> Dict[str, List[Tuple[int, Any]]]:
+    """Buffers items, returning the items of each customer ready to be sent."""
+    for customer_id, indexed_items in items_by_customer.items():
+      self._buffer[customer_id].extend(indexed_items)
+      self._buffered_items += len(indexed_items)
+    if self._buffered_items and self._buffered_since is None:
+      self._buffered_since = time.monotonic()
+
+    if self._buffered_items >= self._max_buffered_items or (
+        self._buffered_since is not None
+        and time.monotonic() - self._buffered_since >= self._max_buffer_seconds
+    ):
+      return self.drain()
+
+    ready = {}
+    for customer_id, indexed_items in self._buffer.items():
+      full_size = len(indexed_items) // self._request_size * self._request_size
+      if full_size:
+        ready[customer_id] = indexed_items[:full_size]
+        self._buffer[customer_id] = indexed_items[full_size:]
+        self._buffered_items -= full_size
+    return ready
+
+  def drain(self) -> Dict[str, List[Tuple[int, Any]]]:
+    """Empties the buffer, returning every buffered item."""
+    ready = {
+        customer_id: indexed_items
+        for customer_id, indexed_items in self._buffer.items()
+        if indexed_items
+    }
+    self._buffer = defaultdict(list)
+    self._buffered_items = 0
+    self._buffered_since = None
+    return ready
+
+
+class GoogleAdsClientCache:
+  """Caches the services, message types and resource paths of a client.
+
+  GoogleAdsClient.get_service builds a new service (and transport) on every
+  call and get_type resolves the message class by name before instantiating
+  it, which dominates the per-row cost of building upload payloads. Services
+  are built once, message classes are resolved once (new messages are fresh
+  instances of the cached class) and resource paths are memoized per ID
+  tuple.
+
+  Args:
+    client: The Google Ads client (proto-plus or raw protobuf).
+  """
+
+  def __init__(self, client: GoogleAdsClient):
+    self._client = client
+    self._services = {}
+    self._message_classes = {}
+    self._resource_paths = {}
+
+  def get_service(self, name: str) -> Any:
+    """Returns the (shared) service of the provided name."""
+    if name not in self._services:
+      self._services[name] = self._client.get_service(name)
+    return self._services[name]
+
+  def get_type(self, name: str) -> Any:
+    """Returns a new, empty message of the provided type."""
+    if name not in self._message_classes:
+      # the class of a message returned by the client is the proto-plus or the
+      # raw protobuf class, depending on the client's use_proto_plus.
+      self._message_classes[name] = type(self._client.get_type(name))
+    return self._message_classes[name]()
+
+  def conversion_action_path(
+      self, customer_id: str, conversion_action_id: str
+  ) -> str:
+    """Returns the (memoized) resource name of a conversion action."""
+    key = ("conversion_action", customer_id, conversion_action_id)
+    if key not in self._resource_paths:
+      self._resource_paths[key] = self.get_service(
+          "ConversionActionService"
+      ).conversion_action_path(customer_id, conversion_action_id)
+    return self._resource_paths[key]
+
+  def conversion_custom_variable_path(
+      self, customer_id: str, conversion_custom_variable_id: str
+  ) -> str:
+    """Returns the (memoized) resource name of a conversion custom variable."""
+    key = ("conversion_custom_variable", customer_id, conversion_custom_variable_id)
+    if key not in self._resource_paths:
+      self._resource_paths[key] = self.get_service(
+          "ConversionUploadService"
+      ).conversion_custom_variable_path(customer_id, conversion_custom_variable_id)
+    return self._resource_paths[key]
+
+
 class GoogleAdsUtils:
   """Utility functions for Google Ads connectors."""
   PartialFailures = Dict[int, str]
+  IndexedItems = List[Tuple[int, Any]]
+
+  DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+  DEFAULT_MAX_BUFFERED_ROWS = 100000
+  DEFAULT_MAX_BUFFER_SECONDS = 300
 
   def validate_google_ads_config(self, config: dict[str, Any]) -> ValidationResult:
     """Validates the provided config can build a Google Ads client.
@@ -151,6 +556,10 @@ class GoogleAdsUtils:
     - login_customer_id
     - refresh_token
 
+    Messages are proto-plus wrappers unless `use_raw_protobuf` is set in
+    config, in which case get_type returns raw protobuf messages, which are
+    much cheaper to build row by row.
+
     Args:
       config: The Tightlock config file.
       version: (Optional) Version number for Google Ads API prefixed with v.
@@ -162,10 +571,16 @@ class GoogleAdsUtils:
     for credential in _REQUIRED_GOOGLE_ADS_CREDENTIALS:
       credentials[credential] = config.get(credential, "")
 
-    credentials["use_proto_plus"] = True
+    credentials["use_proto_plus"] = not config.get("use_raw_protobuf", False)
 
-    return GoogleAdsClient.load_from_dict(
+    client = GoogleAdsClient.load_from_dict(
       config_dict=credentials, version=version)
+    # Access tokens are shared with the other connections of the same user.
+    client.credentials = OAuthTokenCache.shared().user_credentials(
+      credentials["client_id"],
+      credentials["client_secret"],
+      credentials["refresh_token"])
+    return client
 
   def get_partial_failures(self, client: GoogleAdsClient, response: Any) -> PartialFailures:
     """Checks whether a response message has a partial failure error.
@@ -194,12 +609,7 @@ class GoogleAdsUtils:
     partial_failures = defaultdict(str)
 
     for error_detail in error_details:
-      # Retrieve an instance of the GoogleAdsFailure class from the client
-      failure_message = client.get_type("GoogleAdsFailure")
-      # Parse the string into a GoogleAdsFailure message instance.
-      # To access class-only methods on the message we retrieve its type.
-      GoogleAdsFailure = type(failure_message)
-      failure_object = GoogleAdsFailure.deserialize(error_detail.value)
+      failure_object = self.parse_google_ads_failure(client, error_detail.value)
 
       for error in failure_object.errors:
         index = error.location.field_path_elements[0].index
@@ -210,11 +620,96 @@ class GoogleAdsUtils:
 
     return partial_failures
 
+  def parse_google_ads_failure(self, client: GoogleAdsClient, value: bytes) -> Any:
+    """Parses a serialized GoogleAdsFailure from a partial failure detail.
+
+    Args:
+      client: The client that sent the request (proto-plus or raw protobuf).
+      value: The serialized GoogleAdsFailure message.
+
+    Returns: A GoogleAdsFailure message instance.
+    """
+    # Retrieve an instance of the GoogleAdsFailure class from the client.
+    # To access class-only methods on the message we retrieve its type.
+    GoogleAdsFailure = type(client.get_type("GoogleAdsFailure"))
+    if hasattr(GoogleAdsFailure, "deserialize"):
+      return GoogleAdsFailure.deserialize(value)  # proto-plus
+    return GoogleAdsFailure.FromString(value)  # raw protobuf
+
+  def send_requests_per_customer(
+      self,
+      send_request: Callable[[str, List[Any]], PartialFailures],
+      items_by_customer: Mapping[str, IndexedItems],
+      max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+      max_items_per_request: Optional[int] = None,
+  ) -> Tuple[List[int], IndexedItems]:
+    """Sends the items of each customer in concurrent per-customer requests.
+
+    Requests are dispatched on a bounded thread pool and share the services
+    (and hence the gRPC channel) of the calling destination. Each customer
+    still has a single request in flight (larger item lists are sent in
+    consecutive chunks), so per-customer rate limits are not stressed by the
+    fan out.
+
+    Args:
+      send_request: Sends the items of a customer, returning its partial
+        failures (indexed by position in the request).
+      items_by_customer: Customer IDs mapped to index-item tuples, where the
+        index is the position of the item in the input data.
+      max_concurrent_requests: Maximum number of requests in flight.
+      max_items_per_request: Optional maximum number of items per request.
+
+    Returns:
+      The input indices of the items sent successfully, and a list of
+      index-error for the items that failed.
+    """
+    def send_customer_items(
+        customer_id: str, indexed_items: GoogleAdsUtils.IndexedItems
+    ) -> Tuple[List[int], GoogleAdsUtils.IndexedItems]:
+      successful_indices = []
+      invalid_indices_and_errors = []
+      chunk_size = max_items_per_request or len(indexed_items)
+      for start in range(0, len(indexed_items), chunk_size):
+        chunk = indexed_items[start:start + chunk_size]
+        indices = [index for index, _ in chunk]
+        try:
+          partial_failures = send_request(
+              customer_id, [item for _, item in chunk]
+          )
+        except GoogleAdsException as error:
+          # Set every index as failed
+          err_msg = error.error.code().name
+          invalid_indices_and_errors.extend((index, err_msg) for index in indices)
+          continue
+        for position, index in enumerate(indices):
+          # Maps the position in this customer's request back to the
+          # original input data index.
+          if position in partial_failures:
+            invalid_indices_and_errors.append((index, partial_failures[position]))
+          else:
+            successful_indices.append(index)
+      return successful_indices, invalid_indices_and_errors
+
+    successful_indices = []
+    invalid_indices_and_errors = []
+    with futures.ThreadPoolExecutor(max(1, max_concurrent_requests)) as executor:
+      customer_requests = [
+          executor.submit(send_customer_items, customer_id, indexed_items)
+          for customer_id, indexed_items in items_by_customer.items()
+          if indexed_items
+      ]
+      for customer_request in customer_requests:
+        customer_successes, customer_failures = customer_request.result()
+        successful_indices.extend(customer_successes)
+        invalid_indices_and_errors.extend(customer_failures)
+    return successful_indices, invalid_indices_and_errors
+
   def normalize_and_hash_email_address(self, email_address: str) -> str:
     """Returns the result of normalizing and hashing an email address.
 
     For this use case, Google Ads requires removal of any '.' characters
-    preceding "gmail.com" or "googlemail.com"
+    preceding "gmail.com" or "googlemail.com". Prefer HashingUtils to hash
+    whole columns.
 
     Args:
         email_address: An email address to normalize.
@@ -222,22 +717,7 @@ class GoogleAdsUtils:
     Returns:
         A normalized (lowercase, removed whitespace) and SHA-265 hashed string.
     """
-    normalized_email = email_address.lower()
-    email_parts = normalized_email.split("@")
-    # Checks whether the domain of the email address is either "gmail.com"
-    # or "googlemail.com". If this regex does not match then this statement
-    # will evaluate to None.
-    is_gmail = re.match(r"^(gmail|googlemail)\.com$", email_parts[1])
-
-    # Check that there are at least two segments and the second segment
-    # matches the above regex expression validating the email domain name.
-    if len(email_parts) > 1 and is_gmail:
-        # Removes any '.' characters from the portion of the email address
-        # before the domain if the domain is gmail.com or googlemail.com.
-        email_parts[0] = email_parts[0].replace(".", "")
-        normalized_email = "@".join(email_parts)
-
-    return self.normalize_and_hash(normalized_email)
+    return _sha256(_normalize_email(email_address))
 
 
   def normalize_and_hash(self, s: str) -> str:
@@ -252,7 +732,911 @@ class GoogleAdsUtils:
     Returns:
         A normalized (lowercase, removed whitespace) and SHA-256 hashed string.
     """
-    return hashlib.sha256(s.strip().lower().encode()).hexdigest()
+    return _sha256(_normalize_text(s))
+
+
+class CustomerBufferMixin:
+  """Buffers the items of a Google Ads destination per customer across batches.
+
+  Buffered items are sent with GoogleAdsUtils.send_requests_per_customer, in
+  requests of at most `request_size` items. Destinations using the mixin call
+  `_init_customer_buffer` in their constructor, and provide `_utils` (a
+  GoogleAdsUtils) and `_send_request(customer_id, items)`.
+  """
+
+  def _init_customer_buffer(
+      self, config: Mapping[str, Any], request_size: int
+  ) -> None:
+    self._request_size = request_size
+    self._max_concurrent_requests = int(
+        config.get("max_concurrent_requests")
+        or GoogleAdsUtils.DEFAULT_MAX_CONCURRENT_REQUESTS
+    )
+    self._customer_buffer = CustomerBuffer(
+        request_size,
+        int(config.get("max_buffered_rows")
+            or GoogleAdsUtils.DEFAULT_MAX_BUFFERED_ROWS),
+        float(config.get("max_buffer_seconds")
+              or GoogleAdsUtils.DEFAULT_MAX_BUFFER_SECONDS),
+    )
+    # Rows of the previous batches of the run, offsetting buffered indices.
+    self._rows_seen = 0
+
+  def _buffer_and_send(
+      self,
+      items_by_customer: Mapping[str, GoogleAdsUtils.IndexedItems],
+      rows_count: int,
+  ) -> Tuple[List[int], GoogleAdsUtils.IndexedItems]:
+    """Buffers the valid items of a batch and sends the ones ready to be sent.
+
+    Args:
+      items_by_customer: Customer IDs mapped to index-item tuples, where the
+        index is the position of the item in the batch.
+      rows_count: The number of rows of the batch.
+
+    Returns:
+      The run-wide indices of the items sent successfully, and a list of
+      index-error for the items that failed.
+    """
+    ready_items = self._customer_buffer.add({
+        customer_id: self._run_indexed(indexed_items)
+        for customer_id, indexed_items in items_by_customer.items()
+    })
+    self._rows_seen += rows_count
+    return self._send_buffered(ready_items)
+
+  def _run_indexed(
+      self, indexed_items: Sequence[Tuple[int, Any]]
+  ) -> List[Tuple[int, Any]]:
+    """Offsets the indices of the items of a batch to the rows of the run.
+
+    Called before the batch is buffered, e.g. for the rows failing validation.
+    """
+    return [(self._rows_seen + index, item) for index, item in indexed_items]
+
+  def flush(self, dry_run: bool) -> Optional[RunResult]:
+    """Sends the items still buffered at the end of a run.
+
+    Args:
+      dry_run: If True, will not send data to API endpoints.
+
+    Returns: A RunResult summarizing success / failures of the flushed items.
+    """
+    successful_indices, send_failures = self._send_buffered(
+        self._customer_buffer.drain()
+    )
+    # the rows of the next run are indexed from the start again
+    self._rows_seen = 0
+    return RunResult(
+        successful_hits=len(successful_indices),
+        failed_hits=len(send_failures),
+        error_messages=[str(error[1]) for error in send_failures],
+        dry_run=dry_run,
+        failed_indices=[index for index, _ in send_failures],
+    )
+
+  def telemetry(self) -> Mapping[str, Any]:
+    """Returns the number of rows buffered and not sent yet."""
+    return {"buffered_rows": len(self._customer_buffer)}
+
+  def _send_buffered(
+      self, items_by_customer: Mapping[str, GoogleAdsUtils.IndexedItems]
+  ) -> Tuple[List[int], GoogleAdsUtils.IndexedItems]:
+    return self._utils.send_requests_per_customer(
+        self._send_request,
+        items_by_customer,
+        self._max_concurrent_requests,
+        self._request_size,
+    )
+
+  @staticmethod
+  def schema_fields() -> List[Tuple[str, type, Any]]:
+    """ProtocolSchema fields of the concurrency and buffering config fields."""
+    return [
+        ("max_concurrent_requests", Optional[int], Field(
+            default=GoogleAdsUtils.DEFAULT_MAX_CONCURRENT_REQUESTS,
+            description="Maximum number of customers uploaded to "
+                        "concurrently.")),
+        ("max_buffered_rows", Optional[int], Field(
+            default=GoogleAdsUtils.DEFAULT_MAX_BUFFERED_ROWS,
+            description="Rows buffered across batches (to upload each "
+                        "customer in full-size requests) before everything "
+                        "buffered is sent.")),
+        ("max_buffer_seconds", Optional[float], Field(
+            default=GoogleAdsUtils.DEFAULT_MAX_BUFFER_SECONDS,
+            description="Time rows can stay buffered before everything "
+                        "buffered is sent.")),
+    ]
+
+
+def _normalize_text(value: str) -> str:
+  return value.strip().lower()
+
+
+def _normalize_email(value: str) -> str:
+  normalized_email = value.strip().lower()
+  local_part, at, domain = normalized_email.partition("@")
+  # Google requires removal of any '.' characters preceding "gmail.com" or
+  # "googlemail.com"
+  if at and _GMAIL_DOMAIN_REGEX.match(domain):
+    normalized_email = f"{local_part.replace('.', '')}@{domain}"
+  return normalized_email
+
+
+def _sha256(value: str) -> str:
+  return hashlib.sha256(value.encode()).hexdigest()
+
+
+def _normalize_and_hash_chunk(rule: str, values: Sequence[str]) -> List[str]:
+  """Normalizes and hashes a chunk of values (runs in the process pool)."""
+  normalize = HashingUtils.NORMALIZERS[rule]
+  return [_sha256(normalize(value)) for value in values]
+
+
+class HashingModes(enum.Enum):
+  """Whether the values of a PII column are hashed before upload."""
+
+  AUTO = "auto"
+  RAW = "raw"
+  HASHED = "hashed"
+
+
+class HashingUtils:
+  """Normalizes and hashes whole columns of PII with SHA-256.
+
+  Normalization rules are precompiled, and columns with at least
+  `min_parallel_values` values are hashed in chunks across a process pool,
+  started on first use and shut down by `close` at the end of the run.
+  Columns are hashed in the calling process when the pool is not available
+  (single CPU, or task processes that are not allowed to have children).
+
+  Each column has a HashingModes mode: "raw" columns are always hashed,
+  "hashed" columns are passed through and "auto" columns are sampled, being
+  passed through when most sampled values are SHA-256 hex digests, in either
+  case (values of such a column that are not digests are still hashed, so raw
+  PII is never passed through, while the digests of a column not detected as
+  hashed are hashed again). Digests are passed through lowercased.
+
+  Hashes of the last `max_cached_values` distinct values of each rule are
+  memoized (in this instance's memory only, so raw values never outlive the
+  run), which spares re-hashing identifiers repeated across the rows of a
+  run.
+
+  Args:
+    modes: Column names mapped to their HashingModes value (default "auto").
+    min_parallel_values: Column size from which the process pool is used.
+    max_cached_values: Maximum number of memoized hashes per rule.
+  """
+
+  EMAIL = "email"
+  TEXT = "text"
+  NORMALIZERS = {
+      EMAIL: _normalize_email,
+      TEXT: _normalize_text,
+  }
+
+  def __init__(
+      self,
+      modes: Optional[Mapping[str, str]] = None,
+      min_parallel_values: int = _MIN_PARALLEL_HASHING_VALUES,
+      max_cached_values: int = _DEFAULT_MAX_CACHED_HASHES,
+  ):
+    self._modes = modes or {}
+    self._min_parallel_values = min_parallel_values
+    self._max_cached_values = max_cached_values
+    # normalization rules mapped to an LRU (oldest first) of raw values and
+    # their hashes
+    self._caches = {}
+    self._cache_hits = 0
+    self._cache_misses = 0
+    self._pool = None
+    self._pool_lock = threading.Lock()
+
+  def _get_pool(self) -> Optional[futures.ProcessPoolExecutor]:
+    with self._pool_lock:
+      cpu_count = os.cpu_count() or 1
+      if self._pool is None and cpu_count > 1:
+        # spawned, not forked: the task process runs gRPC and HTTP threads,
+        # whose locks a forked child could inherit while held
+        self._pool = futures.ProcessPoolExecutor(
+            max_workers=min(cpu_count, _MAX_HASHING_WORKERS),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+      return self._pool
+
+  def close(self) -> None:
+    """Shuts the process pool down (it is started again if used again)."""
+    with self._pool_lock:
+      pool, self._pool = self._pool, None
+    if pool is not None:
+      pool.shutdown(cancel_futures=True)
+
+  def stats(self) -> Dict[str, int]:
+    """Hash cache counters, reported as run telemetry by destinations."""
+    return {
+        "hash_cache_hits": self._cache_hits,
+        "hash_cache_misses": self._cache_misses,
+        "hash_cache_size": sum(map(len, self._caches.values())),
+    }
+
+  @staticmethod
+  def modes_from_config(
+      config: Mapping[str, Any], columns: Iterable[str]
+  ) -> Dict[str, str]:
+    """Reads the `<column>_hashing_mode` fields of a connection config."""
+    return {
+        column: config.get(f"{column}_hashing_mode") or HashingModes.AUTO.value
+        for column in columns
+    }
+
+  @staticmethod
+  def schema_fields(columns: Iterable[str]) -> List[Tuple[str, type, Any]]:
+    """ProtocolSchema fields of the `<column>_hashing_mode` config fields."""
+    return [
+        (f"{column}_hashing_mode", Optional[HashingModes], Field(
+            default=HashingModes.AUTO.value,
+            description=f"Whether `{column}` values are raw PII that is "
+                        "hashed before upload ('raw'), are already SHA-256 "
+                        "hashed ('hashed'), or are detected by sampling "
+                        "('auto'). In an 'auto' column not detected as "
+                        "hashed, the digests it contains are hashed again."))
+        for column in columns
+    ]
+
+  @staticmethod
+  def _looks_hashed(values: Sequence[str]) -> bool:
+    step = max(1, len(values) // _HASH_DETECTION_SAMPLE_SIZE)
+    sample = values[::step][:_HASH_DETECTION_SAMPLE_SIZE]
+    hashed = sum(1 for value in sample if _SHA256_HEX_REGEX.match(value))
+    return hashed * 2 > len(sample)
+
+  def hash_values(self, values: Sequence[str], rule: str = TEXT) -> List[str]:
+    """Normalizes and hashes a column of (non-empty) values.
+
+    Args:
+      values: The raw values.
+      rule: How values are normalized before hashing (EMAIL or TEXT).
+
+    Returns:
+      The SHA-256 hex digests, in the order of values.
+    """
+    cache = self._caches.setdefault(rule, {})
+    hashed = [cache.get(value) for value in values]
+    # distinct missed values, so that repeated values are only hashed once
+    missed_values = list(dict.fromkeys(
+        value for value, digest in zip(values, hashed) if digest is None
+    ))
+    self._cache_hits += len(values) - len(missed_values)
+    self._cache_misses += len(missed_values)
+    for value, digest in zip(values, hashed):
+      if digest is not None:
+        # dicts keep insertion order: re-inserting marks the most recent use
+        cache[value] = cache.pop(value)
+
+    if missed_values:
+      missed_digests = dict(
+          zip(missed_values, self._hash_uncached(missed_values, rule))
+      )
+      cache.update(missed_digests)
+      hashed = [
+          missed_digests[value] if digest is None else digest
+          for value, digest in zip(values, hashed)
+      ]
+      if len(cache) > self._max_cached_values:
+        # evicts the least recently used values in bulk, down to 3/4 of the
+        # limit, so that eviction stays cheap per value
+        keep = self._max_cached_values * 3 // 4
+        self._caches[rule] = dict(
+            itertools.islice(cache.items(), len(cache) - keep, None)
+        )
+    return hashed
+
+  def _hash_uncached(self, values: Sequence[str], rule: str) -> List[str]:
+    if len(values) >= self._min_parallel_values:
+      pool = self._get_pool()
+      if pool is not None:
+        chunks = [
+            values[start:start + _HASHING_CHUNK_SIZE]
+            for start in range(0, len(values), _HASHING_CHUNK_SIZE)
+        ]
+        try:
+          hashed = []
+          for hashed_chunk in pool.map(
+              _normalize_and_hash_chunk, [rule] * len(chunks), chunks
+          ):
+            hashed.extend(hashed_chunk)
+          return hashed
+        except (AssertionError, OSError, futures.BrokenExecutor):
+          # e.g. daemonic task processes cannot have children
+          print(f"Hashing process pool unavailable: {traceback.format_exc()}")
+          self._min_parallel_values = sys.maxsize
+    return _normalize_and_hash_chunk(rule, values)
+
+  def hash_columns(
+      self, rows: Sequence[Mapping[str, Any]], columns: Mapping[str, str]
+  ) -> List[Dict[str, Any]]:
+    """Replaces the non-empty values of PII columns by their hashes.
+
+    Args:
+      rows: The rows of a batch.
+      columns: The names of the columns to hash mapped to their rule.
+
+    Returns:
+      Copies of the rows, with the values of the provided columns hashed.
+    """
+    hashed_rows = [dict(row) for row in rows]
+    for column, rule in columns.items():
+      mode = self._modes.get(column, HashingModes.AUTO.value)
+      positions = [
+          i for i, row in enumerate(hashed_rows)
+          if isinstance(row.get(column), str) and row[column].strip()
+      ]
+      if mode == HashingModes.HASHED.value or (
+          mode == HashingModes.AUTO.value
+          and self._looks_hashed([hashed_rows[i][column] for i in positions])
+      ):
+        digest_positions = {
+            i for i in positions
+            if _SHA256_HEX_REGEX.match(hashed_rows[i][column])
+        }
+        # digests are passed through in the lowercase the APIs expect
+        for i in digest_positions:
+          hashed_rows[i][column] = hashed_rows[i][column].lower()
+        if mode == HashingModes.HASHED.value:
+          continue
+        positions = [i for i in positions if i not in digest_positions]
+      hashed_values = self.hash_values(
+          [hashed_rows[i][column] for i in positions], rule
+      )
+      for i, hashed_value in zip(positions, hashed_values):
+        hashed_rows[i][column] = hashed_value
+    return hashed_rows
+
+
+class _DiscoveryDocumentCache(Cache):
+  """On-disk cache of discovery documents, shared by the worker's tasks."""
+
+  def __init__(self, directory: pathlib.Path, max_age_seconds: float):
+    self._directory = directory
+    self._max_age_seconds = max_age_seconds
+
+  def _path(self, url: str) -> pathlib.Path:
+    return self._directory / f"{hashlib.sha256(url.encode()).hexdigest()}.json"
+
+  def get(self, url: str) -> Optional[str]:
+    path = self._path(url)
+    try:
+      if time.time() - path.stat().st_mtime < self._max_age_seconds:
+        return path.read_text()
+    except OSError:
+      pass
+    return None
+
+  def set(self, url: str, content: str) -> None:
+    try:
+      self._directory.mkdir(parents=True, exist_ok=True)
+      # written under a temporary name so readers never see partial files
+      temp_path = self._path(url).with_suffix(f".{os.getpid()}.tmp")
+      temp_path.write_text(content)
+      temp_path.replace(self._path(url))
+    except OSError:
+      print(f"Discovery document cache error: {traceback.format_exc()}")
+
+
+class _JitteredRetry(Retry):
+  """A urllib3 Retry whose exponential backoff is randomized (full jitter).
+
+  Concurrent clients failing together hence do not retry in lockstep. A
+  Retry-After header, when present, still takes precedence.
+
+  Read errors and 5xx responses are only retried for the allowed (by default
+  idempotent) methods, as e.g. a POST may have been processed. Throttled
+  (429) requests were not processed, so they are retried whatever their
+  method.
+  """
+
+  def get_backoff_time(self) -> float:
+    return random.uniform(0, super().get_backoff_time())
+
+  def is_retry(
+      self, method: str, status_code: int, has_retry_after: bool = False
+  ) -> bool:
+    if status_code == 429 and not self._is_method_retryable(method):
+      return True
+    return super().is_retry(method, status_code, has_retry_after)
+
+
+class _Httplib2Adapter:
+  """Exposes an HttpTransport with the interface of httplib2.Http.
+
+  Lets googleapiclient services (authorized by google_auth_httplib2) send
+  their requests on the pooled transport.
+  """
+
+  def __init__(
+      self,
+      transport: "HttpTransport",
+      timeout: Optional[float],
+      retry: bool,
+      idempotent: bool,
+  ):
+    self._transport = transport
+    self.timeout = timeout
+    self._retry = retry
+    self._idempotent = idempotent
+
+  def request(
+      self,
+      uri: str,
+      method: str = "GET",
+      body: Optional[Any] = None,
+      headers: Optional[Mapping[str, str]] = None,
+      redirections: int = httplib2.DEFAULT_MAX_REDIRECTS,
+      connection_type: Optional[Any] = None,
+  ) -> Tuple[httplib2.Response, bytes]:
+    del connection_type  # connections are managed by the transport
+    response = self._transport.request(
+        method,
+        uri,
+        data=body,
+        headers=headers,
+        timeout=self.timeout,
+        retry=self._retry,
+        idempotent=self._idempotent,
+        allow_redirects=redirections > 0,
+    )
+    info = dict(response.headers)
+    # requests already decoded the content
+    info.pop("Content-Encoding", None)
+    info["status"] = str(response.status_code)
+    httplib2_response = httplib2.Response(info)
+    httplib2_response.reason = response.reason
+    return httplib2_response, response.content
+
+
+class HttpTransport:
+  """Pooled HTTP transport shared by the REST destinations of a worker.
+
+  Keeps connections alive across requests and destinations, and retries
+  connection errors and 429 responses (and, for idempotent methods, read
+  errors and 5xx responses) with a jittered exponential backoff that honors
+  Retry-After. Callers sending idempotent POSTs (e.g. deduplicated uploads)
+  opt them into 5xx retries, and callers retrying on their own send single
+  attempts instead (see request), so that retries are never stacked. Every request has a
+  timeout, and is reported to the metrics hooks and the stats of the
+  transport.
+  """
+
+  DEFAULT_TIMEOUT_SECONDS = 60
+  DEFAULT_MAX_RETRIES = 3
+  RETRIABLE_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+  _shared: Dict[int, "HttpTransport"] = {}
+  _shared_lock = threading.Lock()
+
+  def __init__(
+      self,
+      max_retries: int = DEFAULT_MAX_RETRIES,
+      backoff_factor: float = 0.5,
+      pool_maxsize: int = 32,
+  ):
+    retry = _JitteredRetry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=self.RETRIABLE_STATUS_CODES,
+        respect_retry_after_header=True,
+        # the last response is returned once retries are exhausted
+        raise_on_status=False,
+    )
+    self._session = self._build_session(retry, pool_maxsize)
+    # None allows every method to be retried
+    self._idempotent_session = self._build_session(
+        retry.new(allowed_methods=None), pool_maxsize
+    )
+    self._single_attempt_session = self._build_session(
+        Retry(total=0, raise_on_status=False), pool_maxsize
+    )
+    self._metrics_hooks: List[Callable[[str, str, Optional[int], float], None]] = []
+    self._stats_lock = threading.Lock()
+    self._stats = {
+        "http_requests": 0,
+        "http_retries": 0,
+        "http_errors": 0,
+        "http_seconds": 0.0,
+    }
+
+  @staticmethod
+  def _build_session(retry: Retry, pool_maxsize: int) -> requests.Session:
+    adapter = HTTPAdapter(
+        pool_connections=8, pool_maxsize=pool_maxsize, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+  @classmethod
+  def shared(cls) -> "HttpTransport":
+    """Returns the transport of the current process, creating it if needed."""
+    # keyed by process, so that forked workers never share sockets
+    pid = os.getpid()
+    with cls._shared_lock:
+      if pid not in cls._shared:
+        cls._shared[pid] = cls()
+      return cls._shared[pid]
+
+  def add_metrics_hook(
+      self, hook: Callable[[str, str, Optional[int], float], None]
+  ) -> None:
+    """Registers hook(method, url, status, seconds), called after requests.
+
+    The status is None when the request failed without a response.
+    """
+    self._metrics_hooks.append(hook)
+
+  def request(
+      self,
+      method: str,
+      url: str,
+      timeout: Optional[float] = None,
+      retry: bool = True,
+      idempotent: bool = False,
+      **kwargs: Any,
+  ) -> requests.Response:
+    """Sends a request, retrying it on retriable failures.
+
+    Args:
+      method: The HTTP method.
+      url: The request URL.
+      timeout: Timeout of each attempt in seconds, defaults to
+        DEFAULT_TIMEOUT_SECONDS.
+      retry: Whether to retry the request; False for callers that retry
+        failed requests on their own.
+      idempotent: Whether the request can be sent again even if it may have
+        been processed, so that read errors and 5xx responses of non
+        idempotent methods (e.g. POST) are retried too.
+      **kwargs: Other arguments of requests.Session.request.
+
+    Returns:
+      The response (of the last attempt).
+
+    Raises:
+      requests.ConnectionError or requests.Timeout, if no attempt got a
+      response.
+    """
+    start = time.monotonic()
+    status = None
+    retries = 0
+    if not retry:
+      session = self._single_attempt_session
+    elif idempotent:
+      session = self._idempotent_session
+    else:
+      session = self._session
+    try:
+      response = session.request(
+          method, url, timeout=timeout or self.DEFAULT_TIMEOUT_SECONDS, **kwargs
+      )
+      status = response.status_code
+      attempts = getattr(response.raw, "retries", None)
+      retries = len(attempts.history) if attempts else 0
+      return response
+    finally:
+      seconds = time.monotonic() - start
+      with self._stats_lock:
+        self._stats["http_requests"] += 1
+        self._stats["http_retries"] += retries
+        self._stats["http_errors"] += status is None or status >= 400
+        self._stats["http_seconds"] += seconds
+      for hook in self._metrics_hooks:
+        hook(method, url, status, seconds)
+
+  def post(self, url: str, **kwargs: Any) -> requests.Response:
+    return self.request("POST", url, **kwargs)
+
+  def httplib2_adapter(
+      self,
+      timeout: Optional[float] = None,
+      retry: bool = True,
+      idempotent: bool = False,
+  ) -> _Httplib2Adapter:
+    """Returns an httplib2.Http compatible view of the transport.
+
+    The retry and idempotent arguments apply to all its requests (see
+    request).
+    """
+    return _Httplib2Adapter(self, timeout, retry, idempotent)
+
+  def stats(self) -> Dict[str, float]:
+    """Returns the counters of the requests sent by the process."""
+    with self._stats_lock:
+      return dict(self._stats)
+
+
+class RateLimiter:
+  """Spaces out the calls of all threads to a maximum rate.
+
+  Calls beyond the rate are delayed (not dropped), so that a burst of
+  concurrent requests is spread evenly instead of hitting a quota at once.
+  """
+
+  def __init__(self, max_calls_per_second: float):
+    self._interval = 1 / max_calls_per_second
+    self._lock = threading.Lock()
+    self._next_call_time = 0.0
+
+  def acquire(self) -> None:
+    """Blocks until the calling thread is allowed to make a call."""
+    with self._lock:
+      now = time.monotonic()
+      delay = self._next_call_time - now
+      self._next_call_time = max(now, self._next_call_time) + self._interval
+    if delay > 0:
+      time.sleep(delay)
+
+
+class SharedRateLimiter(RateLimiter):
+  """A RateLimiter shared by every task and worker calling with the same key.
+
+  The next call time of each key is kept in the Tightlock config database and
+  reserved with an atomic upsert (timed by the database clock), so calls of
+  concurrent runs are spread over the rate wherever they run. When the
+  database cannot be used, only the calls of this limiter are spaced out.
+  """
+
+  def __init__(self, key: str, max_calls_per_second: float):
+    super().__init__(max_calls_per_second)
+    self._key = key
+    self._conn = None
+    self._conn_lock = threading.Lock()
+    self._shared = True
+
+  def _reserve(self) -> float:
+    """Reserves the next call slot of the key, returning the delay until it."""
+    with self._conn_lock:
+      if self._conn is None:
+        self._conn = PostgresHook(postgres_conn_id="tightlock_config").get_conn()
+        self._conn.autocommit = True
+        with self._conn.cursor() as cursor:
+          cursor.execute(
+              f"CREATE TABLE IF NOT EXISTS {_RATE_LIMIT_TABLE} ("
+              " key TEXT PRIMARY KEY,"
+              " next_call_time DOUBLE PRECISION NOT NULL)"
+          )
+      with self._conn.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {_RATE_LIMIT_TABLE} AS limits (key, next_call_time)"
+            " VALUES (%(key)s, extract(epoch FROM clock_timestamp()) + %(interval)s)"
+            " ON CONFLICT (key) DO UPDATE SET next_call_time = GREATEST("
+            "limits.next_call_time, extract(epoch FROM clock_timestamp()))"
+            " + %(interval)s"
+            " RETURNING next_call_time - %(interval)s"
+            " - extract(epoch FROM clock_timestamp())",
+            {"key": self._key, "interval": self._interval},
+        )
+        (delay,) = cursor.fetchone()
+    return delay
+
+  def acquire(self) -> None:
+    """Blocks until the calling thread is allowed to make a call."""
+    if self._shared:
+      try:
+        delay = self._reserve()
+      except Exception:  # pylint: disable=broad-except
+        print(f"Shared rate limiter unavailable: {traceback.format_exc()}")
+        self._shared = False
+        self.close()
+      else:
+        if delay > 0:
+          time.sleep(delay)
+        return
+    super().acquire()
+
+  def close(self) -> None:
+    """Closes the database connection of the limiter."""
+    with self._conn_lock:
+      conn, self._conn = self._conn, None
+    if conn is not None:
+      try:
+        conn.close()
+      except psycopg2.Error:
+        pass
+
+
+class OAuthTokenCache:
+  """Access tokens of user credentials, shared by all tasks and connections.
+
+  Tokens are kept with their expiry in the Tightlock config database, keyed
+  by the client id and a hash of the refresh token (which is not stored).
+  Refreshes of the same credentials are serialized with an advisory lock, so
+  connections starting together exchange their refresh token only once.
+  When the database cannot be used, tokens are refreshed without sharing.
+
+  Access tokens are stored in plaintext. They are only valid until their
+  expiry (about an hour), and can only be read with access to the config
+  database, which already holds the connection configs and their refresh
+  tokens.
+  """
+
+  _shared: Dict[int, "OAuthTokenCache"] = {}
+  _shared_lock = threading.Lock()
+
+  def __init__(self):
+    self._conn = None
+    self._conn_lock = threading.Lock()
+
+  @classmethod
+  def shared(cls) -> "OAuthTokenCache":
+    """Returns the cache of the current process, creating it if needed."""
+    # keyed by process, so that forked workers never share connections
+    pid = os.getpid()
+    with cls._shared_lock:
+      if pid not in cls._shared:
+        cls._shared[pid] = cls()
+      return cls._shared[pid]
+
+  @staticmethod
+  def _key(client_id: str, refresh_token: str) -> str:
+    return hashlib.sha256(f"{client_id}:{refresh_token}".encode()).hexdigest()
+
+  def _connect(self) -> Any:
+    """Opens the connection of the cache, creating the token table."""
+    conn = PostgresHook(postgres_conn_id="tightlock_config").get_conn()
+    try:
+      with conn.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {_OAUTH_TOKEN_TABLE} ("
+            " key TEXT PRIMARY KEY,"
+            " access_token TEXT NOT NULL,"
+            " expiry TIMESTAMP NOT NULL)"
+        )
+      conn.commit()
+    except psycopg2.Error:
+      conn.close()
+      raise
+    return conn
+
+  def _get_or_refresh(
+      self,
+      key: str,
+      refresh: Callable[[], Tuple[str, datetime.datetime]],
+  ) -> Tuple[str, datetime.datetime]:
+    """Returns the shared token of key, refreshing it if about to expire."""
+    with self._conn_lock:
+      try:
+        if self._conn is None:
+          self._conn = self._connect()
+      except Exception:  # pylint: disable=broad-except
+        print(f"OAuth token cache unavailable: {traceback.format_exc()}")
+      else:
+        try:
+          with self._conn.cursor() as cursor:
+            # held until the commit, i.e. while the token is being refreshed
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (key,))
+            cursor.execute(
+                f"SELECT access_token, expiry FROM {_OAUTH_TOKEN_TABLE}"
+                " WHERE key = %s",
+                (key,),
+            )
+            row = cursor.fetchone()
+            now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            if row and row[1] - now >= _OAUTH_TOKEN_MIN_VALIDITY:
+              token, expiry = row
+            else:
+              token, expiry = refresh()
+              cursor.execute(
+                  f"INSERT INTO {_OAUTH_TOKEN_TABLE} (key, access_token, expiry)"
+                  " VALUES (%s, %s, %s) ON CONFLICT (key) DO UPDATE SET"
+                  " access_token = EXCLUDED.access_token, expiry = EXCLUDED.expiry",
+                  (key, token, expiry),
+              )
+          self._conn.commit()
+          return token, expiry
+        except psycopg2.Error:
+          print(f"OAuth token cache error: {traceback.format_exc()}")
+          # connects again on the next refresh
+          self._conn.close()
+          self._conn = None
+        except BaseException:
+          # releases the advisory lock of a failed token refresh
+          self._conn.rollback()
+          raise
+    return refresh()
+
+  def user_credentials(
+      self,
+      client_id: str,
+      client_secret: str,
+      refresh_token: str,
+      token_uri: str = GOOGLE_OAUTH_TOKEN_URI,
+  ) -> google.oauth2.credentials.Credentials:
+    """Builds user credentials whose access tokens go through the cache.
+
+    Args:
+      client_id: The OAuth2.0 client ID.
+      client_secret: The OAuth2.0 client secret.
+      refresh_token: The OAuth2.0 refresh token.
+      token_uri: The token endpoint of the refresh token exchange.
+
+    Returns: Credentials refreshed (on first use and when expired) from the
+      cache, or by exchanging the refresh token when the cache has no valid
+      token.
+    """
+    key = self._key(client_id, refresh_token)
+
+    def refresh_handler(request, scopes):
+      del scopes  # granted with the refresh token
+
+      def refresh() -> Tuple[str, datetime.datetime]:
+        credentials = google.oauth2.credentials.Credentials(
+            None,
+            refresh_token=refresh_token,
+            token_uri=token_uri,
+            client_id=client_id,
+            client_secret=client_secret,
+        )
+        credentials.refresh(request)
+        return credentials.token, credentials.expiry
+
+      return self._get_or_refresh(key, refresh)
+
+    # Without a refresh token, the credentials refresh with the handler.
+    return google.oauth2.credentials.Credentials(
+        None,
+        token_uri=token_uri,
+        client_id=client_id,
+        client_secret=client_secret,
+        refresh_handler=refresh_handler,
+    )
+
+
+class GoogleApiUtils:
+  """Utility functions for connectors of discovery-based Google APIs."""
+
+  def build_service(
+      self,
+      service_name: str,
+      version: str,
+      http: Any,
+      discovery_service_url: Optional[str] = None,
+  ) -> Any:
+    """Builds a discovery-based API service, reusing a cached document.
+
+    The discovery document is fetched (from discovery_service_url, if
+    provided) and cached on disk, so that the following builds of the worker
+    do not fetch it again. When it cannot be fetched, the document bundled
+    with google-api-python-client is used instead. Bundled documents may lag
+    behind the live API, hence they are only a fallback.
+
+    Args:
+      service_name: The API name, e.g. "displayvideo".
+      version: The API version, e.g. "v3".
+      http: The (authorized) httplib2.Http used by the service.
+      discovery_service_url: Optional URL template of the remote document.
+
+    Returns: The API service resource.
+    """
+    try:
+      return discovery.build(
+          service_name,
+          version,
+          http=http,
+          discoveryServiceUrl=(
+              discovery_service_url or discovery.V2_DISCOVERY_URI
+          ),
+          static_discovery=False,
+          cache=_DiscoveryDocumentCache(
+              _DISCOVERY_CACHE_DIR, _DISCOVERY_CACHE_MAX_AGE_SECONDS
+          ),
+      )
+    except (HttpError, httplib2.HttpLib2Error, OSError):
+      print(
+          f"Could not fetch the {service_name} {version} discovery document, "
+          "using the bundled one."
+      )
+    return discovery.build(
+        service_name, version, http=http, static_discovery=True
+    )
 
 
 class DrillMixin:
@@ -270,15 +1654,27 @@ class DrillMixin:
     return events
 
   def get_drill_data(
-      self, from_target: Sequence[str], fields: Sequence[str], offset: int, limit: int
+      self,
+      from_target: Sequence[str],
+      fields: Sequence[str],
+      offset: int,
+      limit: int,
+      query_options: Optional[QueryOptions] = None,
   ) -> List[Mapping[str, Any]]:
     drill_conn = DrillHook().get_conn()
     cursor = drill_conn.cursor()
     table_alias = _TABLE_ALIAS
-    fields_str = ",".join([f"{table_alias}.{field}" for field in fields])
+    query_options = query_options or QueryOptions()
+    column = lambda name: f"{table_alias}.`{name}`"
+    alias = lambda name: f"`{name}`"
+    fields_str = query_options.build_select_list(fields, column, alias)
+    where_clause = query_options.build_where_clause(
+        column, QueryOptions.sql_literal
+    )
     query = (
         f"SELECT {fields_str}"
         f" FROM {from_target} as {table_alias}"
+        f"{f' WHERE {where_clause}' if where_clause else ''}"
         f" LIMIT {limit} OFFSET {offset}"
     )
     try:
@@ -289,6 +1685,50 @@ class DrillMixin:
       results = []
     return results
 
+  def count_drill_rows(
+      self, from_target: str, query_options: Optional[QueryOptions] = None
+  ) -> Optional[int]:
+    """Counts the rows of a Drill target (Parquet counts come from metadata)."""
+    drill_conn = DrillHook().get_conn()
+    cursor = drill_conn.cursor()
+    table_alias = _TABLE_ALIAS
+    query_options = query_options or QueryOptions()
+    where_clause = query_options.build_where_clause(
+        lambda name: f"{table_alias}.`{name}`", QueryOptions.sql_literal
+    )
+    query = (
+        f"SELECT COUNT(1) FROM {from_target} as {table_alias}"
+        f"{f' WHERE {where_clause}' if where_clause else ''}"
+    )
+    try:
+      cursor.execute(query)
+      return int(cursor.fetchone()[0])
+    except Exception:  # pylint: disable=broad-except
+      print(f"Drill count error: {traceback.format_exc()}")
+      return None
+
+  def list_drill_files(self, path: str) -> List[str]:
+    """Lists the names of the files directly under a Drill directory path.
+
+    Returns an empty list when the path is not a directory (or cannot be
+    listed), so callers can fall back to reading the path as a single table.
+    """
+    drill_conn = DrillHook().get_conn()
+    cursor = drill_conn.cursor()
+    try:
+      cursor.execute(f"SHOW FILES IN {path}")
+      columns = [d[0] for d in cursor.description]
+      rows = cursor.fetchall()
+    except Exception:  # pylint: disable=broad-except
+      return []
+    name_index = columns.index("name")
+    is_file_index = columns.index("isFile")
+    return sorted(
+        row[name_index] for row in rows
+        if str(row[is_file_index]).lower() == "true"
+        and not row[name_index].startswith((".", "_"))
+    )
+
   def validate_drill(self, path: str) -> ValidationResult:
     drill_conn = DrillHook().get_conn()
     cursor = drill_conn.cursor()
@@ -22,8 +22,8 @@ from typing import Any, Awaitable, Callable, Dict, List, Optional
 from functools import partial
 
 import httpx
-from models import (Connection, RunLog, RunLogsResponse, RunResult,
-                    ValidationResult)
+from models import (Connection, RunLog, RunLogsResponse, RunProgress,
+                    RunResult, ValidationResult)
 
 _AIRFLOW_BASE_URL = "http://airflow-webserver:8080"
 
@@ -152,6 +152,29 @@ class AirflowClient:
 
     return response
 
+  async def get_run_progress(self, connection_name: str) -> Optional[RunProgress]:
+    """Retrieves the progress published by the latest run of a connection."""
+    dag_id = f"{connection_name}_dag"
+    url = f"{self.base_url}/dags/{dag_id}/dagRuns?order_by=-execution_date&limit=1"
+    list_response = await self._get_request(url, status_forcelist=[])
+    if list_response.status_code != 200:
+      return None
+    runs = list_response.json().get("dag_runs")
+    if not runs:
+      return None
+    run = runs[0]
+    dag_run_id = run["dag_run_id"]
+    progress_response = await self._get_dag_run_xcom(dag_id, dag_run_id, "run_progress")
+    progress = {}
+    if progress_response.status_code == 200:
+      progress = ast.literal_eval(progress_response.json().get("value") or "{}")
+    return RunProgress(
+        connection_name=connection_name,
+        dag_run_id=dag_run_id,
+        state=run.get("state") or "Missing",
+        **progress,
+    )
+
   async def trigger(
       self,
       dag_prefix: str,
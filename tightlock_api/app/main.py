@@ -25,7 +25,7 @@ from db import get_session
 from fastapi import Body, Depends, FastAPI, HTTPException, Query
 from fastapi.responses import Response, JSONResponse
 from models import (Config, ConfigValue, Connection, ConnectResponse, RunLogsResponse,
-                    ValidationResult)
+                    RunProgress, ValidationResult)
 from security import check_authentication_header
 from sqlalchemy.exc import IntegrityError, NoResultFound
 from sqlmodel import select
@@ -87,6 +87,29 @@ async def trigger_connection(
   return Response(status_code=response.status_code)
 
 
+@v1.get("/connections/{connection_name}:progress", response_model=RunProgress)
+async def get_connection_progress(
+    connection_name: str,
+    airflow_client=Depends(AirflowClient),
+):
+  """Retrieves the progress of the latest run of a connection.
+
+  Args:
+    connection_name: The name of the target connection.
+    airflow_client: Airflow Client dependency injection.
+  Returns:
+    The RunProgress of the latest run, including rows done, throughput and
+    an ETA when the source can estimate its total number of rows.
+  """
+  progress = await airflow_client.get_run_progress(connection_name)
+  if not progress:
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail=f"No runs found for connection {connection_name}.",
+    )
+  return progress
+
+
 @v1.get("/configs", response_model=list[Config])
 async def get_configs(session: AsyncSession = Depends(get_session)):
   """Retrieves stored configs.
@@ -16,7 +16,7 @@ limitations under the License."""
 """Definition of data models used by Tightlock application."""
 
 import datetime
-from typing import Any, Dict, Optional, Sequence
+from typing import Any, Dict, List, Optional, Sequence
 
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.dialects.postgresql import JSONB
@@ -50,6 +50,22 @@ class RunLog(SQLModel):
   run_type: str
   run_result: RunResult
 
+class RunProgress(SQLModel):
+  """Progress of the latest run of a connection."""
+
+  connection_name: str
+  dag_run_id: str
+  state: str
+  rows_done: int = 0
+  batches_done: int = 0
+  total_rows: Optional[int] = None
+  rows_per_second: float = 0.0
+  eta_seconds: Optional[float] = None
+  started_at: Optional[float] = None
+  updated_at: Optional[float] = None
+  done: bool = False
+  telemetry: Dict[str, Any] = {}
+
 class RunLogsResponse(SQLModel):
   """RunLogs endpoint response."""
   run_logs: Sequence[RunLog]
@@ -78,6 +94,10 @@ class Connection(SQLModel):
   source: Dict[str, Any]  # Source
   destination: Dict[str, Any]  # Destination
   schedule: Optional[str] = None  # A cron expression or preset
+  # Destination field -> source column (or {"source": ..., "cast": ...})
+  field_mappings: Optional[Dict[str, Any]] = None
+  # Row filters pushed down to the source query
+  filters: Optional[List[Dict[str, Any]]] = None
 
 
 class Config(SQLModel, table=True):